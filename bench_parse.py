@@ -0,0 +1,106 @@
+"""
+CPU cost of turning raw bluetoothctl scan output into clean lines, per MB:
+the old pipeline (pexpect logfile hook splitting lines, parse_text on every
+log message and on every expect() buffer, strptime per line) against the
+pty reader, which decodes, strips and splits each byte once.
+
+    python bench_parse.py --mb 8
+"""
+import re
+import time
+import random
+import argparse
+from datetime import datetime
+
+from models.ptyreader import PtyReader
+
+
+PROMPT = "\x1b[0;94m[bluetooth]\x1b[0m# "
+
+
+def scan_output(size, seed=0):
+    """Colored [NEW]/[CHG] events with prompt redraws, like a busy scan."""
+    rand = random.Random(seed)
+    macs = [":".join("%02X" % rand.randrange(256) for _ in range(6)) for _ in range(200)]
+    parts = []
+    total = 0
+    while total < size:
+        mac = rand.choice(macs)
+        if rand.random() < 0.9:
+            line = "[\x1b[0;93mCHG\x1b[0m] Device %s RSSI: %d" % (mac, rand.randrange(-99, -30))
+        else:
+            line = "[\x1b[0;92mNEW\x1b[0m] Device %s %s" % (mac, mac.replace(":", "-"))
+        part = "\r\x1b[K" + line + "\r\n" + PROMPT
+        parts.append(part)
+        total += len(part)
+    return "".join(parts).encode("utf-8")
+
+
+def chunks(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def legacy(data, chunk):
+    """What models/bluetooth.py did before the reader thread."""
+    def parse_text(text):
+        ansi_escape = r'(\x1B[@-_][0-?]*[ -/]*[@-~])+'
+        ansi_regex = re.compile(ansi_escape)
+        return ansi_regex.sub("", text).split('\r\n')
+
+    asctime = "2024-01-01 12:00:00,000"
+    lines = 0
+    for raw in chunks(data, chunk):
+        text = raw.decode("utf-8", "replace")
+        # logfile hook, one log record per line
+        records = [line for line in re.split(r'[\n\r]+', text) if line.strip() != ""]
+        # _update_from_discover_log
+        for msg in records:
+            for line in parse_text(msg):
+                datetime.strptime(asctime.split(",")[0], "%Y-%m-%d %H:%M:%S")
+                lines += 1
+        # wait_for_prompt / get_output on the expect() buffer
+        parse_text(text)
+    return lines
+
+
+def reader(data, chunk):
+    records = []
+    pty = PtyReader(None, on_line=records.append)
+    for raw in chunks(data, chunk):
+        pty.feed(raw)
+    created = time.time()
+    for msg in records:
+        datetime.fromtimestamp(created)
+    return len(records)
+
+
+def measure(fn, data, chunk, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        lines = fn(data, chunk)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark bluetoothctl output parsing")
+    parser.add_argument("--mb", type=float, default=4.0, help="MB of scan output")
+    parser.add_argument("--chunk", type=int, default=4096, help="bytes per pty read")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = scan_output(int(args.mb * 1024 * 1024))
+    mb = len(data) / (1024 * 1024)
+
+    old, old_lines = measure(legacy, data, args.chunk, args.repeat)
+    new, new_lines = measure(reader, data, args.chunk, args.repeat)
+    print("%.1f MB of scan output, %d byte reads" % (mb, args.chunk))
+    print("legacy  %6.3f s CPU/MB  (%d lines)" % (old / mb, old_lines))
+    print("reader  %6.3f s CPU/MB  (%d lines)" % (new / mb, new_lines))
+    print("saved   %6.3f s CPU/MB  (%.1fx)" % ((old - new) / mb, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,19 +5,93 @@ from picotui.defs import *
 
 from views.itemlist import WListBox2
 from views.pane import Pane
+from views.viewmodel import EMPTY_VIEW
+from views.framebuffer import FrameBuffer
+from views.rowcache import RowCache
 import models.bluetooth as bluelib
+from models.controllers import ControllerPool
+from models.actions import Action, ActionQueue
+from models.reconnect import ReconnectManager
+from models.daemon import BluetoothClient, DEFAULT_SOCKET
+from models.scan import PROFILE_ORDER
+from models.profiler import SamplingProfiler, DEFAULT_OUTPUT
+from models.memory import MemoryMonitor, TRACE_OUTPUT
+from models.latency import LatencyMeter
+from models.idle import IdleMonitor, device_state
+from models.signal import sort_by_proximity
+from models.sightings import DEFAULT_LOG
 from threading import Thread, Timer
+import argparse
+import os
+import queue
+import signal
+import sys
+import threading
 import time
 
 def write_log(msg):
     with open("log.txt","a") as fh:
         fh.write("%s\n" % msg)
 
+# focus in/out, reported once enabled with \x1b[?1004h
+KEY_FOCUS_IN = b"\x1b[I"
+KEY_FOCUS_OUT = b"\x1b[O"
+
 class RepeatingTimer(Timer):
+    """Runs `function` every `interval` seconds, with an IdleMonitor not while idle."""
+
+    def __init__(self, interval, function, idle=None):
+        super().__init__(interval, function)
+        self.idle = idle
+
     def run(self):
         while not self.finished.is_set():
-            self.function(*self.args, **self.kwargs)
-            self.finished.wait(self.interval)
+            if self.idle is None:
+                self.function(*self.args, **self.kwargs)
+                self.finished.wait(self.interval)
+            else:
+                self.idle.tick()
+                self.function(*self.args, **self.kwargs)
+                self.idle.wait(self.interval, self.finished)
+
+    def cancel(self):
+        super().cancel()
+        if not self.idle is None:
+            self.idle.wake()
+
+class Dispatcher(Thread):
+    """
+    Runs the bluetoothctl work of the input loop in order, so a key never
+    waits for bluetoothctl to answer.
+    """
+
+    def __init__(self):
+        super().__init__(name="dispatch", daemon=True)
+        self.jobs = queue.Queue()
+
+    def submit(self, function, *args):
+        self.jobs.put((function, args))
+
+    def stop(self):
+        self.jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            function, args = job
+            try:
+                function(*args)
+            except Exception as e:
+                write_log(e)
+
+def terminal_size():
+    try:
+        return tuple(os.get_terminal_size(sys.stdout.fileno()))
+    except OSError:
+        # not a tty we can ioctl, ask the terminal itself
+        return Screen.screen_size()
 
 
 '''
@@ -38,40 +112,80 @@ class BluetoothApplet:
     class ViewState:
         VIEW_ALL = "all"
         VIEW_PAIRED = "paired"
+        VIEW_NEARBY = "nearby"
 
 
-    class ActionState:
-        PAIRING = 0
-        CONNECTING = 1
-        UNPAIRING= 2
-        DISCONNECTING = 3
-        TRUSTING = 4
-        UNTRUSTING = 5
-        IDLE = 6
-
-
-
-    def __init__(self):
+    def __init__(self, bluetooth=None, max_actions=3, reconnect=True, \
+                 profile_output=DEFAULT_OUTPUT, memory_threshold=16*1024*1024, \
+                 idle_after=60.0, idle_pause_scan=False):
         self.bluetooth = None
         self.screen = Screen()
-        self.scan_state = BluetoothApplet.ScanState.NOT_SCANNING
-        self.controller_state = BluetoothApplet.ControllerState.ON
-        self.action_state = BluetoothApplet.ActionState.IDLE
-        self.target = None
+        self.scan_states = {}
 
-        self.bluetooth = bluelib.Bluetoothctl(rfkill_unblock=False,debug=False)
+        if bluetooth is None:
+            bluetooth = bluelib.Bluetoothctl(rfkill_unblock=False,debug=False)
+        self.bluetooth = bluetooth
+        self.actions = ActionQueue(self.bluetooth, limit=max_actions)
+        self.reconnect = None
+        if reconnect:
+            self.reconnect = ReconnectManager(self.actions)
 
         self.view_index = 0
+        self.devices = []
+        # (devices in view order, mac -> position), swapped in as one
+        self.arranged = ([], {})
+        self.controllers = []
+        self.controller = {}
+        self.scan_stats = {"profile": None, "rate": 0.0, "profiles": {}}
+        self.session_stats = {}
+        self.filter_text = ""
+        self.filtering = False
         self.view_order = [
             BluetoothApplet.ViewState.VIEW_PAIRED,
-            BluetoothApplet.ViewState.VIEW_ALL
+            BluetoothApplet.ViewState.VIEW_ALL,
+            BluetoothApplet.ViewState.VIEW_NEARBY
         ]
 
+        # what is on screen, see paint()
+        self.view = EMPTY_VIEW
+        self.row_cache = RowCache(self.format_row, self.row_fields)
+        self.view_lock = threading.Lock()
+        self.paint_lock = threading.RLock()
+        self.size = None
+
+        self.memory = MemoryMonitor(self.bluetooth.get_memory_stats, \
+                                    threshold=memory_threshold)
+        # no refreshes while nobody looks and nothing happens
+        self.idle = IdleMonitor(timeout=idle_after, on_idle=self.enter_idle, \
+                                on_wake=self.leave_idle)
+        self.idle_pause_scan = idle_pause_scan
+        self.device_state = None
+        # set by SIGUSR2, the update thread does the toggling
+        self.profile_requested = threading.Event()
+
         def update_in_background():
+            if self.profile_requested.is_set():
+                self.profile_requested.clear()
+                self.toggle_profiler()
             self.update_pane()
+            self.memory.sample()
+            if not self.reconnect is None:
+                self.reconnect.update(self.devices, self.controller)
+            if not self.actions.needs_scan_paused():
+                self.unpause_scan()
+            self.watch_activity()
             self.update_status()
 
-        self.update_thread = RepeatingTimer(2.0, update_in_background)
+        self.update_thread = RepeatingTimer(2.0, update_in_background, idle=self.idle)
+        self.update_thread.name = "update"
+        self.dispatcher = Dispatcher()
+        # key read to first repaint
+        self.latency = LatencyMeter()
+        # the input loop and the background refresh
+        self.profiler = SamplingProfiler(path=profile_output, \
+                                         threads=[threading.main_thread(), \
+                                                  self.update_thread, \
+                                                  self.dispatcher])
 
 
 
@@ -81,13 +195,69 @@ class BluetoothApplet:
         index = abs(self.view_index) % n
         return self.view_order[index]
 
+    @property
+    def controller_mac(self):
+        return self.controller.get("mac_addr")
+
+    @property
+    def controller_state(self):
+        if self.controller.get("powered") is False:
+            return BluetoothApplet.ControllerState.OFF
+        return BluetoothApplet.ControllerState.ON
+
+    @property
+    def scan_state(self):
+        return self.scan_states.get(self.controller_mac, \
+                                    BluetoothApplet.ScanState.NOT_SCANNING)
+
+    @scan_state.setter
+    def scan_state(self, state):
+        self.scan_states[self.controller_mac] = state
+
     def screen_redraw(self,allow_cursor=False):
-        self.update_pane()
-        self.update_status()
+        # resizes and redraw requests only repaint the last snapshot
+        if self.layout():
+            self.screen.cls()
+        self.paint()
+
+    def publish(self, **changes):
+        """Replace parts of the snapshot and paint them."""
+        with self.view_lock:
+            self.view = self.view._replace(**changes)
+        self.paint(changes.keys())
+
+    def paint(self, fields=None):
+        """
+        Paint the last snapshot (all of it, or the `fields` of it that
+        changed). Nothing here talks to bluetoothctl or the daemon.
+        """
+        view = self.view
+        with self.paint_lock, FrameBuffer():
+            labels = [("header", self.view_msg), \
+                      ("status", self.status_msg), \
+                      ("message", self.debug_msg)]
+            for field,label in labels:
+                label.t = getattr(view, field)
+
+            keys = [data["mac_addr"] for data in view.rows]
+            if fields is None:
+                # the dialog repaints the list with everything else
+                self.frame.set_lines(list(view.lines), keys=keys, redraw=False)
+                self.dialog.redraw()
+                self.latency.painted()
+                return
+
+            if "lines" in fields:
+                self.frame.set_lines(list(view.lines), keys=keys)
+
+            for field,label in labels:
+                if field in fields:
+                    label.redraw()
+        self.latency.painted()
 
     def get_devices(self, cached = False):
         update_scanned = self.scan_state == BluetoothApplet.ScanState.SCANNING
-        update_paired = self.action_state != BluetoothApplet.ActionState.IDLE
+        update_paired = self.actions.busy()
         if cached:
             if update_scanned:
                 self.bluetooth.flush_log()
@@ -95,41 +265,111 @@ class BluetoothApplet:
             self.bluetooth.update_devices(update_scanned=update_scanned, \
                                         update_paired=update_paired)
 
-        return self.bluetooth.get_devices(sort=True)
+        return self.bluetooth.get_devices(sort=True, order="name")
 
-    def update_pane(self):
+    def fetch(self):
+        """Ask bluetoothctl (or the daemon) for everything the screen shows."""
+        self.controllers = self.bluetooth.get_controllers()
+        self.controller = self.bluetooth.get_controller()
+        self.scan_stats = self.bluetooth.get_scan_stats()
+        self.session_stats = self.bluetooth.get_session_stats()
         self.devices = self.get_devices()
+        self.arrange()
 
+    def arrange(self):
+        # the device table is fetched by name, the views order it locally
+        devices = self.devices
+        if self.view_state == BluetoothApplet.ViewState.VIEW_NEARBY:
+            ordered = sort_by_proximity(devices)
+        else:
+            ordered = devices
+        self.arranged = (ordered, dict((data["mac_addr"], idx) \
+                                       for idx,data in enumerate(ordered)))
+
+    def update_pane(self):
+        self.fetch()
+        self.render_pane()
+
+    def visible_devices(self, ordered, positions):
+        if self.filter_text == "":
+            return ordered
+
+        # cost follows the number of matches, not the size of the table
+        matches = self.bluetooth.search(self.filter_text)
+        indices = sorted(positions[mac] for mac in matches \
+                         if mac in positions)
+        return [ordered[idx] for idx in indices]
+
+    # what format_row prints of a device, the row cache reformats on their change
+    ROW_FIELDS = ("mac_addr", "name", "connected", "paired", "online", "trusted", \
+                  "device_class", "appearance", "icon", "profiles")
+    NEARBY_FIELDS = ROW_FIELDS + ("distance", "rssi_trend")
+
+    def row_fields(self, view):
+        if view == BluetoothApplet.ViewState.VIEW_NEARBY:
+            return BluetoothApplet.NEARBY_FIELDS
+        return BluetoothApplet.ROW_FIELDS
+
+    def format_row(self, view, idx, data, action):
+        if data["connected"]:
+            flag = "[conn]"
+        elif data["paired"]:
+            flag = "[pair]"
+        elif not data["online"]:
+            flag = " [-]  "
+        else:
+            flag = " [*]  "
+
+        if data["trusted"]:
+            flag += "[tr]"
+        else:
+            flag += "    "
+
+        # what the enricher made of it: kind of device and profiles
+        label = data['name']
+        kind = data['device_class'] or data['appearance'] or data['icon']
+        details = ([kind] if not kind is None else []) + list(data['profiles'])
+        if len(details) > 0:
+            label = "%s {%s}" % (label, ", ".join(details))
+
+        text = "%d]%s %s %s\n" % (idx, \
+                                  flag, \
+                                  data['mac_addr'], \
+                                  label)
+
+        if view == BluetoothApplet.ViewState.VIEW_NEARBY and \
+           not data["distance"] is None:
+            text = "%d]%s %s ~%4.1fm %+4.1fdB/s %s\n" % (idx, \
+                                                       flag, \
+                                                       data['mac_addr'], \
+                                                       data['distance'], \
+                                                       data['rssi_trend'], \
+                                                       label)
+
+        if not action is None:
+            text = "%s <%s %s>\n" % (text.rstrip("\n"), action[0], action[1])
+        return text
+
+    def render_pane(self):
+        view = self.view_state
+        ordered, positions = self.arranged
+        rows = []
         entries = []
-        for idx,data in enumerate(self.devices):
-            if self.view_state == BluetoothApplet.ViewState.VIEW_PAIRED and \
+        for data in self.visible_devices(ordered, positions):
+            if view == BluetoothApplet.ViewState.VIEW_PAIRED and \
                not data["paired"]:
                 continue
 
-            if data["connected"]:
-                flag = "[conn]"
-            elif data["paired"]:
-                flag = "[pair]"
-            elif not data["online"]:
-                flag = " [-]  "
-            else:
-                flag = " [*]  "
+            action = self.actions.get(data['mac_addr'])
+            if not action is None:
+                action = (action.kind, action.state)
 
-            if data["trusted"]:
-                flag += "[tr]"
-            else:
-                flag += "    "
+            idx = positions[data["mac_addr"]]
+            entries.append(self.row_cache.get(view, idx, data, action))
+            rows.append(data)
 
-            text = "%d]%s %s %s\n" % (idx, \
-                                      flag, \
-                                      data['mac_addr'], \
-                                      data['name'])
-
-            entries.append(text)
-
-        self.frame.set_lines(entries)
-        self.dialog.redraw()
-        #self.frame.redraw()
+        self.row_cache.retain(positions)
+        self.publish(lines=tuple(entries), rows=tuple(rows))
 
     def initialize(self):
         self.screen.init_tty()
@@ -142,67 +382,134 @@ class BluetoothApplet:
         self.bluetooth.update_devices()
         self.bluetooth.update_devices()
         self.update_pane()
+        self.update_status()
 
-    def setup_ui(self):
-        width, height = Screen.screen_size()
-
-        msg_height = 1
-        ypadding = 2
-        xpadding = 4
-        frame_height = height - ypadding*6 - msg_height*4-1
-        frame_width = width - xpadding*2-1
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.request_profiler())
+        # back from ctrl-z
+        signal.signal(signal.SIGCONT, lambda signum, frame: self.idle.resume())
+        # have the terminal report focus changes
+        Screen.wr("\x1b[?1004h")
+
+    def request_profiler(self):
+        """
+        SIGUSR2. Stopping the profiler joins its thread, writes the stacks
+        and paints, none of which may run in a signal handler, so only flag
+        it for the next refresh (and end idling so there is one).
+        """
+        self.profile_requested.set()
+        self.idle.resume()
+
+    def toggle_profiler(self):
+        path = self.profiler.toggle()
+        if path is None:
+            self.update_msg("profiling, P or SIGUSR2 to stop")
+        else:
+            self.update_msg("%d samples written to %s" % (self.profiler.samples, path))
+        self.update_status()
 
-        self.dialog = Pane(x=2,y=2,w=width, \
-                             h=height)
+    def setup_ui(self):
+        self.dialog = Pane(x=2,y=2)
         self.dialog.border_w = 0
         self.dialog.border_h = 0
 
-        yoffset=0
-        self.dialog.add(x=xpadding,y=yoffset, \
-                        widget=WLabel(w=frame_width, text="==== bluetooth applet ===="))
-        yoffset += msg_height
-        yoffset += ypadding
-
-        self.view_msg = WLabel(w=frame_width, text="<current view>")
-        self.dialog.add(x=xpadding, y=yoffset, widget=self.view_msg)
-        yoffset += msg_height
-        yoffset += ypadding
-
-        self.frame = WListBox2(w=frame_width, h=frame_height, items=[])
-        self.dialog.add(x=2,y=yoffset, widget=self.frame)
-        yoffset += frame_height
-
-        self.status_msg = WLabel(w=frame_width, text="<status line>")
-        self.debug_msg = WLabel(w=frame_width, text="<feedback>")
-        help_text = "s: scan on/off | c: conn/pair | t: trust/untrust | x: forget | q: quit"
-        self.help_msg = WLabel(w=frame_width, text=help_text)
-
-        yoffset += ypadding
-        self.dialog.add(x=xpadding, y=yoffset, widget=self.status_msg)
-        yoffset += msg_height
-        self.dialog.add(x=xpadding, y=yoffset, widget=self.debug_msg)
-        yoffset += msg_height
-        self.dialog.add(x=xpadding, y=yoffset, widget=self.help_msg)
+        # sizes and positions are set by layout()
+        self.title_msg = WLabel(w=1, text="==== bluetooth applet ====")
+        self.view_msg = WLabel(w=1, text="")
+        self.frame = WListBox2(w=8, h=8, items=[])
+        self.status_msg = WLabel(w=1, text="")
+        self.debug_msg = WLabel(w=1, text="")
+        help_text = "s: scan on/off | p: scan profile | c: conn/pair | t: trust/untrust | x: forget | a: adapter | /: filter | P: profile | M: trace memory | q: quit"
+        self.help_msg = WLabel(w=1, text=help_text)
+        for widget in [self.title_msg, self.view_msg, self.frame, \
+                       self.status_msg, self.debug_msg, self.help_msg]:
+            self.dialog.add(x=0, y=0, widget=widget)
 
         self.screen_redraw()
         Screen.set_screen_redraw(self.screen_redraw)
+        Screen.set_screen_resize(lambda screen: self.screen_redraw())
 
         self.update_thread.start()
+        self.dispatcher.start()
+
+    def layout(self):
+        """Size the widgets to the terminal, returns whether it changed."""
+        size = terminal_size()
+        if size == self.size:
+            return False
+        self.size = size
+        width, height = size
+
+        msg_height = 1
+        ypadding = 2
+        xpadding = 4
+        frame_height = max(height - ypadding*6 - msg_height*4-1, 5)
+        frame_width = max(width - xpadding*2-1, 8)
+
+        with self.paint_lock:
+            self.dialog.w = width - self.dialog.x
+            self.dialog.h = height - self.dialog.y
+
+            def place(x, y, widget):
+                widget.set_xy(self.dialog.x + x, self.dialog.y + y)
+
+            yoffset=0
+            place(xpadding, yoffset, self.title_msg)
+            yoffset += msg_height
+            yoffset += ypadding
+
+            place(xpadding, yoffset, self.view_msg)
+            yoffset += msg_height
+            yoffset += ypadding
+
+            self.frame.resize(frame_width, frame_height)
+            place(2, yoffset, self.frame)
+            yoffset += frame_height
+
+            yoffset += ypadding
+            for label in [self.status_msg, self.debug_msg, self.help_msg]:
+                place(xpadding, yoffset, label)
+                yoffset += msg_height
+
+            for label in [self.title_msg, self.view_msg, self.status_msg, \
+                          self.debug_msg, self.help_msg]:
+                label.w = frame_width
+        return True
 
     def get_selected_device(self):
+        rows = self.view.rows
         line_index = self.frame.choice
-        return self.devices[line_index]
+        if line_index >= len(rows):
+            return None
+        return rows[line_index]
+
+    def watch_activity(self):
+        # signal strength alone is no reason to stay awake
+        state = device_state(self.devices)
+        if state != self.device_state or self.actions.busy() or \
+           (not self.reconnect is None and len(self.reconnect.get_status()) > 0):
+            self.device_state = state
+            self.idle.activity()
+
+    def enter_idle(self):
+        self.bluetooth.set_idle(True, wake=self.idle.activity)
+        if self.idle_pause_scan:
+            self.pause_scan()
+        self.update_status()
+
+    def leave_idle(self):
+        # the refresh that follows resumes a scan paused for idling
+        self.bluetooth.set_idle(False)
 
     def unpause_scan(self):
         if self.scan_state == BluetoothApplet.ScanState.SCAN_PAUSED:
             self.scan_state = BluetoothApplet.ScanState.SCANNING
-            self.bluetooth.start_scan()
+            self.dispatcher.submit(self.bluetooth.start_scan)
 
 
     def pause_scan(self):
         if self.scan_state == BluetoothApplet.ScanState.SCANNING:
             self.scan_state = BluetoothApplet.ScanState.SCAN_PAUSED
-            self.bluetooth.stop_scan()
+            self.dispatcher.submit(self.bluetooth.stop_scan)
 
 
     def update_status(self):
@@ -210,258 +517,379 @@ class BluetoothApplet:
             msg = "[[all devices]]"
         elif self.view_state == BluetoothApplet.ViewState.VIEW_PAIRED:
             msg = "[[paired devices]]"
+        elif self.view_state == BluetoothApplet.ViewState.VIEW_NEARBY:
+            msg = "[[nearby devices]]"
+
+        if self.filtering or self.filter_text != "":
+            msg += "  /%s%s" % (self.filter_text, "_" if self.filtering else "")
 
-        self.view_msg.t = msg
-        self.view_msg.redraw()
+        header = msg
 
         flags = []
+        controllers = self.controllers
+        macs = [ctrl["mac_addr"] for ctrl in controllers]
+        if len(controllers) > 1 and self.controller_mac in macs:
+            controller = self.controller
+            index = macs.index(controller["mac_addr"])
+            flags.append("%s (%d/%d)" % (controller["name"] or controller["mac_addr"], \
+                                         index+1, len(controllers)))
+
         if self.controller_state == BluetoothApplet.ControllerState.ON:
             flags.append("powered on")
         else:
             flags.append("powered off")
 
-        if self.action_state != BluetoothApplet.ActionState.IDLE:
-            is_connected = self.bluetooth.is_connected(self.target)
-            is_paired = self.bluetooth.is_paired(self.target,update=False)
-            is_trusted = self.bluetooth.is_trusted(self.target,update=False)
+        if self.scan_state == BluetoothApplet.ScanState.SCANNING:
+            stats = self.scan_stats
+            flags.append("scanning %s %.1f ev/s" % (stats["profile"], stats["rate"]))
+            if stats.get("rssi_published", 0) > 0:
+                flags.append("rssi x%.1f folded" % \
+                             (stats["rssi_events"] / stats["rssi_published"]))
+        elif self.scan_state == BluetoothApplet.ScanState.SCAN_PAUSED:
+            flags.append("paused scan")
+        else:
+            pass
 
-            if self.action_state == BluetoothApplet.ActionState.CONNECTING and \
-            is_connected:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        for action in self.actions.get_actions():
+            flags.append(action.describe())
 
-            if self.action_state == BluetoothApplet.ActionState.DISCONNECTING and \
-            not is_connected:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        if not self.reconnect is None:
+            for mac,attempts,wait in self.reconnect.get_status():
+                if wait > 0:
+                    flags.append("reconnect %s in %ds" % (mac, wait))
 
-            if self.action_state == BluetoothApplet.ActionState.TRUSTING and \
-            is_trusted:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        for name,stats in sorted(self.session_stats.items()):
+            if not stats["healthy"]:
+                flags.append("%s session down" % name)
 
-            if self.action_state == BluetoothApplet.ActionState.UNTRUSTING and \
-            not is_trusted:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        for name,grown in self.memory.warnings():
+            flags.append("memory: %s +%.1f MB" % (name, grown / (1024*1024)))
 
+        if self.idle.idle:
+            flags.append("idle")
 
-            if self.action_state == BluetoothApplet.ActionState.PAIRING and \
-            is_paired:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        if self.latency.slow():
+            flags.append("input lag %.0f ms" % (1000 * self.latency.percentile(0.95)))
 
-            if self.action_state == BluetoothApplet.ActionState.UNPAIRING and \
-            not is_paired:
-                    self.action_state = BluetoothApplet.ActionState.IDLE
-                    self.unpause_scan()
+        if self.profiler.running:
+            flags.append("profiling %d samples, %.1f%% overhead" % \
+                         (self.profiler.samples, 100 * self.profiler.overhead()))
 
+        self.publish(header=header, status=" | ".join(flags))
 
 
-        if self.scan_state == BluetoothApplet.ScanState.SCANNING:
-            flags.append("scanning")
-        elif self.scan_state == BluetoothApplet.ScanState.SCAN_PAUSED:
-            flags.append("paused scan")
-        else:
-            pass
+    def action_pending(self, target_mac):
+        action = self.actions.get(target_mac)
+        if not action is None and action.pending:
+            self.update_msg("failed. There is an action already in progress for %s." \
+                            % target_mac)
+            return True
+        return False
 
+    def forget_reconnect(self, target_mac):
+        # the user dropped it on purpose, do not reconnect behind their back
+        if not self.reconnect is None:
+            self.reconnect.forget(target_mac)
 
-        if self.action_state == BluetoothApplet.ActionState.CONNECTING:
-            flags.append("connecting to %s" % self.target)
-        elif self.action_state == BluetoothApplet.ActionState.CONNECTING:
-            flags.append("disconnecting from %s" % self.target)
-        elif self.action_state == BluetoothApplet.ActionState.PAIRING:
-            flags.append("pairing with %s" % self.target)
-        elif self.action_state == BluetoothApplet.ActionState.UNPAIRING:
-            flags.append("unpairing with %s" % self.target)
-        elif self.action_state == BluetoothApplet.ActionState.TRUSTING:
-            flags.append("trusting %s" % self.target)
-        elif self.action_state == BluetoothApplet.ActionState.UNTRUSTING:
-            flags.append("untrusting %s" % self.target)
+    def submit_action(self, kind, target_mac):
+        if kind in Action.PAUSES_SCAN:
+            self.pause_scan()
 
+        action = self.actions.submit(kind, target_mac)
+        if not action is None:
+            self.update_msg(action.describe())
+        # the row shows the queued action right away
+        self.render_pane()
+        self.update_status()
+        return action
 
+    def update_msg(self,msg):
+        self.publish(message=msg)
+        write_log(msg)
+
+    def handle_filter_key(self, key):
+        if key == KEY_ENTER:
+            self.filtering = False
+        elif key == KEY_ESC:
+            self.filtering = False
+            self.filter_text = ""
+        elif key == KEY_BACKSPACE:
+            self.filter_text = self.filter_text[:-1]
+        elif key in [KEY_UP, KEY_DOWN]:
+            with self.paint_lock, FrameBuffer():
+                self.frame.handle_key(key)
+            self.latency.painted()
+            return
+        else:
+            try:
+                text = key.decode("utf-8")
+            except:
+                return
+            if not text.isprintable():
+                return
+            self.filter_text += text
 
-        msg = " | ".join(flags)
-        self.status_msg.t = msg
-        self.status_msg.redraw()
+        self.render_pane()
+        self.update_status()
 
+    def switch_scan_profile(self, name):
+        stats = self.bluetooth.get_scan_stats()
+        self.bluetooth.set_scan_profile(name)
+        # average events/sec each profile let through so far
+        rates = ["%s %.1f" % (profile, stats["profiles"][profile]["rate"]) \
+                 for profile in PROFILE_ORDER if profile in stats["profiles"]]
+        self.update_msg("scan profile %s (ev/s: %s)" % (name, ", ".join(rates)))
+        self.scan_stats = self.bluetooth.get_scan_stats()
+        self.update_status()
 
-    def update_msg(self,msg):
-        self.debug_msg.t = msg
-        self.debug_msg.redraw()
-        write_log(self.debug_msg.t)
+    def switch_controller(self, target_mac):
+        self.bluetooth.select_controller(target_mac)
+        self.update_msg("controller %s" % target_mac)
+        self.update_pane()
+        self.update_status()
+
+    def switch_view(self, step):
+        self.view_index += step
+        # reorder what is on screen now, fresh data follows
+        self.arrange()
+        self.render_pane()
+        self.update_msg("view %s #devs=%d" % (self.view_state, len(self.devices)))
+        self.update_status()
+        self.dispatcher.submit(self.update_pane)
 
     def run(self):
         while 1:
             key = self.dialog.get_input()
-            write_log(key)
-
-            keystr = None
+            self.idle.activity()
+            self.latency.start()
             try:
-                keystr = key.decode("ascii")
-            except:
-                keystr = None
- 
-            if keystr != None:
-                write_log(keystr)
-                if keystr == "s":
-                    if self.scan_state == BluetoothApplet.ScanState.NOT_SCANNING:
-                        self.bluetooth.start_scan()
-                        self.scan_state = BluetoothApplet.ScanState.SCANNING
-                        self.update_msg("scanning")
-                    else:
-                        self.pause_scan()
-                        self.scan_state = BluetoothApplet.ScanState.NOT_SCANNING
-                        self.update_msg("stopped")
-
-                    self.update_status()
-
-                elif keystr == "x":
-                    dev = self.get_selected_device()
-                    target_mac = dev["mac_addr"]
-
-                    is_paired = self.bluetooth.is_paired(target_mac)
-                    if is_paired:
-                        self.update_msg("unpairing with %s" % (target_mac))
-                        self.target = target_mac
-                        self.action_state = BluetoothApplet.ActionState.UNPAIRING
-                        self.pause_scan()
-                        self.bluetooth.unpair(self.target)
-                        self.update_status()
-
-
-                elif keystr == "d":
-                    dev = self.get_selected_device()
-                    target_mac = dev["mac_addr"]
-                    if self.action_state != BluetoothApplet.ActionState.IDLE:
-                        self.update_msg("failed. There is an action already in progress.")
-                        continue
-
-                    is_connected = self.bluetooth.is_connected(target_mac)
-                    if is_connected:
-                        self.update_msg("disconnecting from %s" % (target_mac))
-                        self.target = target_mac
-                        self.action_state = BluetoothApplet.ActionState.DISCONNECTING
-                        self.pause_scan()
-                        self.bluetooth.disconnect(self.target)
-                        self.update_status()
-
-                    else:
-                        self.update_msg("error: %s not connected" % dev["mac_addr"])
-
-
-                elif keystr == "t":
-                    dev = self.get_selected_device()
-                    target_mac = dev["mac_addr"]
-                    if self.action_state != BluetoothApplet.ActionState.IDLE:
-                        self.update_msg("failed. There is an action already in progress.")
-                        continue
-
-                    is_trusted = self.bluetooth.is_trusted(target_mac)
-                    is_paired = self.bluetooth.is_paired(target_mac)
-                    if not is_paired:
-                        self.update_msg("failed. Cannot trust an unpaired device.")
-                        continue
-
-                    if is_trusted:
-                        self.update_msg("untrusting %s" % (target_mac))
-                        self.target = target_mac
-                        self.action_state = BluetoothApplet.ActionState.UNTRUSTING
-                        self.pause_scan()
-                        self.bluetooth.untrust(self.target)
-                        self.update_status()
-
-                    else:
-                        self.update_msg("trusting %s" % (target_mac))
-                        self.target = target_mac
-                        self.action_state = BluetoothApplet.ActionState.TRUSTING
-                        self.pause_scan()
-                        self.bluetooth.trust(self.target)
-                        self.update_status()
-
-
-
-
-
-
-                elif keystr == "c":
-                    dev = self.get_selected_device()
-                    target_mac = dev["mac_addr"]
-
-                    if self.action_state != BluetoothApplet.ActionState.IDLE:
-                        self.update_msg("failed. There is an action already in progress.")
-                        continue
-
-                    is_connected = self.bluetooth.is_connected(target_mac)
-                    is_paired = self.bluetooth.is_paired(target_mac)
-                    if is_paired:
-                        if is_connected:
-                            self.update_msg("already connected to %s" % target_mac)
-                            continue
-
-                        self.update_msg("connecting to %s" % (target_mac))
-                        self.target = target_mac
-                        self.action_state = BluetoothApplet.ActionState.CONNECTING
-                        self.pause_scan()
-                        result = self.bluetooth.connect(self.target)
-                        self.update_status()
-
-                    else:
-                        self.update_msg("pairing with %s" % (target_mac))
-                        self.action_state = BluetoothApplet.ActionState.PAIRING
-                        self.target = target_mac
-                        self.pause_scan()
-                        result = self.bluetooth.pair(self.target)
-                        self.update_status()
-
-
-
-                elif keystr == "t":
-                    self.update_msg("turn off/on")
-                    self.bluetooth.power_off()
-
-                elif keystr == "q":
-                    if self.scan_state == BluetoothApplet.ScanState.SCANNING:
-                        self.bluetooth.stop_scan();
-                    self.teardown()
+                if self.handle_key(key):
                     return
-            else:
-                if key == KEY_LEFT:
-                    self.view_index -= 1
-                    self.update_msg("view %s #devs=%d" % (self.view_state, \
-                                                       len(self.get_devices(cached=True))))
-                    self.update_status()
-                    self.update_pane()
-
-                elif key == KEY_RIGHT:
-                    self.view_index += 1
-                    self.update_msg("view %s #devs=%d" % (self.view_state, \
-                                                       len(self.get_devices(cached=True))))
-                    self.update_status()
-                    self.update_pane()
+            finally:
+                # the key painted nothing
+                self.latency.cancel()
+
+    def handle_key(self, key):
+        """
+        Handle one key, returns True to quit. Decisions are made on the
+        device rows on screen; bluetoothctl work goes to the dispatcher or
+        the action queue, so this never waits for it.
+        """
+        write_log(key)
+        if key == KEY_FOCUS_IN:
+            return False
+        if key == KEY_FOCUS_OUT:
+            self.idle.blur()
+            return False
+
+        if self.filtering:
+            self.handle_filter_key(key)
+            return False
+
+        keystr = None
+        try:
+            keystr = key.decode("ascii")
+        except:
+            keystr = None
+
+        if keystr != None:
+            write_log(keystr)
+            if keystr == "s":
+                if self.scan_state == BluetoothApplet.ScanState.NOT_SCANNING:
+                    self.scan_state = BluetoothApplet.ScanState.SCANNING
+                    self.dispatcher.submit(self.bluetooth.start_scan)
+                    self.update_msg("scanning")
+                else:
+                    self.pause_scan()
+                    self.scan_state = BluetoothApplet.ScanState.NOT_SCANNING
+                    self.update_msg("stopped")
+
+                self.update_status()
+
+            elif keystr == "x":
+                dev = self.get_selected_device()
+                if dev is None:
+                    return False
+                target_mac = dev["mac_addr"]
+                if self.action_pending(target_mac):
+                    return False
+
+                if dev["paired"]:
+                    self.forget_reconnect(target_mac)
+                    self.submit_action(Action.Kind.UNPAIR, target_mac)
+
+
+            elif keystr == "d":
+                dev = self.get_selected_device()
+                if dev is None:
+                    return False
+                target_mac = dev["mac_addr"]
+                if self.action_pending(target_mac):
+                    return False
+
+                if dev["connected"]:
+                    self.forget_reconnect(target_mac)
+                    self.submit_action(Action.Kind.DISCONNECT, target_mac)
+
+                else:
+                    self.update_msg("error: %s not connected" % dev["mac_addr"])
+
+
+            elif keystr == "t":
+                dev = self.get_selected_device()
+                if dev is None:
+                    return False
+                target_mac = dev["mac_addr"]
+                if self.action_pending(target_mac):
+                    return False
+
+                if not dev["paired"]:
+                    self.update_msg("failed. Cannot trust an unpaired device.")
+                    return False
+
+                if dev["trusted"]:
+                    self.submit_action(Action.Kind.UNTRUST, target_mac)
+
+                else:
+                    self.submit_action(Action.Kind.TRUST, target_mac)
+
+
+            elif keystr == "c":
+                dev = self.get_selected_device()
+                if dev is None:
+                    return False
+                target_mac = dev["mac_addr"]
+                if self.action_pending(target_mac):
+                    return False
+
+                if dev["paired"]:
+                    if dev["connected"]:
+                        self.update_msg("already connected to %s" % target_mac)
+                        return False
+
+                    self.submit_action(Action.Kind.CONNECT, target_mac)
 
                 else:
+                    self.submit_action(Action.Kind.PAIR, target_mac)
+
+
+            elif keystr == "p":
+                current = self.scan_stats["profile"]
+                index = PROFILE_ORDER.index(current) if current in PROFILE_ORDER else -1
+                name = PROFILE_ORDER[(index + 1) % len(PROFILE_ORDER)]
+                self.update_msg("switching to scan profile %s" % name)
+                self.dispatcher.submit(self.switch_scan_profile, name)
+
+            elif keystr == "P":
+                self.toggle_profiler()
+
+            elif keystr == "M":
+                top = self.memory.trace()
+                if top is None:
+                    self.update_msg("tracing allocations, M again for the top allocators")
+                elif len(top) > 0:
+                    self.update_msg("top allocator %s, all in %s" % (top[0], TRACE_OUTPUT))
+
+            elif keystr == "/":
+                self.filtering = True
+                self.update_status()
+
+            elif keystr == "a":
+                macs = [ctrl["mac_addr"] for ctrl in self.controllers]
+                if len(macs) < 2 or not self.controller_mac in macs:
+                    self.update_msg("there is only one controller")
+                    return False
+
+                target_mac = macs[(macs.index(self.controller_mac) + 1) % len(macs)]
+                self.update_msg("switching to controller %s" % target_mac)
+                self.dispatcher.submit(self.switch_controller, target_mac)
+
+            elif keystr == "t":
+                self.update_msg("turn off/on")
+                self.dispatcher.submit(self.bluetooth.power_off)
+
+            elif keystr == "q":
+                for mac,state in self.scan_states.items():
+                    if state == BluetoothApplet.ScanState.SCANNING:
+                        self.bluetooth.select_controller(mac)
+                        self.bluetooth.stop_scan();
+                self.teardown()
+                return True
+        else:
+            if key == KEY_LEFT:
+                self.switch_view(-1)
+
+            elif key == KEY_ESC and self.filter_text != "":
+                self.handle_filter_key(key)
+
+            elif key == KEY_RIGHT:
+                self.switch_view(1)
+
+            else:
+                with self.paint_lock, FrameBuffer():
                     res = self.dialog.handle_input(key)
-                    if res is not None and res is not True:
-                        return
+                self.latency.painted()
+                if res is not None and res is not True:
+                    return True
 
-        self.teardown()
+        return False
 
     def teardown(self):
+        Screen.wr("\x1b[?1004l")
         self.update_thread.cancel()
+        self.dispatcher.stop()
+        self.profiler.stop()
         self.screen.cls()
         self.screen.cursor(True)
         self.screen.disable_mouse()
         self.screen.deinit_tty()
 
-def run_ui():
-    applet = BluetoothApplet()
+def run_ui(socket_path=DEFAULT_SOCKET, standalone=False, command="bluetoothctl", \
+           max_actions=3, reconnect=True, scan_profile=None, \
+           profile_output=DEFAULT_OUTPUT, memory_threshold=16*1024*1024, \
+           idle_after=60.0, idle_pause_scan=False, sighting_log=DEFAULT_LOG):
+    if not standalone and BluetoothClient.available(socket_path):
+        # attach to the daemon's warm device table instead of spawning bluetoothctl
+        bluetooth = BluetoothClient(socket_path)
+        if not scan_profile is None:
+            bluetooth.set_scan_profile(scan_profile)
+    else:
+        bluetooth = ControllerPool(rfkill_unblock=False, command=command, \
+                                   scan_profile=scan_profile or "all", \
+                                   sighting_log=sighting_log)
+
+    applet = BluetoothApplet(bluetooth=bluetooth, max_actions=max_actions, \
+                             reconnect=reconnect, profile_output=profile_output, \
+                             memory_threshold=memory_threshold, idle_after=idle_after, \
+                             idle_pause_scan=idle_pause_scan)
     try:
         applet.initialize()
         applet.run()
     finally:
         applet.teardown()
 
+    latency = applet.latency
+    if latency.count > 0:
+        write_log("input latency p50 %.1f ms, p95 %.1f ms, %d of %d keys over %.0f ms" % \
+                  (1000 * latency.percentile(0.5), 1000 * latency.percentile(0.95), \
+                   latency.over, latency.count, 1000 * latency.target))
+    if not applet.reconnect is None:
+        for mac,times in sorted(applet.reconnect.get_stats().items()):
+            write_log("reconnected %s %d times, mean %.1fs, max %.1fs" % \
+                      (mac, len(times), sum(times) / len(times), max(times)))
+    idle = applet.idle.get_stats()
+    write_log("idle %.0fs: %.2f CPU s/h idle, %.2f CPU s/h active, %d wakeups last minute" % \
+              (idle["idle_seconds"], idle["idle_cpu_per_hour"], \
+               idle["active_cpu_per_hour"], idle["wakeups_per_min"]))
+    for name,stats in sorted(applet.session_stats.items()):
+        write_log("%s session: %d commands, %d failed, mean %.1f ms, max %.1f ms" % \
+                  (name, stats["commands"], stats["failures"], \
+                   stats["mean_ms"], stats["max_ms"]))
+        if stats.get("respawns", 0) > 0:
+            write_log("%s session respawned %d times, recovered in %.0f ms (worst %.0f ms)" % \
+                      (name, stats["respawns"], stats["last_recover_ms"], \
+                       stats["max_recover_ms"]))
+
 
 def test_info(target_mac):
     print("starting...")
@@ -515,4 +943,37 @@ def test_connect(target_mac):
 #test_connect("FC:E8:06:8F:30:BB")
 #test_info("FC:E8:06:8F:30:BB")
 #test_scan()
-run_ui()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bluetooth applet for i3")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, \
+                        help="daemon socket to attach to, if it is running")
+    parser.add_argument("--standalone", action="store_true", \
+                        help="never attach to a daemon, run bluetoothctl directly")
+    parser.add_argument("--bluetoothctl", default="bluetoothctl", \
+                        help="bluetoothctl command line, e.g. the simulator")
+    parser.add_argument("--max-actions", type=int, default=3, \
+                        help="how many pair/connect/trust operations run at once")
+    parser.add_argument("--no-reconnect", action="store_true", \
+                        help="do not reconnect trusted devices that drop off")
+    parser.add_argument("--scan-profile", default=None, choices=PROFILE_ORDER, \
+                        help="discovery filter and duty cycle used while scanning")
+    parser.add_argument("--profile-output", default=DEFAULT_OUTPUT, \
+                        help="collapsed stacks written when profiling (P or SIGUSR2) stops")
+    parser.add_argument("--memory-threshold", type=float, default=16, \
+                        help="MB a structure may grow before the status line warns")
+    parser.add_argument("--idle-after", type=float, default=60, \
+                        help="seconds without input or device changes before idling, 0 never")
+    parser.add_argument("--idle-pause-scan", action="store_true", \
+                        help="pause scanning while idle")
+    parser.add_argument("--sighting-log", default=DEFAULT_LOG, \
+                        help="binary history every sighting is appended to")
+    parser.add_argument("--no-sighting-log", action="store_true", \
+                        help="keep no sighting history")
+    args = parser.parse_args()
+    run_ui(socket_path=args.socket, standalone=args.standalone, \
+           command=args.bluetoothctl, max_actions=args.max_actions, \
+           reconnect=not args.no_reconnect, scan_profile=args.scan_profile, \
+           profile_output=args.profile_output, \
+           memory_threshold=int(args.memory_threshold * 1024 * 1024), \
+           idle_after=args.idle_after, idle_pause_scan=args.idle_pause_scan, \
+           sighting_log=None if args.no_sighting_log else args.sighting_log)
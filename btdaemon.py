@@ -0,0 +1,38 @@
+import argparse
+
+from models.scan import PROFILE_ORDER
+
+from models.daemon import BluetoothDaemon, DEFAULT_SOCKET
+from models.sightings import DEFAULT_LOG
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless bluetooth applet daemon")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, \
+                        help="path of the UNIX socket to serve on")
+    parser.add_argument("--interval", type=float, default=2.0, \
+                        help="seconds between device table refreshes")
+    parser.add_argument("--no-scan", action="store_true", \
+                        help="only scan while a client asks for it")
+    parser.add_argument("--bluetoothctl", default="bluetoothctl", \
+                        help="bluetoothctl command line, e.g. the simulator")
+    parser.add_argument("--scan-profile", default="all", choices=PROFILE_ORDER, \
+                        help="discovery filter and duty cycle used while scanning")
+    parser.add_argument("--sighting-log", default=DEFAULT_LOG, \
+                        help="binary history every sighting is appended to")
+    parser.add_argument("--no-sighting-log", action="store_true", \
+                        help="keep no sighting history")
+    args = parser.parse_args()
+
+    daemon = BluetoothDaemon(path=args.socket, \
+                             interval=args.interval, \
+                             scan=not args.no_scan, \
+                             command=args.bluetoothctl, \
+                             scan_profile=args.scan_profile, \
+                             sighting_log=None if args.no_sighting_log else args.sighting_log)
+    daemon.start()
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os
+import time
+import argparse
+from datetime import datetime
+
+from models.sightings import DEFAULT_LOG, EVENT_NAMES, NO_VALUE, \
+                             SightingHistory, int_to_mac
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+
+def format_dbm(value):
+    return "-" if value is None or value == NO_VALUE else "%d dBm" % value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="query the applet's sighting history")
+    parser.add_argument("mac", nargs="?", default=None, \
+                        help="list this device's sightings instead of all devices")
+    parser.add_argument("--since", type=float, default=None, \
+                        help="only the last SINCE minutes")
+    parser.add_argument("--last", action="store_true", \
+                        help="only when the device was last seen")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--log", default=DEFAULT_LOG)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        print("no sightings logged yet, %s does not exist" % args.log)
+        return
+    try:
+        history = SightingHistory(args.log)
+    except ValueError as e:
+        print(e)
+        return
+    start = None if args.since is None else time.time() - 60 * args.since
+
+    if args.mac is None:
+        devices = history.devices(start)
+        for mac,count,first,last,rssi in devices[:args.limit]:
+            print("%s %7d sightings  %s - %s  strongest %s" % \
+                  (mac, count, format_time(first), format_time(last), format_dbm(rssi)))
+        print("%d devices, %d sightings logged" % (len(devices), len(history)))
+        return
+
+    if args.last:
+        records = history.last_seen(args.mac)
+        records = [] if records is None else [records]
+    else:
+        records = history.device(args.mac, start)[-args.limit:]
+    for record in records:
+        print("%s %s %-8s rssi %s  tx %s" % \
+              (format_time(record["time"]), int_to_mac(record["mac"]), \
+               EVENT_NAMES.get(int(record["event"]), "?"), \
+               format_dbm(int(record["rssi"])), format_dbm(int(record["tx_power"]))))
+    if len(records) == 0:
+        print("%s was never seen" % args.mac)
+
+
+if __name__ == "__main__":
+    main()
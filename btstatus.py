@@ -0,0 +1,35 @@
+import sys
+import argparse
+
+import models.bluetooth as bluelib
+from models.daemon import BluetoothClient, DEFAULT_SOCKET
+from views.statusbar import StatusBar
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bluetooth status for i3bar/i3blocks")
+    parser.add_argument("--mode", default=StatusBar.Mode.I3BAR, \
+                        choices=[StatusBar.Mode.I3BAR, StatusBar.Mode.I3BLOCKS])
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, \
+                        help="daemon socket to attach to, if it is running")
+    parser.add_argument("--standalone", action="store_true", \
+                        help="never attach to a daemon, run bluetoothctl directly")
+    parser.add_argument("--bluetoothctl", default="bluetoothctl", \
+                        help="bluetoothctl command line, e.g. the simulator")
+    args = parser.parse_args()
+
+    bar = StatusBar(mode=args.mode, out=sys.stdout)
+    # bluetoothctl errors are printed, keep them out of the bar protocol
+    sys.stdout = sys.stderr
+    try:
+        if not args.standalone and BluetoothClient.available(args.socket):
+            bar.run_attached(BluetoothClient(args.socket))
+        else:
+            bar.run_local(bluelib.Bluetoothctl(rfkill_unblock=False, \
+                                                  command=args.bluetoothctl))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
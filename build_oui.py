@@ -0,0 +1,35 @@
+import json
+import argparse
+import urllib.request
+
+from models.oui import DEFAULT_INDEX, OUI_SOURCE_URL, \
+                       parse_oui_text, parse_oui_json, write_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compile the IEEE OUI registry " \
+                                     "into the applet's memory mapped vendor index")
+    parser.add_argument("--source", default=None, \
+                        help="IEEE oui.txt, downloaded from %s if omitted" % OUI_SOURCE_URL)
+    parser.add_argument("--json", default=None, \
+                        help="use an OuiLookup data file instead of oui.txt")
+    parser.add_argument("--output", default=DEFAULT_INDEX)
+    args = parser.parse_args()
+
+    if not args.json is None:
+        with open(args.json, encoding="utf-8") as fh:
+            entries = list(parse_oui_json(json.load(fh)))
+    elif not args.source is None:
+        with open(args.source, encoding="utf-8", errors="replace") as fh:
+            entries = list(parse_oui_text(fh))
+    else:
+        with urllib.request.urlopen(OUI_SOURCE_URL) as resp:
+            text = resp.read().decode("utf-8", errors="replace")
+        entries = list(parse_oui_text(text.splitlines()))
+
+    count = write_index(entries, args.output)
+    print("wrote %d prefixes to %s" % (count, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import time
+import threading
+
+
+class Action:
+
+    class Kind:
+        PAIR = "pair"
+        UNPAIR = "unpair"
+        CONNECT = "connect"
+        DISCONNECT = "disconnect"
+        TRUST = "trust"
+        UNTRUST = "untrust"
+
+    class State:
+        QUEUED = "queued"
+        RUNNING = "running"
+        DONE = "done"
+        FAILED = "failed"
+
+    # model method issuing the command, check confirming it and its expected value
+    COMMANDS = {
+        Kind.PAIR: ("pair", "is_paired", True),
+        Kind.UNPAIR: ("unpair", "is_paired", False),
+        Kind.CONNECT: ("connect", "is_connected", True),
+        Kind.DISCONNECT: ("disconnect", "is_connected", False),
+        Kind.TRUST: ("trust", "is_trusted", True),
+        Kind.UNTRUST: ("untrust", "is_trusted", False)
+    }
+
+    # discovery makes pairing and connecting unreliable on most adapters
+    PAUSES_SCAN = [Kind.PAIR, Kind.CONNECT]
+
+    PROGRESS = {
+        Kind.PAIR: "pairing with",
+        Kind.UNPAIR: "unpairing with",
+        Kind.CONNECT: "connecting to",
+        Kind.DISCONNECT: "disconnecting from",
+        Kind.TRUST: "trusting",
+        Kind.UNTRUST: "untrusting"
+    }
+
+    def __init__(self, kind, mac_addr):
+        self.kind = kind
+        self.mac_addr = mac_addr
+        self.state = Action.State.QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @property
+    def pending(self):
+        return self.state in [Action.State.QUEUED, Action.State.RUNNING]
+
+    def describe(self):
+        text = "%s %s" % (Action.PROGRESS[self.kind], self.mac_addr)
+        if self.state == Action.State.QUEUED:
+            return text + " (queued)"
+        elif self.state == Action.State.DONE:
+            return "%s %s: done" % (self.kind, self.mac_addr)
+        elif self.state == Action.State.FAILED:
+            return "%s %s: failed" % (self.kind, self.mac_addr)
+        return text
+
+
+class ActionQueue:
+    """
+    Pending bluetooth operations, at most one per device. Operations on
+    different devices run concurrently, up to `limit` at a time; each one
+    issues its command and polls the device until bluetoothctl confirms the
+    new state or `timeout` expires. Finished actions are kept for `linger`
+    seconds so the UI can report them.
+    """
+
+    def __init__(self, bluetooth, limit=3, timeout=30.0, poll=1.0, linger=5.0):
+        self.bluetooth = bluetooth
+        self.limit = limit
+        self.timeout = timeout
+        self.poll = poll
+        self.linger = linger
+
+        self.lock = threading.Lock()
+        self.queued = []
+        self.running = {}
+        self.finished = []
+
+    def submit(self, kind, mac_addr):
+        """Queue an action, returns None if the device already has one pending."""
+        with self.lock:
+            if not self._pending(mac_addr) is None:
+                return None
+
+            action = Action(kind, mac_addr)
+            self.queued.append(action)
+            self._start_ready()
+            return action
+
+    def _pending(self, mac_addr):
+        if mac_addr in self.running:
+            return self.running[mac_addr]
+        for action in self.queued:
+            if action.mac_addr == mac_addr:
+                return action
+        return None
+
+    def _start_ready(self):
+        while len(self.running) < self.limit and len(self.queued) > 0:
+            action = self.queued.pop(0)
+            action.state = Action.State.RUNNING
+            action.started = time.time()
+            self.running[action.mac_addr] = action
+            threading.Thread(target=self._run, args=(action,), daemon=True).start()
+
+    def _run(self, action):
+        try:
+            success = self._execute(action)
+        except Exception as e:
+            print(e)
+            success = False
+
+        with self.lock:
+            del self.running[action.mac_addr]
+            action.state = Action.State.DONE if success else Action.State.FAILED
+            action.finished = time.time()
+            self.finished.append(action)
+            self._start_ready()
+
+    def _execute(self, action):
+        command, check, expected = Action.COMMANDS[action.kind]
+        getattr(self.bluetooth, command)(action.mac_addr, sync=False)
+
+        deadline = action.started + self.timeout
+        while time.time() < deadline:
+            try:
+                if getattr(self.bluetooth, check)(action.mac_addr) == expected:
+                    return True
+            except KeyError:
+                # the device left the table, i.e. it was removed
+                return not expected
+            time.sleep(self.poll)
+        return False
+
+    def get(self, mac_addr):
+        """The pending or recently finished action of a device, if any."""
+        with self.lock:
+            action = self._pending(mac_addr)
+            if action is None:
+                for done in reversed(self.finished):
+                    if done.mac_addr == mac_addr:
+                        return done
+            return action
+
+    def get_actions(self):
+        with self.lock:
+            expired = time.time() - self.linger
+            self.finished = [a for a in self.finished if a.finished >= expired]
+            return list(self.running.values()) + list(self.queued) + list(self.finished)
+
+    def busy(self):
+        with self.lock:
+            return len(self.running) + len(self.queued) > 0
+
+    def needs_scan_paused(self):
+        with self.lock:
+            return any(action.kind in Action.PAUSES_SCAN \
+                       for action in list(self.running.values()) + self.queued)
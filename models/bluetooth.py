@@ -1,4 +1,6 @@
+import os
 import time
+from types import MappingProxyType
 import pexpect
 import subprocess
 import sys
@@ -9,6 +11,21 @@ import logging
 
 from OuiLookup import OuiLookup
 
+from models.signal import SignalHistory, sort_by_proximity
+from models.oui import default_index, is_locally_administered
+from models.search import DeviceIndex
+from models.scan import PROFILES, ScanStats
+from models.ptyreader import PtyReader
+from models.memory import footprint
+from models.events import DeviceEvents, DeviceAdded, DeviceChanged, DeviceRemoved, \
+    ControllerChanged, Subscription
+from models.table import DeviceTable
+from models.enrich import Enricher
+from models.session import QueryPool, SessionStats
+from models.watchdog import Watchdog
+from models.sightings import DEFAULT_LOG, open_log, EVENT_NEW, EVENT_RSSI, \
+    EVENT_TX_POWER, EVENT_CHANGE, EVENT_DEL
+
 
 class BluetoothctlError(Exception):
     """This exception is raised, when bluetoothctl fails to start."""
@@ -47,43 +64,246 @@ logger.addHandler(logging.StreamHandler(sys.stdout))
 
 # Add the RecordsListHandler to store the log records objects
 
+# output reaches these already stripped of colors, see PtyReader
+PROMPT_REGEX = re.compile(r"\n\[[A-Z\-a-z0-9 ]+\]#")
+CONTROLLER_REGEX = re.compile(r"Controller ([0-9A-F:]{17}) ([^\n]*)\n")
+EVENT_REGEX = re.compile(r"\[(CHG|NEW|DEL)\]")
+# bookkeeping fields of a device record, changing them is not news
+QUIET_FIELDS = ["time", "update_state"]
+# dB the smoothed RSSI has to move before proximity is published again
+SMOOTHED_HYSTERESIS = 2.0
+# dB/s the trend has to move, a few dB of jitter tilts the fitted slope a bit
+TREND_HYSTERESIS = 0.5
+
+# [CHG] Device properties that change while scanning without changing `info`
+SIGNAL_PROPERTIES = ["RSSI:", "TxPower:", "ManufacturerData", "ServiceData", \
+                     "AdvertisingFlags:", "AdvertisingData"]
+
+
+def parse_flag(value):
+    if value == "yes":
+        return True
+    elif value == "no":
+        return False
+    return None
+
 
 class Bluetoothctl:
     """A wrapper for bluetoothctl utility."""
 
-    def __init__(self, rfkill_unblock=True,debug=False):
+    def __init__(self, rfkill_unblock=True,debug=False, \
+                 command="bluetoothctl",controller=None,scan_profile="all", \
+                 info_ttl=30.0,rssi_hysteresis=5,enrich_workers=2, \
+                 query_sessions=1,sighting_log=DEFAULT_LOG):
         if rfkill_unblock:
             out = subprocess.check_output("rfkill unblock bluetooth", shell = True)
 
-        self.child = pexpect.spawn("bluetoothctl", \
-                                   encoding="utf-8", \
-                                   echo=True)
+        self.command = command
+        self.child = self._spawn()
+        self.stats = SessionStats()
+        self.watchdog = Watchdog()
+        self.respawning = False
+        # (why, since when) the child was replaced, until the new one is back
+        # in the old one's state
+        self.replay_pending = None
+        # the adapter picked with select, replayed on a new child
+        self.selected = None
+        # called from the reader thread on device or controller changes, see set_idle
+        self.on_wake = None
+        # quiet sessions for queries, the one above carries the event stream
+        self.queries = None
+        # mac -> read-only record, a change replaces the record
         self.devices = {}
+        self.events = DeviceEvents()
+        # what readers see, published after every ingestion pass
+        self.table = DeviceTable({}, 0, self._sort_devices)
+        # macs added, changed or removed since the table was published
+        self.table_changes = set()
+        # RSSI readings are published when they move this many dB
+        self.rssi_hysteresis = rssi_hysteresis
+        # mac -> raw RSSI events since its reading was last published
+        self.folded = {}
+        self.rssi_events = 0
+        self.rssi_published = 0
+        # mac -> (parsed `info` reply, time fetched)
+        self.info_cache = {}
+        self.info_ttl = info_ttl
+        self.signal = SignalHistory()
+        self.index = DeviceIndex()
+        # every sighting, appended to the binary history, None to keep none
+        self.sightings = None
+        if not sighting_log is None:
+            try:
+                self.sightings = open_log(sighting_log)
+            except OSError as e:
+                print(e)
+        # vendor, class, appearance and profiles, resolved off the ingestion path
+        self.enricher = Enricher(self._resolve_vendor, \
+                                 fetch_info=None if query_sessions == 0 else self._fetch_info, \
+                                 workers=enrich_workers)
+        self.scan_profile = PROFILES[scan_profile]
+        self.scan_stats = ScanStats()
+        self.profile_applied = False
+        self.scan_wanted = False
+        self.scan_window_on = False
+        self.scan_window_end = 0
+        self.controllers = {}
+        self.controller = self._new_controller(controller)
+        if not controller is None:
+            self.controllers[controller] = self.controller
+
         self.logfile = self.get_discover_log()
-        self.child.logfile = self.logger
+        # every line of output goes to the discover log as soon as it is read
+        self.reader = PtyReader(self.child, on_line=self._on_line)
+        self.reader.start()
         self.text_buffer = []
+        self.log_index = 0
+
+        # a cold start (python, a busy bluetoothd) can take longer than a command
+        self.wait_for_prompt(None, self.watchdog.probe_timeout)
+        if query_sessions > 0:
+            self.queries = QueryPool(command, size=query_sessions, controller=controller)
+        if not controller is None:
+            self.select_controller(controller)
+
+    def _spawn(self):
+        return pexpect.spawn(self.command, \
+                             encoding="utf-8", \
+                             echo=True)
+
+    def _check_session(self):
+        """Respawn bluetoothctl when it exited or hangs, see Watchdog."""
+        if self.respawning:
+            return
+
+        reason = None
+        if self.reader.eof or not self.child.isalive():
+            self.watchdog.failing(self.reader.eof_at)
+            reason = "exited"
+        elif self.watchdog.should_probe(self.reader.last_read):
+            if self._probe():
+                self.watchdog.answered()
+            else:
+                reason = "hung"
+
+        if not self.queries is None:
+            self.queries.restart_failed()
+        if not reason is None:
+            self._respawn(reason)
+        elif not self.replay_pending is None:
+            self._replay()
+
+    def _probe(self):
+        # an old "[CHG] Controller ... Discovering: yes" must not count as the answer
+        self.reader.drain()
+        sent = time.monotonic()
+        try:
+            self.child.send("show\n")
+        except OSError:
+            return False
+        res = self.reader.expect([r"Discovering: (yes|no)", pexpect.TIMEOUT, pexpect.EOF], \
+                                 timeout=self.watchdog.probe_timeout)
+        if res != 0:
+            self.watchdog.failing(sent)
+        return res == 0
 
-        self.wait_for_prompt(None,0.1)
-
-    def get_discover_log(self):
-        discover_log = "/tmp/discover.log"
-
-        def _write(*args, **kwargs):
-            text = args[0]
-            # Ignore other params, pexpect only use one arg
-            for line in re.split(r'[\n\r]+', text):
-                if line.strip() == "":
-                    continue
+    def _respawn(self, reason):
+        """
+        Replace the child and bring the new one to where the old one was,
+        see _replay(). A replay that fails is retried on the next check.
+        """
+        self.respawning = True
+        try:
+            self.logger.info("bluetoothctl %s, restarting it" % reason)
+            self.child.close(force=True)
+            self.child = self._spawn()
+            self.reader = PtyReader(self.child, on_line=self._on_line)
+            self.reader.start()
+            self.text_buffer = []
+            if self.replay_pending is None:
+                self.replay_pending = (reason, self.watchdog.failed_at)
+            self.wait_for_prompt(None, self.watchdog.probe_timeout)
+        except BluetoothctlError as e:
+            # no prompt, the next check finds it hung or exited
+            print(e)
+        finally:
+            self.respawning = False
 
-                logger.info(line) # call the logger info method with the reworked content
+        self._replay()
 
-            return True
+    def _replay(self):
+        """
+        Adapter, power, discovery filter and scan of the old child. The
+        table is refreshed in one batch, paired devices get their status
+        read again. The session counts as recovered once every step went
+        through.
+        """
+        self.respawning = True
+        try:
+            if not self.selected is None and not self.select_controller(self.selected):
+                return False
+            if self.controller["powered"] and self.power_on() != 0:
+                return False
+            self.profile_applied = False
+            self.scan_window_on = False
+            if self.scan_wanted and \
+               (self.start_scan() != 0 or not self.profile_applied):
+                return False
+
+            self._update_available_devices()
+            self._update_paired_devices()
+            for dev in list(self.devices.values()):
+                if dev["paired"] or dev["connected"]:
+                    self._set_field(dev["mac_addr"], "update_state", True)
+        except (BluetoothctlError, pexpect.ExceptionPexpect) as e:
+            print(e)
+            return False
+        finally:
+            self.respawning = False
+
+        reason,since = self.replay_pending
+        seconds = self.watchdog.recovered(reason, since)
+        self.logger.info("bluetoothctl back after %.2fs" % seconds)
+        self.replay_pending = None
+        return True
+
+    def _on_line(self, line):
+        self.logger.info(line)
+        on_wake = self.on_wake
+        if not on_wake is None and not EVENT_REGEX.search(line) is None and \
+           not any(prop in line for prop in SIGNAL_PROPERTIES) and \
+           not "Discovering:" in line:
+            on_wake()
+
+    def set_idle(self, idle, wake=None):
+        """
+        While idle, `wake()` is called for every [NEW]/[DEL] and every [CHG]
+        that is not just signal strength or discovery (which pausing the scan
+        for idling changes itself), from the reader thread.
 
-        # our flush method
-        def _flushFile():
-            hdlr.stream.flush()
+        Nobody switches the windows of a duty cycled scan while idle, so the
+        window that is open is closed and the next one opens on waking.
+        """
+        self.on_wake = wake if idle else None
+        if self.scan_wanted and self.scan_profile.duty_cycled:
+            if idle and self.scan_window_on:
+                self._scan_off()
+            elif not idle:
+                self.scan_window_end = 0
 
-        logger = logging.getLogger('bt-discover')
+    def get_discover_log(self):
+        discover_log = "/tmp/discover.log"
+        logger_name = "bt-discover"
+        mac = self.controller["mac_addr"]
+        if not mac is None:
+            # one log per adapter session, kept apart from the default one
+            suffix = mac.replace(":","").lower()
+            discover_log = "/tmp/discover-%s.log" % suffix
+            logger_name = "bt-discover.%s" % suffix
+
+        self.discover_log = discover_log
+        logger = logging.getLogger(logger_name)
+        logger.propagate = mac is None
         hdlr = logging.FileHandler(discover_log, \
                                    mode="w", \
                                    encoding="utf-8")
@@ -92,26 +312,16 @@ class Bluetoothctl:
         logger.addHandler(hdlr)
         logger.setLevel(logging.INFO)
 
-        # give the logger the methods required by pexpect
-        logger.write = _write
-        logger.flush = _flushFile
-
         self.log_handler = RecordsListHandler()
         logger.addHandler(self.log_handler)
         self.logger = logger
 
     def parse_text(self,text):
-        if(isinstance(text,bytes)):
-            text = text.decode("utf-8")
-
-        ansi_escape =r'(\x1B[@-_][0-?]*[ -/]*[@-~])+'
-        newline = '\r\n'
-        ansi_regex = re.compile(ansi_escape)
-        san_text = ansi_regex.sub("", text)
-        return san_text.split(newline)
+        # decoded and stripped of colors by the reader, only split it
+        return text.split("\n")
 
     def get_output(self):
-        self.text_buffer += self.parse_text(self.child.before)
+        self.text_buffer += self.parse_text(self.reader.before)
         return self.text_buffer
 
     def clear_output(self):
@@ -119,50 +329,165 @@ class Bluetoothctl:
 
     def wait_for_prompt(self, command, pause = 0.1):
         """Run a command in bluetoothctl prompt, return output as a list of lines."""
+        start = time.perf_counter()
         if not command is None:
             self.child.send(command + "\n")
 
-        ansi_escape =r'(\x1b[@-_][0-?]*[ -/]*[@-~])*'
-        newline = r'\r\n?'
-        command_regex = newline + ansi_escape+"\[[A-Z\-a-z0-9 ]+\]" + ansi_escape + "#"
-        #command_regex = ansi_escape+"\[[A-Za-z0-9 ]+\]" + ansi_escape + "#"
-        command_patterns = [command_regex, \
-                            pexpect.EOF]
-        start_failed = self.child.expect(command_patterns, timeout=pause)
+        command_patterns = [PROMPT_REGEX, \
+                            pexpect.EOF, \
+                            pexpect.TIMEOUT]
+        start_failed = self.reader.expect(command_patterns, timeout=pause)
+        if not command is None:
+            self.stats.add(time.perf_counter() - start, ok=not start_failed)
+            self.watchdog.command_done(not start_failed)
 
         if start_failed:
-            raise BluetoothctlError("Bluetoothctl failed after running " + command)
+            raise BluetoothctlError("Bluetoothctl failed after running %s" % command)
 
-        return self.parse_text(self.child.before)
+        return self.parse_text(self.reader.before)
 
     def _lookup_device_name(self,mac,dev_name):
-        # TODO: (random), (public)
         if dev_name is None or \
            mac == dev_name or \
            dev_name == mac.replace(":","-"):
-            lookup = list(OuiLookup().query(mac)[0].values())[0]
-            if not lookup is None:
-                return "%s (oui)" % lookup, True
+            # no name of its own, the enricher fills in the vendor
             return None, True
 
         else:
             return dev_name, False
 
+    def _resolve_vendor(self,mac,address_type=None):
+        if is_locally_administered(mac, address_type):
+            # random/private address, there is no vendor to find
+            return None
+
+        index = default_index()
+        if not index is None:
+            return index.lookup(mac)
+        return list(OuiLookup().query(mac)[0].values())[0]
+
+    def _new_controller(self,mac):
+        return {"mac_addr": mac, \
+                "name": None, \
+                "powered": None, \
+                "discovering": False}
+
+    def _declare_controller(self,mac,default=False):
+        if self.controller["mac_addr"] is None and default:
+            # the session has not selected an adapter, bind to bluez's default
+            self.controller["mac_addr"] = mac
+            self.controllers[mac] = self.controller
+            self.events.emit(ControllerChanged(mac, dict(self.controller)))
+        elif not mac in self.controllers:
+            self.controllers[mac] = self._new_controller(mac)
+            self.events.emit(ControllerChanged(mac, dict(self.controllers[mac])))
+        return self.controllers[mac]
+
+    def _set_controller_field(self,ctrl,key,value):
+        if ctrl[key] != value:
+            ctrl[key] = value
+            self.events.emit(ControllerChanged(ctrl["mac_addr"], {key: value}))
+
+    def _update_controller_from_event(self,cmd,args):
+        mac_addr = args[0]
+        if cmd == "DEL":
+            if mac_addr != self.controller["mac_addr"]:
+                if not self.controllers.pop(mac_addr, None) is None:
+                    self.events.emit(ControllerChanged(mac_addr, {}, removed=True))
+            return
+
+        if cmd == "NEW":
+            name = " ".join(args[1:])
+            ctrl = self._declare_controller(mac_addr, \
+                                            default=name.endswith("[default]"))
+            self._set_controller_field(ctrl, "name", name.replace("[default]","").strip())
+
+        elif cmd == "CHG" and len(args) > 2:
+            ctrl = self._declare_controller(mac_addr)
+            subcmd,value = args[1],parse_flag(args[2])
+            if "Powered" in subcmd and not value is None:
+                self._set_controller_field(ctrl, "powered", value)
+            elif "Discovering" in subcmd and not value is None:
+                self._set_controller_field(ctrl, "discovering", value)
+
     def _declare_device(self,mac,name,inferred_name=False):
         if not mac in self.devices:
-            self.devices[mac] = dict({"online": False, \
+            self.devices[mac] = MappingProxyType({"online": False, \
                                  "paired": False, \
                                  "connected": False, \
                                  "trusted": False, \
                                  "update_state": False, \
                                  "name": name, \
                                  "mac_addr": mac, \
+                                 "controller": self.controller["mac_addr"], \
                                  "time": datetime.now(), \
                                  "tx_power": -1, \
-                                 "rssi": -1})
+                                 "rssi": -1, \
+                                 "rssi_smoothed": None, \
+                                 "rssi_trend": 0.0, \
+                                 "distance": None, \
+                                 "vendor": None, \
+                                 "device_class": None, \
+                                 "appearance": None, \
+                                 "icon": None, \
+                                 "profiles": ()})
+            self.index.update(mac, name)
+            self.enricher.submit(mac, vendor=True)
+            self.table_changes.add(mac)
+            self.events.emit(DeviceAdded(mac, self.devices[mac], \
+                                         self.controller["mac_addr"]))
         elif not name is None and \
              (not inferred_name or self.devices[mac]["name"] is None):
-            self.devices[mac]["name"] = name
+            self._set_name(mac, name)
+
+    def _set_fields(self,mac,fields,folded=1):
+        dev = self.devices[mac]
+        changed = dict((key, value) for key,value in fields.items() if dev[key] != value)
+        if len(changed) == 0:
+            return
+
+        # copy on write, published tables keep the old record
+        record = dict(dev)
+        record.update(changed)
+        news = dict((key, value) for key,value in changed.items() \
+                    if not key in QUIET_FIELDS)
+        if len(news) > 0:
+            self.events.emit(DeviceChanged(mac, news, self.controller["mac_addr"], \
+                                           folded))
+        self.devices[mac] = MappingProxyType(record)
+        self.table_changes.add(mac)
+
+    def _set_field(self,mac,key,value):
+        self._set_fields(mac, {key: value})
+
+    def _remove_device(self,mac):
+        self.folded.pop(mac, None)
+        self.index.remove(mac)
+        self.signal.remove(mac)
+        if not self.devices.pop(mac, None) is None:
+            self.table_changes.add(mac)
+            self.events.emit(DeviceRemoved(mac, self.controller["mac_addr"]))
+
+    def _publish(self):
+        if len(self.table_changes) > 0:
+            # only what changed is copied, see DeviceTable.updated
+            changed = dict((mac, self.devices[mac]) for mac in self.table_changes \
+                           if mac in self.devices)
+            removed = [mac for mac in self.table_changes if not mac in self.devices]
+            self.table = self.table.updated(changed, removed, self.table.version + 1)
+            self.table_changes = set()
+        self.events.flush()
+
+    def snapshot(self):
+        """
+        The device table as of the last ingestion pass, a read-only
+        DeviceTable that is never changed afterwards. O(1), no copies.
+        """
+        return self.table
+
+    def _set_name(self,mac,name):
+        self._set_field(mac, "name", name)
+        self.index.update(mac, name, self.devices[mac]["vendor"])
 
     def _update_from_discover_log(self):
         def find_cmd_index(args):
@@ -173,61 +498,144 @@ class Bluetoothctl:
                         return cmd,idx
             return None,-1
 
-        for entry in self.log_handler.entries:
-            msg = entry.getMessage()
-            lines = self.parse_text(msg)
-            for line in lines:
-                timestamp = datetime.strptime(entry.asctime.split(",")[0], \
-                                            "%Y-%m-%d %H:%M:%S")
-                args = line.split(" ")
-                cmd,index = find_cmd_index(args)
-                if len(args) < index + 2 or \
-                   args[index+1] != "Device":
-                    continue
-
-                if cmd == "CHG":
-                    if len(args) <= index+4:
-                        continue
-
-                    mac_addr,subcmd = args[index+2],args[index+3]
-                    final_name,inferred = self._lookup_device_name(mac_addr,None)
-                    self._declare_device(mac_addr,final_name,inferred_name=inferred)
-                    if "RSSI" in subcmd:
-                        try:
-                            self.devices[mac_addr]["rssi"] = int(args[index+4])
-                        except ValueError:
-                            pass
-
-                    elif "TxPower" in subcmd:
-                        try:
-                            self.devices[mac_addr]["tx_power"] = int(args[index+4])
-                        except ValueError:
-                            pass
-
-
-                    elif "Name:" in subcmd or "Alias:" in subcmd:
-                        self.devices[mac_addr]["name"] = " ".join(args[index+4:])
-
-                    self.devices[mac_addr]['online'] = True
-                    self.devices[mac_addr]["time"] = timestamp
+        entries = self.log_handler.entries
+        start,self.log_index = self.log_index,len(entries)
+        events = 0
+        # mac -> [last seen, latest RSSI or None], applied once per device
+        seen = {}
+        for entry in entries[start:self.log_index]:
+            # the reader already split and stripped the output, one line per record
+            line = entry.getMessage()
+            args = line.split(" ")
+            cmd,index = find_cmd_index(args)
+            if len(args) > index+2 and \
+               args[index+1] == "Controller":
+                self._update_controller_from_event(cmd,args[index+2:])
+                continue
 
-                elif cmd == "NEW" and len(args) >= index+3:
-                    mac_addr = args[index+2]
-                    if len(args) >= index+4:
-                        name = " ".join(args[index+3:])
-                    else:
-                        name = None
+            if len(args) < index + 2 or \
+               args[index+1] != "Device":
+                continue
 
-                    final_name,inferred = self._lookup_device_name(mac_addr,name)
-                    self._declare_device(mac_addr, final_name, \
-                                         inferred_name=inferred)
-                    self.devices[mac_addr]['online'] = True
-                    self.devices[mac_addr]["time"] = timestamp
+            if cmd in ["CHG", "NEW"]:
+                events += 1
 
-                elif cmd == "DEL":
-                    pass
+            if cmd == "CHG":
+                if len(args) <= index+4:
+                    continue
 
+                mac_addr,subcmd = args[index+2],args[index+3]
+                if not any(prop in subcmd for prop in SIGNAL_PROPERTIES):
+                    self.info_cache.pop(mac_addr, None)
+                if not mac_addr in self.devices:
+                    final_name,inferred = self._lookup_device_name(mac_addr,None)
+                    self._declare_device(mac_addr,final_name,inferred_name=inferred)
+                latest = seen.setdefault(mac_addr, [None, None])
+                latest[0] = entry.created
+                if not "RSSI" in subcmd and not "TxPower" in subcmd:
+                    self._log_sighting(entry.created, mac_addr, EVENT_CHANGE)
+
+                if "RSSI" in subcmd:
+                    try:
+                        rssi = int(args[index+4])
+                    except ValueError:
+                        continue
+                    self._log_sighting(entry.created, mac_addr, EVENT_RSSI, rssi)
+                    # every sample feeds the smoothing, the record gets the last one
+                    self.signal.add_rssi(mac_addr, rssi, entry.created)
+                    latest[1] = rssi
+                    self.folded[mac_addr] = self.folded.get(mac_addr, 0) + 1
+                    self.rssi_events += 1
+
+                elif "TxPower" in subcmd:
+                    try:
+                        self._set_field(mac_addr, "tx_power", int(args[index+4]))
+                        self.signal.set_tx_power(mac_addr, \
+                                                 self.devices[mac_addr]["tx_power"])
+                    except ValueError:
+                        pass
+                    self._log_sighting(entry.created, mac_addr, EVENT_TX_POWER)
+
+
+                elif "Name:" in subcmd or "Alias:" in subcmd:
+                    self._set_name(mac_addr, " ".join(args[index+4:]))
+
+                elif subcmd in ["Connected:", "Paired:", "Trusted:"]:
+                    value = parse_flag(args[index+4])
+                    if not value is None:
+                        self._set_field(mac_addr, subcmd[:-1].lower(), value)
+
+                elif subcmd in ["Class:", "Appearance:", "Icon:"]:
+                    self.enricher.submit(mac_addr, info={subcmd[:-1]: args[index+4]})
+
+                elif subcmd == "UUIDs:":
+                    self.enricher.submit(mac_addr, info={"UUIDs": [args[index+4]]})
+
+            elif cmd == "NEW" and len(args) >= index+3:
+                mac_addr = args[index+2]
+                if len(args) >= index+4:
+                    name = " ".join(args[index+3:])
+                else:
+                    name = None
 
+                final_name,inferred = self._lookup_device_name(mac_addr,name)
+                self._declare_device(mac_addr, final_name, \
+                                     inferred_name=inferred)
+                seen.setdefault(mac_addr, [None, None])[0] = entry.created
+                self._log_sighting(entry.created, mac_addr, EVENT_NEW)
+
+            elif cmd == "DEL" and len(args) >= index+3:
+                self._log_sighting(entry.created, args[index+2], EVENT_DEL)
+                self.info_cache.pop(args[index+2], None)
+                self._remove_device(args[index+2])
+                seen.pop(args[index+2], None)
+
+        for mac_addr,(created,rssi) in seen.items():
+            if mac_addr in self.devices:
+                self._apply_sighting(mac_addr, created, rssi)
+        self.scan_stats.add(events)
+        self._apply_enrichment()
+        if not self.sightings is None:
+            self.sightings.flush()
+
+    def _log_sighting(self,created,mac,event,rssi=None):
+        if self.sightings is None:
+            return
+        dev = self.devices.get(mac)
+        self.sightings.add(created, mac, event, rssi=rssi, \
+                           tx_power=None if dev is None else dev["tx_power"])
+
+    def _apply_enrichment(self):
+        for mac,fields in self.enricher.results():
+            if not mac in self.devices:
+                continue
+            if "profiles" in fields:
+                # property changes report one UUID at a time
+                fields["profiles"] = tuple(sorted(set(fields["profiles"]) | \
+                                                  set(self.devices[mac]["profiles"])))
+            self._set_fields(mac, fields)
+            vendor = fields.get("vendor")
+            if not vendor is None and self.devices[mac]["name"] is None:
+                self._set_name(mac, "%s (oui)" % vendor)
+            elif not vendor is None:
+                # named devices are found by their vendor too
+                self.index.update(mac, self.devices[mac]["name"], vendor)
+
+    def _apply_sighting(self,mac,created,rssi):
+        """
+        Fold the events of one device in a pass into one update: last seen
+        always, the RSSI only once it moved past the hysteresis, so a few
+        dB of jitter neither changes the record nor reorders the views.
+        """
+        fields = {"online": True, "time": datetime.fromtimestamp(created)}
+        published = self.devices[mac]["rssi"]
+        if not rssi is None and \
+           (published == -1 or abs(rssi - published) >= self.rssi_hysteresis):
+            fields["rssi"] = rssi
+            self.rssi_published += 1
+            self._set_fields(mac, fields, folded=self.folded.pop(mac, 1))
+        else:
+            self._set_fields(mac, fields)
 
     def _update_from_parsed_result(self,text):
         macs = []
@@ -246,11 +654,21 @@ class Bluetoothctl:
                 macs.append(mac_addr)
         return macs
 
+    def _query(self,command):
+        """Reply to a command, from a quiet session when there is one."""
+        if not self.queries is None and self.queries.healthy:
+            out = self.queries.query(command)
+            if out is None:
+                raise BluetoothctlError("No reply to " + command)
+            return out
+
+        self.clear_output()
+        self.wait_for_prompt(command, 0.1)
+        return self.get_output()
+
     def _update_available_devices(self):
         try:
-            self.clear_output()
-            self.wait_for_prompt("devices", 0.1)
-            out = self.get_output()
+            out = self._query("devices")
             self._update_from_parsed_result(out)
 
         except BluetoothctlError as e:
@@ -261,13 +679,11 @@ class Bluetoothctl:
     def _update_paired_devices(self):
         """Return a list of tuples of paired devices."""
         try:
-            self.clear_output()
-            self.wait_for_prompt("paired-devices", 0.1)
-            out = self.get_output()
+            out = self._query("paired-devices")
             macs = self._update_from_parsed_result(out)
             for mac in macs:
                 if self.devices[mac]["paired"] == False:
-                    self.devices[mac]["update_state"] = True
+                    self._set_field(mac, "update_state", True)
 
 
         except BluetoothctlError as e:
@@ -275,6 +691,19 @@ class Bluetoothctl:
             return None
 
 
+    def _update_signal(self,now=None):
+        self.signal.update(now)
+        for mac in self.devices:
+            rssi,trend,distance = self.signal.get(mac)
+            published = self.devices[mac]["rssi_smoothed"]
+            if (rssi is None) != (published is None) or \
+               abs(trend - self.devices[mac]["rssi_trend"]) >= TREND_HYSTERESIS or \
+               (not rssi is None and abs(rssi - published) >= SMOOTHED_HYSTERESIS):
+                # the row prints the trend to 0.1 dB/s
+                self._set_fields(mac, {"rssi_smoothed": rssi, \
+                                       "rssi_trend": round(trend, 1), \
+                                       "distance": distance})
+
     def _sort_devices(self,devices_by_key):
         mac_list = []
         value_list = []
@@ -292,7 +721,8 @@ class Bluetoothctl:
             value_list.append((prefix + data['name'] if not data['name'] is None else prefix + 'z' + mac))
 
         indices = np.argsort(value_list)
-        return list(map(lambda idx: dict(device_list[mac_list[idx]]), indices))
+        # records are read-only, hand them out as they are
+        return list(map(lambda idx: device_list[mac_list[idx]], indices))
 
 
 
@@ -302,7 +732,8 @@ class Bluetoothctl:
         expiration_time = curr_time  - timedelta(seconds=timeout)
         pruned = []
         for dev in devices:
-            if dev['time'] >= expiration_time:
+            if dev['time'] >= expiration_time or \
+               dev['paired'] or dev['connected']:
                 pruned.append(dev)
 
 
@@ -312,19 +743,160 @@ class Bluetoothctl:
 
     def update_devices(self,update_scanned=True,update_paired=True):
         """Filter paired devices out of available."""
+        self._check_session()
         if update_scanned:
+            self.cycle_scan()
             self._update_from_discover_log()
+            self._update_signal()
 
         if update_paired:
             self._update_paired_devices()
 
-        for dev in self.devices.values():
+        for dev in list(self.devices.values()):
             if dev["update_state"]:
                 self.update_device_status(dev["mac_addr"])
-                dev["update_state"] = False
+                self._set_field(dev["mac_addr"], "update_state", False)
+
+        self._publish()
+
+    def subscribe(self, callback=None, max_batches=64):
+        """
+        Changes to the device table and controllers as they are ingested, in
+        batches of DeviceAdded/DeviceChanged/DeviceRemoved/ControllerChanged
+        events (models/events.py). Returns the Subscription to iterate and
+        close; with a callback, batches are handed to it on its own thread.
+        """
+        subscription = Subscription(max_batches)
+        self.events.attach(subscription)
+        if not callback is None:
+            subscription.deliver(callback)
+        return subscription
+
+    def get_devices(self,sort=False,order="name"):
+        devices = self._prune_devices(self.snapshot().sorted(), 60*3)
+        if order == "proximity":
+            return sort_by_proximity(devices)
+        return devices
+
+    def search(self, query):
+        """Mac addresses of devices whose name, vendor or address match."""
+        return self.index.search(query)
+
+    def get_memory_stats(self):
+        """(count, approximate bytes) of the structures that grow with the session."""
+        try:
+            log_size = os.path.getsize(self.discover_log)
+        except OSError:
+            log_size = 0
+
+        signal = self.signal
+        signal_bytes = sum(arr.nbytes for arr in [signal.rssi, signal.times, signal.heads, \
+                                                  signal.tx_power, signal.smoothed, \
+                                                  signal.trend, signal.distance])
+        return {"log_records": footprint(self.log_handler.entries), \
+                "text_buffer": footprint(self.text_buffer), \
+                "devices": footprint(self.devices), \
+                "info_cache": footprint(self.info_cache), \
+                "search_index": footprint(self.index.grams), \
+                "signal": (len(signal.rows), signal_bytes), \
+                "reader": (len(self.reader.pieces), self.reader.pending + len(self.reader.buf)), \
+                "discover_log": (1, log_size)}
+
+    def get_controller(self):
+        return dict(self.controller)
+
+    def get_controllers(self):
+        return [dict(ctrl) for ctrl in self.controllers.values()]
+
+    def update_controllers(self):
+        """Refresh the list of controllers, return their mac addresses."""
+        self.child.send("list\n")
+        while True:
+            res = self.reader.expect([CONTROLLER_REGEX, pexpect.TIMEOUT, pexpect.EOF], \
+                                    timeout=0.3)
+            if res == 2:
+                print(BluetoothctlError("Bluetoothctl exited"))
+                break
+            elif res == 1:
+                break
+
+            mac_addr = self.reader.match.group(1)
+            name = self.reader.match.group(2).strip()
+            if re.match(r"^[A-Za-z]+: ", name):
+                # [CHG] Controller <mac> Powered: yes
+                continue
+
+            ctrl = self._declare_controller(mac_addr, \
+                                            default=name.endswith("[default]"))
+            self._set_controller_field(ctrl, "name", name.replace("[default]","").strip())
+
+        self._publish()
+        return list(self.controllers.keys())
+
+    def select_controller(self, mac_address):
+        """Make this session act on the given controller."""
+        try:
+            self.wait_for_prompt("select " + mac_address, 0.5)
+        except BluetoothctlError as e:
+            print(e)
+            return False
 
-    def get_devices(self,sort=False):
-        return self._prune_devices(self._sort_devices(self.devices), 60*3)
+        self.selected = mac_address
+        if not self.queries is None:
+            self.queries.select(mac_address)
+        if mac_address != self.controller["mac_addr"]:
+            if self.controller["mac_addr"] is None:
+                self.controller["mac_addr"] = mac_address
+            else:
+                self.controller = self._new_controller(mac_address)
+                for mac in list(self.devices):
+                    self._remove_device(mac)
+            self.controllers[mac_address] = self.controller
+            self._publish()
+
+        # earlier [NEW] Device events belong to whichever adapter was default
+        self.log_index = len(self.log_handler.entries)
+        return True
+
+    def update_controller(self):
+        """Refresh the power and scan state of the selected controller."""
+        try:
+            self.child.send("show\n")
+            self.reader.expect([r"Discovering: (yes|no)"], timeout=1)
+            out = self.parse_text(self.reader.before + self.reader.after)
+        except (pexpect.TIMEOUT, pexpect.EOF) as e:
+            print(BluetoothctlError("Bluetoothctl failed after running show"))
+            return None
+
+        for line in out:
+            args = line.strip().split(" ")
+            if args[0] == "Controller" and len(args) > 1:
+                self._declare_controller(args[1], default=True)
+            elif args[0] == "Name:":
+                self._set_controller_field(self.controller, "name", " ".join(args[1:]))
+            elif args[0] == "Powered:":
+                self._set_controller_field(self.controller, "powered", args[-1] == "yes")
+            elif args[0] == "Discovering:":
+                self._set_controller_field(self.controller, "discovering", args[-1] == "yes")
+        self._publish()
+        return self.get_controller()
+
+    def wait_for_event(self, timeout=None):
+        """
+        Block until bluetoothctl reports a device or controller change, the
+        output is captured by the discover log. Every event read so far is
+        consumed with the first, so a burst wakes the caller once. Returns
+        False on timeout. If bluetoothctl exited it is respawned, which
+        counts as a change.
+        """
+        res = self.reader.expect([EVENT_REGEX, pexpect.TIMEOUT, pexpect.EOF], \
+                                timeout=timeout)
+        if res == 0:
+            # the rest of a burst is already parsed, one wakeup covers it
+            self.reader.drain(unfinished=False)
+        elif res == 2:
+            self._check_session()
+        return res != 1
 
 
     def _process_device_info(self,text,mac_addr):
@@ -340,6 +912,9 @@ class Bluetoothctl:
                    len(text) >= idx+2 and \
                    text[idx+1].startswith(indent):
                     start_idx = idx+1
+                    # "Device <mac> (random)", the only place the address type shows
+                    if len(args) > 2 and args[2] in ["(random)", "(public)"]:
+                        info["AddressType"] = args[2].strip("()")
 
         if start_idx < 0:
             self.logger.info("NO START INDEX")
@@ -359,6 +934,7 @@ class Bluetoothctl:
                 ":".join(args[1:]).strip()
 
             if key == "UUID":
+                info.setdefault("UUIDs", []).append(value)
                 key = value.split(":")[0]
                 value = ":".join(value.split(":")[1:])
 
@@ -371,8 +947,38 @@ class Bluetoothctl:
         return info
 
 
-    def get_device_info(self, mac_address):
+    def _expect_result(self, out, patterns):
+        """
+        Wait for the outcome of a command. bluetoothctl prints it before the
+        prompt comes back or asynchronously after it, so look at the output
+        of the command first.
+        """
+        text = "\n".join(out)
+        for idx,pattern in enumerate(patterns):
+            if isinstance(pattern, str) and not re.search(pattern, text) is None:
+                return idx
+        if not pexpect.TIMEOUT in patterns:
+            # a device that never answers is a failure, not an exception
+            patterns = patterns + [pexpect.TIMEOUT]
+        return self.reader.expect(patterns)
+
+    def get_device_info(self, mac_address, cached=True):
         """Get device info by mac address."""
+        # apply pending [CHG] events first, they invalidate cached entries
+        self._update_from_discover_log()
+        entry = self.info_cache.get(mac_address)
+        if cached and not entry is None and \
+           time.monotonic() - entry[1] < self.info_ttl:
+            return dict(entry[0])
+
+        if not self.queries is None and self.queries.healthy:
+            infodict = self._fetch_info(mac_address)
+            if not infodict is None:
+                self.info_cache[mac_address] = (infodict, time.monotonic())
+                self.enricher.submit(mac_address, info=infodict)
+                infodict = dict(infodict)
+            return infodict
+
         try:
             self.clear_output()
             self.wait_for_prompt("info " + mac_address,0.1)
@@ -382,11 +988,38 @@ class Bluetoothctl:
             print(e)
             return None
         else:
-            res = self.child.expect(["UUID:", "not available", pexpect.EOF])
-            out = self.get_output()
+            if re.search("UUID:|not available", "\n".join(out)) is None:
+                # the prompt was an earlier one, the reply is still coming
+                res = self.reader.expect(["UUID:", "not available", pexpect.EOF])
+                text = self.reader.before
+                if res == 0:
+                    # read up to the prompt, so the reply includes every UUID
+                    self.reader.expect([PROMPT_REGEX, pexpect.TIMEOUT], timeout=0.5)
+                    text += "UUID:" + self.reader.before
+                self.text_buffer += self.parse_text(text)
+            out = self.text_buffer
             infodict = self._process_device_info(out,mac_address)
+            if not infodict is None:
+                self.info_cache[mac_address] = (infodict, time.monotonic())
+                self.enricher.submit(mac_address, info=infodict)
+                infodict = dict(infodict)
             return infodict
 
+    def _fetch_info(self,mac_address):
+        """`info` from a quiet session, safe to call from any thread."""
+        out = self.queries.query("info " + mac_address)
+        if out is None:
+            return None
+        return self._process_device_info(out,mac_address)
+
+    def get_session_stats(self):
+        """Health and command stats of the event session and the query sessions."""
+        stats = {"event": dict(self.stats.get(), healthy=self.child.isalive())}
+        stats["event"].update(self.watchdog.get_stats())
+        if not self.queries is None:
+            stats.update(self.queries.get_stats())
+        return stats
+
     def is_connected(self,mac_address,update=True):
         if update:
             self.update_device_status(mac_address)
@@ -405,33 +1038,36 @@ class Bluetoothctl:
 
     def update_device_status(self,mac_address):
         data = self.get_device_info(mac_address)
-        if data is None:
+        if data is None or not mac_address in self.devices:
             return False
 
         is_paired = "Paired" in data and data["Paired"]
-        self.devices[mac_address]["paired"] = is_paired
         is_connected = "Connected" in data and data["Connected"]
-        self.devices[mac_address]["connected"] = is_connected
         is_trusted = "Trusted" in data and data["Trusted"]
-        self.devices[mac_address]["trusted"] = is_trusted
+        self._set_fields(mac_address, {"paired": is_paired, \
+                                       "connected": is_connected, \
+                                       "trusted": is_trusted})
+        self._publish()
 
 
-    def pair(self, mac_address):
+    def pair(self, mac_address,sync=True):
         """Try to pair with a device by mac address."""
         try:
             self.clear_output()
-            self.wait_for_prompt("pair " + mac_address, 4)
+            out = self.wait_for_prompt("pair " + mac_address, 4)
             self.get_output()
         except BluetoothctlError as e:
             print(e)
             return None
         else:
-            res = self.child.expect(["Failed to pair", "Pairing successful", pexpect.EOF])
+            if not sync:
+                return None
+            res = self._expect_result(out, ["Failed to pair", "Pairing successful", pexpect.EOF])
             out = self.get_output()
             success = True if res == 1 else False
             return success
 
-    def unpair(self, mac_address):
+    def unpair(self, mac_address,sync=True):
         """Try to pair with a device by mac address."""
         try:
             self.clear_output()
@@ -441,7 +1077,9 @@ class Bluetoothctl:
             print(e)
             return None
         else:
-            res = self.child.expect(["Failed to remove", "Device has been removed", pexpect.EOF])
+            if not sync:
+                return None
+            res = self._expect_result(out, ["Failed to remove", "Device has been removed", pexpect.EOF])
             out = self.get_output()
             success = True if res == 1 else False
             return success
@@ -457,7 +1095,7 @@ class Bluetoothctl:
             print(e)
             return None
         else:
-            res = self.child.expect(["not available", "Device has been removed", pexpect.EOF])
+            res = self._expect_result(out, ["not available", "Device has been removed", pexpect.EOF])
             success = True if res == 1 else False
             return success
 
@@ -475,7 +1113,7 @@ class Bluetoothctl:
 
         else:
             if sync:
-                res = self.child.expect(["trust succeeded","not available", pexpect.EOF])
+                res = self._expect_result(out, ["trust succeeded","not available", pexpect.EOF])
                 msg = self.get_output()
                 success = True if res == 1 else False
                 return success
@@ -496,7 +1134,7 @@ class Bluetoothctl:
 
         else:
             if sync:
-                res = self.child.expect(["untrust succeeded", "not available", pexpect.EOF])
+                res = self._expect_result(out, ["untrust succeeded", "not available", pexpect.EOF])
                 msg = self.get_output()
                 success = True if res == 1 else False
                 return success
@@ -519,7 +1157,7 @@ class Bluetoothctl:
 
         else:
             if sync:
-                res = self.child.expect(["Failed to connect", "Connection successful", pexpect.EOF])
+                res = self._expect_result(out, ["Failed to connect", "Connection successful", pexpect.EOF])
                 msg = self.get_output()
                 success = True if res == 1 else False
                 return success
@@ -541,7 +1179,7 @@ class Bluetoothctl:
             return None
         else:
             if sync:
-                res = self.child.expect(["Failed to disconnect", "Successful disconnected", pexpect.EOF])
+                res = self._expect_result(out, ["Failed to disconnect", "Successful disconnected", pexpect.EOF])
                 self.get_output()
                 success = True if res == 1 else False
                 return success
@@ -550,8 +1188,11 @@ class Bluetoothctl:
 
 
 
-    def stop_scan(self):
-        """Start bluetooth scanning process."""
+    def flush_log(self):
+        """Nothing to pump, the reader thread drains the pty as output arrives."""
+        pass
+
+    def _scan_off(self):
         try:
             # turn off scanner
             self.clear_output()
@@ -561,15 +1202,12 @@ class Bluetoothctl:
             print(e)
             return None
         else:
-            res = self.child.expect(["Discovering: no", "Failed to stop discovery", pexpect.EOF])
+            self.scan_window_on = False
+            res = self._expect_result(out, ["Discovering: no", "Failed to stop discovery", pexpect.EOF])
             self.get_output()
             return res
 
-    def flush_log(self):
-            self.wait_for_prompt("list")
-
-    def start_scan(self):
-        """Start bluetooth scanning process."""
+    def _scan_on(self):
         try:
             self.clear_output()
             out = self.wait_for_prompt("scan on")
@@ -578,10 +1216,83 @@ class Bluetoothctl:
             print(e)
             return None
         else:
-            res = self.child.expect(["Discovering: yes", "Failed to start discovery", pexpect.EOF])
+            self.scan_window_on = True
+            res = self._expect_result(out, ["Discovering: yes", "Failed to start discovery", pexpect.EOF])
             self.get_output()
             return res
 
+    def _apply_scan_profile(self):
+        try:
+            self.wait_for_prompt("menu scan",0.5)
+            for cmd in self.scan_profile.commands():
+                self.wait_for_prompt(cmd,0.5)
+            self.wait_for_prompt("back",0.5)
+        except BluetoothctlError as e:
+            print(e)
+            return False
+
+        self.profile_applied = True
+        return True
+
+    def start_scan(self):
+        """Start bluetooth scanning process."""
+        if not self.profile_applied:
+            self._apply_scan_profile()
+
+        self.scan_wanted = True
+        self.scan_stats.start(self.scan_profile.name)
+        if self.scan_profile.duty_cycled:
+            self.scan_window_end = time.monotonic() + self.scan_profile.on_time
+        return self._scan_on()
+
+    def stop_scan(self):
+        """Stop bluetooth scanning process."""
+        self.scan_wanted = False
+        self.scan_stats.stop()
+        if not self.scan_window_on:
+            # resting between duty cycle windows, discovery is already off
+            return None
+        return self._scan_off()
+
+    def cycle_scan(self):
+        """Switch between the scan and rest windows of a duty cycled profile."""
+        profile = self.scan_profile
+        if not self.scan_wanted or not profile.duty_cycled:
+            return
+
+        now = time.monotonic()
+        if now < self.scan_window_end:
+            return
+
+        if self.scan_window_on:
+            self._scan_off()
+            self.scan_window_end = now + profile.off_time
+        else:
+            self._scan_on()
+            self.scan_window_end = now + profile.on_time
+
+    def set_scan_profile(self, name):
+        """Use another discovery filter, a running scan is restarted with it."""
+        if not name in PROFILES:
+            return False
+
+        self.scan_profile = PROFILES[name]
+        self.profile_applied = False
+        if self.scan_wanted:
+            # bluez reads the filter when discovery starts
+            self.stop_scan()
+            self.start_scan()
+        return True
+
+    def get_scan_stats(self):
+        """Current profile, recent events/sec and the average of every profile."""
+        return {"profile": self.scan_profile.name, \
+                "rate": self.scan_stats.rate(), \
+                "profiles": self.scan_stats.get(), \
+                # raw RSSI events and the readings published from them
+                "rssi_events": self.rssi_events, \
+                "rssi_published": self.rssi_published}
+
 
     def power_off(self):
         """Make device discoverable."""
@@ -592,7 +1303,7 @@ class Bluetoothctl:
             print(e)
             return None
 
-        res = self.child.expect(["power off succeeded", pexpect.EOF])
+        res = self._expect_result(out, ["power off succeeded", pexpect.EOF])
         self.get_output()
         return res
 
@@ -600,13 +1311,14 @@ class Bluetoothctl:
         """Make device discoverable."""
         try:
             self.clear_output()
-            self.wait_for_prompt("power on",1)
+            out = self.wait_for_prompt("power on",1)
         except BluetoothctlError as e:
             print(e)
             return None
 
-        res = self.child.expect(["power on succeeded", pexpect.EOF])
-        out = self.get_output()
+        res = self._expect_result(out, ["power on succeeded", pexpect.EOF])
+        self.get_output()
+        return res
 
 
     def make_discoverable(self):
@@ -0,0 +1,264 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import models.bluetooth as bluelib
+from models.signal import sort_by_proximity
+from models.events import Subscription
+from models.sightings import DEFAULT_LOG
+
+
+class ControllerWorker(threading.Thread):
+    """
+    Owns the bluetoothctl session of one adapter. Every command for the
+    adapter runs on this thread, so a slow pair on one adapter never holds
+    up discovery on another. Between jobs the device table is refreshed.
+    """
+
+    def __init__(self, bluetooth, interval=2.0):
+        super().__init__(daemon=True)
+        self.bluetooth = bluetooth
+        self.interval = interval
+        self.jobs = queue.Queue()
+        self.finished = threading.Event()
+        self.last_refresh = 0
+        # no periodic refresh while idle, only jobs
+        self.idle = False
+        self.publish()
+
+    @property
+    def mac_addr(self):
+        return self.bluetooth.controller["mac_addr"]
+
+    def submit(self, method, *args, **kwargs):
+        future = Future()
+        self.jobs.put((future, method, args, kwargs))
+        return future
+
+    def call(self, method, *args, **kwargs):
+        return self.submit(method, *args, **kwargs).result()
+
+    def stop(self):
+        self.finished.set()
+        self.jobs.put(None)
+
+    def set_idle(self, idle):
+        self.idle = idle
+        if not idle:
+            # wake the loop up, it refreshes straight away
+            self.last_refresh = 0
+            self.jobs.put(None)
+
+    def publish(self):
+        # readers on other threads only ever see whole, finished tables
+        self.devices = self.bluetooth.get_devices(sort=True)
+        self.controller = self.bluetooth.get_controller()
+
+    def refresh(self):
+        scanning = self.bluetooth.controller["discovering"]
+        if scanning:
+            self.bluetooth.flush_log()
+        self.bluetooth.update_devices(update_scanned=True, update_paired=False)
+        self.last_refresh = time.monotonic()
+        self.publish()
+
+    def run(self):
+        while not self.finished.is_set():
+            try:
+                job = self.jobs.get(timeout=None if self.idle else self.interval)
+            except queue.Empty:
+                job = None
+
+            if not job is None:
+                future, method, args, kwargs = job
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = getattr(self.bluetooth, method)(*args, **kwargs)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+                self.publish()
+
+            if self.finished.is_set():
+                break
+            if not self.idle and time.monotonic() - self.last_refresh >= self.interval:
+                self.refresh()
+
+        self.bluetooth.child.close()
+        if not self.bluetooth.queries is None:
+            self.bluetooth.queries.close()
+
+
+class ControllerPool:
+    """
+    One bluetoothctl session and worker thread per adapter. Implements the
+    Bluetoothctl interface used by the front ends; device commands go to the
+    adapter that owns the device, everything else to the selected adapter.
+    """
+
+    def __init__(self, rfkill_unblock=False, command="bluetoothctl", interval=2.0, \
+                 scan_profile="all", sighting_log=DEFAULT_LOG):
+        first = bluelib.Bluetoothctl(rfkill_unblock=rfkill_unblock, command=command, \
+                                     scan_profile=scan_profile, sighting_log=sighting_log)
+        macs = first.update_controllers()
+        first.update_controller()
+
+        self.workers = {}
+        self.selected = first.controller["mac_addr"]
+        self.workers[self.selected] = ControllerWorker(first, interval)
+        for mac in macs:
+            if not mac in self.workers:
+                bluetooth = bluelib.Bluetoothctl(rfkill_unblock=False, \
+                                                 command=command, \
+                                                 controller=mac, \
+                                                 scan_profile=scan_profile, \
+                                                 sighting_log=sighting_log)
+                bluetooth.update_controller()
+                self.workers[mac] = ControllerWorker(bluetooth, interval)
+
+        for worker in self.workers.values():
+            worker.start()
+
+    @property
+    def worker(self):
+        return self.workers[self.selected]
+
+    def _worker_for(self, mac_address):
+        owners = [worker for worker in self.workers.values() \
+                  if any(dev["mac_addr"] == mac_address for dev in worker.devices)]
+        if len(owners) == 0 or self.worker in owners:
+            return self.worker
+        return owners[0]
+
+    def _call(self, method, *args, **kwargs):
+        return self.worker.call(method, *args, **kwargs)
+
+    def _call_for(self, mac_address, method, *args, **kwargs):
+        return self._worker_for(mac_address).call(method, mac_address, *args, **kwargs)
+
+    def shutdown(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    def get_controllers(self):
+        return [worker.controller for worker in self.workers.values()]
+
+    def set_idle(self, idle, wake=None):
+        """Stop refreshing the tables while idle, `wake()` on a real change."""
+        for worker in self.workers.values():
+            # it may run bluetoothctl commands, that is the worker's job
+            worker.submit("set_idle", idle, wake)
+            worker.set_idle(idle)
+
+    def get_memory_stats(self):
+        # summed over the adapters, each worker measures its own session
+        stats = {}
+        for worker in self.workers.values():
+            for name,(count,size) in worker.call("get_memory_stats").items():
+                total = stats.get(name, (0, 0))
+                stats[name] = (total[0] + count, total[1] + size)
+        return stats
+
+    def get_session_stats(self):
+        # per adapter, e.g. "00:1A:7D:DA:71:10 query0"; the counters are
+        # locked, no need to queue behind the adapter's jobs
+        stats = {}
+        for mac,worker in self.workers.items():
+            for name,value in worker.bluetooth.get_session_stats().items():
+                stats["%s %s" % (mac, name)] = value
+        return stats
+
+    def get_controller(self):
+        return self.worker.controller
+
+    def select_controller(self, mac_address):
+        if not mac_address in self.workers:
+            return False
+        self.selected = mac_address
+        return True
+
+    def update_controller(self):
+        return self._call("update_controller")
+
+    def flush_log(self):
+        pass
+
+    def update_devices(self, update_scanned=True, update_paired=True):
+        return self._call("update_devices", update_scanned=update_scanned, \
+                          update_paired=update_paired)
+
+    def get_devices(self, sort=False, order="name"):
+        if order == "proximity":
+            return sort_by_proximity(self.worker.devices)
+        return self.worker.devices
+
+    def snapshot(self):
+        """The selected adapter's DeviceTable, see Bluetoothctl.snapshot."""
+        return self.worker.bluetooth.snapshot()
+
+    def subscribe(self, callback=None, max_batches=64):
+        """Table changes of every adapter, see Bluetoothctl.subscribe."""
+        subscription = Subscription(max_batches)
+        for worker in self.workers.values():
+            worker.bluetooth.events.attach(subscription)
+        if not callback is None:
+            subscription.deliver(callback)
+        return subscription
+
+    def search(self, query):
+        # the index is locked internally, no need to go through the worker
+        return self.worker.bluetooth.search(query)
+
+    def get_device_info(self, mac_address):
+        return self._call_for(mac_address, "get_device_info")
+
+    def update_device_status(self, mac_address):
+        return self._call_for(mac_address, "update_device_status")
+
+    def is_connected(self, mac_address, update=True):
+        return self._call_for(mac_address, "is_connected", update=update)
+
+    def is_paired(self, mac_address, update=True):
+        return self._call_for(mac_address, "is_paired", update=update)
+
+    def is_trusted(self, mac_address, update=True):
+        return self._call_for(mac_address, "is_trusted", update=update)
+
+    def pair(self, mac_address, sync=True):
+        return self._call_for(mac_address, "pair", sync=sync)
+
+    def unpair(self, mac_address, sync=True):
+        return self._call_for(mac_address, "unpair", sync=sync)
+
+    def connect(self, mac_address, sync=True):
+        return self._call_for(mac_address, "connect", sync=sync)
+
+    def disconnect(self, mac_address, sync=False):
+        return self._call_for(mac_address, "disconnect", sync=sync)
+
+    def trust(self, mac_address, sync=True):
+        return self._call_for(mac_address, "trust", sync=sync)
+
+    def untrust(self, mac_address, sync=True):
+        return self._call_for(mac_address, "untrust", sync=sync)
+
+    def start_scan(self):
+        return self._call("start_scan")
+
+    def stop_scan(self):
+        return self._call("stop_scan")
+
+    def set_scan_profile(self, name):
+        return self._call("set_scan_profile", name)
+
+    def get_scan_stats(self):
+        # the counters are locked internally, like the search index
+        return self.worker.bluetooth.get_scan_stats()
+
+    def power_on(self):
+        return self._call("power_on")
+
+    def power_off(self):
+        return self._call("power_off")
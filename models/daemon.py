@@ -0,0 +1,519 @@
+import os
+import json
+import time
+import socket
+import socketserver
+import threading
+from datetime import datetime
+
+import models.bluetooth as bluelib
+from models.signal import sort_by_proximity
+from models.search import DeviceIndex
+from models.idle import device_state
+from models.sightings import DEFAULT_LOG
+from models.actions import Action
+
+
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), \
+                              "btapplet.sock")
+
+# how long a sync request waits for its outcome, less than the client waits
+SYNC_TIMEOUT = 8.0
+
+
+class DaemonError(Exception):
+    """This exception is raised, when the daemon rejects or fails a request."""
+    pass
+
+
+def encode_device(dev):
+    data = dict(dev)
+    data["time"] = dev["time"].timestamp()
+    return data
+
+def decode_device(data):
+    dev = dict(data)
+    dev["time"] = datetime.fromtimestamp(data["time"])
+    return dev
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    One connection, one line of JSON per request and one line per reply:
+
+      -> {"op": "connect", "mac": "FC:E8:06:8F:30:BB"}
+      <- {"ok": true, "result": true}
+
+    "subscribe" turns the connection into a one-way stream of
+    {"event": "devices", "version": n, "devices": [...], "controller": {...}}
+    lines.
+    """
+
+    def handle(self):
+        daemon = self.server.daemon
+        try:
+            for line in self.rfile:
+                if line.strip() == b"":
+                    continue
+
+                try:
+                    request = json.loads(line)
+                    op = request["op"]
+                except (ValueError, KeyError, TypeError):
+                    self.reply({"ok": False, "error": "malformed request"})
+                    continue
+
+                if op == "subscribe":
+                    daemon.stream(self)
+                    return
+
+                try:
+                    result = daemon.dispatch(self, op, request)
+                except Exception as e:
+                    # a failed command must not take the connection with it
+                    self.reply({"ok": False, "error": str(e) or type(e).__name__})
+                else:
+                    self.reply({"ok": True, "result": result})
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            daemon.release_scan(self)
+
+    def reply(self, msg):
+        self.wfile.write(json.dumps(msg).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BluetoothDaemon:
+    """
+    Owns a single bluetoothctl session, keeps the device table warm and
+    serves it to any number of clients over a UNIX socket.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, interval=2.0, scan=True, \
+                 bluetooth=None, command="bluetoothctl", scan_profile="all", \
+                 sighting_log=DEFAULT_LOG):
+        self.path = path
+        self.command = command
+        self.scan_profile = scan_profile
+        self.sighting_log = sighting_log
+        self.interval = interval
+        self.keep_scanning = scan
+        self.bluetooth = bluetooth
+
+        # bluetoothctl is a single pty, every command goes through this lock
+        self.lock = threading.RLock()
+        self.changed = threading.Condition()
+        self.version = 0
+        self.snapshot = []
+        self.controller = {}
+        self.scan_holders = set()
+        self.scanning = False
+        self.finished = threading.Event()
+        self.server = None
+
+    def start(self):
+        if self.bluetooth is None:
+            self.bluetooth = bluelib.Bluetoothctl(rfkill_unblock=False, \
+                                                  command=self.command, \
+                                                  scan_profile=self.scan_profile, \
+                                                  sighting_log=self.sighting_log)
+
+        with self.lock:
+            self.bluetooth.power_on()
+            self.bluetooth.update_devices()
+            self.bluetooth.update_controller()
+        self._sync_scan()
+        self._refresh()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = _Server(self.path, _RequestHandler)
+        self.server.daemon = self
+        os.chmod(self.path, 0o600)
+
+        self.update_thread = threading.Thread(target=self._update_loop, \
+                                              daemon=True)
+        self.update_thread.start()
+
+    def serve_forever(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.finished.set()
+        with self.changed:
+            self.changed.notify_all()
+        if self.server is not None:
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def _update_loop(self):
+        while not self.finished.wait(self.interval):
+            self._refresh()
+
+    def _refresh(self):
+        with self.lock:
+            if self.scanning:
+                self.bluetooth.flush_log()
+            self.bluetooth.update_devices(update_scanned=self.scanning)
+            devices = [encode_device(dev) \
+                       for dev in self.bluetooth.get_devices(sort=True)]
+            controller = self.bluetooth.get_controller()
+
+        if devices != self.snapshot or controller != self.controller:
+            with self.changed:
+                self.snapshot = devices
+                self.controller = controller
+                self.version += 1
+                self.changed.notify_all()
+
+    def _sync_scan(self):
+        # scan_holders changes on the handler threads, read it under the lock
+        with self.lock:
+            want = self.keep_scanning or len(self.scan_holders) > 0
+            if want and not self.scanning:
+                self.bluetooth.start_scan()
+            elif not want and self.scanning:
+                self.bluetooth.stop_scan()
+            self.scanning = want
+
+    def hold_scan(self, client):
+        with self.lock:
+            self.scan_holders.add(client)
+            self._sync_scan()
+
+    def release_scan(self, client):
+        with self.lock:
+            if client in self.scan_holders:
+                self.scan_holders.discard(client)
+                self._sync_scan()
+
+    def stream(self, client):
+        version = -1
+        while not self.finished.is_set():
+            with self.changed:
+                while version == self.version and not self.finished.is_set():
+                    self.changed.wait()
+                version = self.version
+                devices = self.snapshot
+                controller = self.controller
+
+            client.reply({"event": "devices", \
+                          "version": version, \
+                          "devices": devices, \
+                          "controller": controller})
+
+    def dispatch(self, client, op, request):
+        if op == "list":
+            return self.snapshot
+
+        if op == "controller":
+            return self.controller
+
+        if op == "scan":
+            if request.get("on", True):
+                self.hold_scan(client)
+            else:
+                self.release_scan(client)
+            with self.lock:
+                return self.scanning
+
+        if op == "profile":
+            with self.lock:
+                if not self.bluetooth.set_scan_profile(request.get("name")):
+                    raise DaemonError("unknown scan profile %s" % request.get("name"))
+                return self.bluetooth.get_scan_stats()
+
+        if op == "memory":
+            with self.lock:
+                return self.bluetooth.get_memory_stats()
+
+        if op == "stats":
+            with self.lock:
+                return self.bluetooth.get_scan_stats()
+
+        if op == "sessions":
+            with self.lock:
+                return self.bluetooth.get_session_stats()
+
+        if op == "power":
+            with self.lock:
+                if request.get("on", True):
+                    return self.bluetooth.power_on()
+                return self.bluetooth.power_off()
+
+        if op != "info" and not op in Action.COMMANDS:
+            raise DaemonError("unknown operation %s" % op)
+
+        mac = request.get("mac")
+        if not mac in self.bluetooth.devices:
+            raise DaemonError("unknown device %s" % mac)
+
+        if op == "info":
+            with self.lock:
+                return self.bluetooth.get_device_info(mac)
+
+        # only issue the command under the lock, never wait for its outcome there
+        command, check, expected = Action.COMMANDS[op]
+        with self.lock:
+            result = getattr(self.bluetooth, command)(mac, sync=False)
+            self.bluetooth.update_device_status(mac)
+        if request.get("sync", False):
+            result = self._wait_for(mac, check, expected)
+        self._refresh()
+        return result
+
+    def _wait_for(self, mac, check, expected):
+        """Poll `check` until it reports `expected`, False after SYNC_TIMEOUT."""
+        deadline = time.monotonic() + SYNC_TIMEOUT
+        while True:
+            try:
+                with self.lock:
+                    if getattr(self.bluetooth, check)(mac) == expected:
+                        return True
+            except KeyError:
+                # the device left the table, i.e. it was removed
+                return not expected
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.25)
+
+
+class BluetoothClient:
+    """
+    Thin client for a running BluetoothDaemon. Implements the subset of the
+    Bluetoothctl interface used by the front ends.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._connect()
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.index = DeviceIndex()
+        # the subscription followed while idle, see set_idle
+        self.idle_stream = None
+
+    @staticmethod
+    def available(path=DEFAULT_SOCKET):
+        if not os.path.exists(path):
+            return False
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.close()
+            return True
+        except OSError:
+            return False
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+        self.rfile = self.sock.makefile("rb")
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, op, **kwargs):
+        kwargs["op"] = op
+        with self.lock:
+            try:
+                self.sock.sendall(json.dumps(kwargs).encode("utf-8") + b"\n")
+                line = self.rfile.readline()
+            except socket.timeout:
+                # its late reply would answer the next request, start over
+                self.close()
+                self._connect()
+                raise DaemonError("daemon did not answer %s in time" % op)
+
+        if line == b"":
+            raise DaemonError("daemon closed the connection")
+
+        reply = json.loads(line)
+        if not reply["ok"]:
+            raise DaemonError(reply["error"])
+        return reply["result"]
+
+    def _open_stream(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(b'{"op": "subscribe"}\n')
+        return sock, sock.makefile("rb")
+
+    def subscribe(self):
+        """Yield the device list and controller state on every change."""
+        sock, rfile = self._open_stream()
+        try:
+            for line in rfile:
+                msg = json.loads(line)
+                msg["devices"] = [decode_device(dev) for dev in msg["devices"]]
+                yield msg
+        finally:
+            rfile.close()
+            sock.close()
+
+    def _checked(self, op, mac_address, **kwargs):
+        try:
+            return self.request(op, mac=mac_address, **kwargs)
+        except DaemonError as e:
+            print(e)
+            return None
+
+    def flush_log(self):
+        pass
+
+    def update_devices(self, update_scanned=True, update_paired=True):
+        devices = [decode_device(dev) for dev in self.request("list")]
+        known = self.devices
+        self.devices = dict((dev["mac_addr"], dev) for dev in devices)
+        # departed devices must not stay searchable
+        for mac in known:
+            if not mac in self.devices:
+                self.index.remove(mac)
+        for dev in devices:
+            self.index.update(dev["mac_addr"], dev["name"], dev.get("vendor"))
+
+    def get_devices(self, sort=False, order="name"):
+        self.update_devices()
+        if order == "proximity":
+            return sort_by_proximity(list(self.devices.values()))
+        return list(self.devices.values())
+
+    def get_controller(self):
+        return self.request("controller")
+
+    def update_controller(self):
+        return self.get_controller()
+
+    def get_controllers(self):
+        return [self.get_controller()]
+
+    def select_controller(self, mac_address):
+        # the daemon serves its default controller only
+        return mac_address == self.get_controller()["mac_addr"]
+
+    def search(self, query):
+        return self.index.search(query)
+
+    def get_device_info(self, mac_address):
+        return self._checked("info", mac_address)
+
+    def update_device_status(self, mac_address):
+        self.update_devices()
+
+    def is_connected(self, mac_address, update=True):
+        if update:
+            self.update_devices()
+        return self.devices[mac_address]["connected"]
+
+    def is_paired(self, mac_address, update=True):
+        if update:
+            self.update_devices()
+        return self.devices[mac_address]["paired"]
+
+    def is_trusted(self, mac_address, update=True):
+        if update:
+            self.update_devices()
+        return self.devices[mac_address]["trusted"]
+
+    def pair(self, mac_address, sync=True):
+        return self._checked("pair", mac_address, sync=sync)
+
+    def unpair(self, mac_address, sync=True):
+        return self._checked("unpair", mac_address, sync=sync)
+
+    def connect(self, mac_address, sync=True):
+        return self._checked("connect", mac_address, sync=sync)
+
+    def disconnect(self, mac_address, sync=False):
+        return self._checked("disconnect", mac_address, sync=sync)
+
+    def trust(self, mac_address, sync=True):
+        return self._checked("trust", mac_address, sync=sync)
+
+    def untrust(self, mac_address, sync=True):
+        return self._checked("untrust", mac_address, sync=sync)
+
+    def start_scan(self):
+        return self.request("scan", on=True)
+
+    def stop_scan(self):
+        return self.request("scan", on=False)
+
+    def set_scan_profile(self, name):
+        try:
+            self.request("profile", name=name)
+        except DaemonError as e:
+            print(e)
+            return False
+        return True
+
+    def get_scan_stats(self):
+        return self.request("stats")
+
+    def get_session_stats(self):
+        return self.request("sessions")
+
+    def set_idle(self, idle, wake=None):
+        """
+        The daemon keeps its own schedule. While idle the client follows its
+        stream and calls `wake()` when a device appears, goes or changes
+        state; signal strength alone does not count.
+        """
+        if not self.idle_stream is None:
+            # the watcher's read returns, it exits
+            try:
+                self.idle_stream.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.idle_stream = None
+
+        if idle and not wake is None:
+            try:
+                sock, rfile = self._open_stream()
+            except OSError as e:
+                print(e)
+                return
+            self.idle_stream = sock
+            threading.Thread(target=self._watch_idle, args=(sock, rfile, wake), \
+                             name="idle-watch", daemon=True).start()
+
+    def _watch_idle(self, sock, rfile, wake):
+        # the first message is the table as it is now
+        state = None
+        try:
+            for line in rfile:
+                msg = json.loads(line)
+                current = device_state([decode_device(dev) for dev in msg["devices"]])
+                if not state is None and current != state:
+                    wake()
+                state = current
+        except (OSError, ValueError):
+            pass
+        finally:
+            rfile.close()
+            sock.close()
+
+    def get_memory_stats(self):
+        # the daemon's session, the client itself holds next to nothing
+        return dict((name, tuple(value)) for name,value in self.request("memory").items())
+
+    def power_on(self):
+        return self.request("power", on=True)
+
+    def power_off(self):
+        return self.request("power", on=False)
@@ -0,0 +1,177 @@
+import re
+import queue
+import threading
+
+
+# major device class, bits 8-12 of the Class of Device
+MAJOR_CLASSES = {0: "misc", 1: "computer", 2: "phone", 3: "network", \
+                 4: "audio", 5: "peripheral", 6: "imaging", 7: "wearable", \
+                 8: "toy", 9: "health"}
+
+# minor classes worth telling apart in the device list
+AUDIO_CLASSES = {1: "headset", 2: "hands-free", 4: "microphone", \
+                 5: "speaker", 6: "headphones", 7: "portable audio", \
+                 8: "car audio", 10: "hifi audio"}
+PERIPHERAL_CLASSES = {1: "keyboard", 2: "mouse", 3: "keyboard/mouse"}
+
+# GAP appearance categories, bits 6-15
+APPEARANCES = {1: "phone", 2: "computer", 3: "watch", 4: "clock", \
+               5: "display", 6: "remote control", 7: "eye glasses", 8: "tag", \
+               9: "keyring", 10: "media player", 11: "barcode scanner", \
+               12: "thermometer", 13: "heart rate sensor", \
+               14: "blood pressure", 15: "hid", 16: "glucose meter", \
+               17: "running sensor", 18: "cycling sensor", \
+               49: "pulse oximeter", 81: "outdoor sports"}
+HID_APPEARANCES = {1: "keyboard", 2: "mouse", 3: "joystick", 4: "gamepad", \
+                   5: "tablet", 6: "card reader", 7: "pen", 8: "barcode scanner"}
+
+# 16-bit service UUIDs -> profile
+PROFILE_NAMES = {0x1101: "SPP", 0x1105: "OPP", 0x1106: "FTP", \
+                 0x1108: "HSP", 0x110a: "A2DP Source", 0x110b: "A2DP Sink", \
+                 0x110c: "AVRCP Target", 0x110e: "AVRCP", 0x1112: "HSP AG", \
+                 0x1115: "PANU", 0x1116: "NAP", 0x111e: "HFP", \
+                 0x111f: "HFP AG", 0x1124: "HID", 0x112f: "PBAP", \
+                 0x1132: "MAP", 0x1200: "PnP", 0x1800: "GAP", 0x1801: "GATT", \
+                 0x180a: "Device Info", 0x180d: "Heart Rate", \
+                 0x180f: "Battery", 0x1812: "HOGP"}
+
+BASE_UUID_REGEX = re.compile(r"([0-9a-fA-F]{8})-0000-1000-8000-00805[fF]9[bB]34[fF][bB]")
+
+
+def decode_class(value):
+    try:
+        cod = int(value, 16)
+    except ValueError:
+        return None
+    major,minor = (cod >> 8) & 0x1f, (cod >> 2) & 0x3f
+    if major == 4 and minor in AUDIO_CLASSES:
+        return AUDIO_CLASSES[minor]
+    if major == 5 and (minor >> 4) in PERIPHERAL_CLASSES:
+        return PERIPHERAL_CLASSES[minor >> 4]
+    return MAJOR_CLASSES.get(major)
+
+def decode_appearance(value):
+    try:
+        appearance = int(value, 16)
+    except ValueError:
+        return None
+    category,sub = appearance >> 6, appearance & 0x3f
+    if category == 15 and sub in HID_APPEARANCES:
+        return HID_APPEARANCES[sub]
+    return APPEARANCES.get(category)
+
+def profile_name(uuid):
+    """
+    Profile of a service UUID, either bare or the `info` form
+    `Audio Sink (0000110b-...)`; bluetoothctl's own name otherwise.
+    """
+    match = BASE_UUID_REGEX.search(uuid)
+    if not match is None:
+        name = PROFILE_NAMES.get(int(match.group(1), 16))
+        if not name is None:
+            return name
+    name = uuid.split("(")[0].strip()
+    if name == "" or name.startswith("Vendor") or name.startswith("Unknown") or \
+       not BASE_UUID_REGEX.match(name) is None:
+        return None
+    return name
+
+def decode_info(info):
+    """Record fields from (part of) a parsed `info` reply."""
+    fields = {}
+    if "Class" in info:
+        fields["device_class"] = decode_class(info["Class"])
+    if "Appearance" in info:
+        fields["appearance"] = decode_appearance(info["Appearance"])
+    if "Icon" in info:
+        fields["icon"] = info["Icon"]
+    if "UUIDs" in info:
+        profiles = [profile_name(uuid) for uuid in info["UUIDs"]]
+        fields["profiles"] = tuple(sorted(set(name for name in profiles \
+                                              if not name is None)))
+    return fields
+
+
+class Enricher:
+    """
+    Works out what a device is, off the ingestion path: vendor from the
+    OUI, class, appearance, icon and profiles from `info` replies and
+    property changes. submit() only queues the MAC, a few worker threads
+    do the lookups and results() hands the record fields back to the
+    session, which applies them on its next pass. `fetch_info(mac)`, when
+    given, lets the workers ask for an `info` reply themselves; it comes
+    before the vendor, `resolve_vendor(mac, address_type)` gets the address
+    type the reply names.
+    """
+
+    def __init__(self, resolve_vendor, fetch_info=None, workers=2):
+        self.resolve_vendor = resolve_vendor
+        self.fetch_info = fetch_info
+        self.lock = threading.Lock()
+        # mac -> [vendor wanted, info or None], one queue entry per mac
+        self.pending = {}
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()
+        self.submitted = 0
+        self.enriched = 0
+        self.workers = [threading.Thread(target=self.run, name="enrich", daemon=True) \
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, mac, vendor=False, info=None):
+        with self.lock:
+            self.submitted += 1
+            job = self.pending.get(mac)
+            if job is None:
+                self.pending[mac] = [vendor, info]
+                self.jobs.put(mac)
+                return
+            job[0] = job[0] or vendor
+            if not info is None:
+                if job[1] is None:
+                    job[1] = dict(info)
+                else:
+                    uuids = job[1].get("UUIDs", []) + info.get("UUIDs", [])
+                    job[1].update(info)
+                    if len(uuids) > 0:
+                        job[1]["UUIDs"] = uuids
+
+    def results(self):
+        """(mac, fields) for every device enriched since the last call."""
+        done = []
+        while True:
+            try:
+                done.append(self.done.get_nowait())
+            except queue.Empty:
+                return done
+
+    def stop(self):
+        for worker in self.workers:
+            self.jobs.put(None)
+
+    def run(self):
+        while True:
+            mac = self.jobs.get()
+            if mac is None:
+                return
+            with self.lock:
+                vendor,info = self.pending.pop(mac)
+
+            fields = {}
+            try:
+                if info is None and vendor and not self.fetch_info is None:
+                    info = self.fetch_info(mac)
+                if vendor:
+                    # random LE addresses have no vendor, the info reply says which
+                    address_type = None if info is None else info.get("AddressType")
+                    fields["vendor"] = self.resolve_vendor(mac, address_type)
+                if not info is None:
+                    fields.update(decode_info(info))
+            except Exception as e:
+                print(e)
+                continue
+            if len(fields) > 0:
+                self.done.put((mac, fields))
+                with self.lock:
+                    self.enriched += 1
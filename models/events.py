@@ -0,0 +1,210 @@
+import asyncio
+import threading
+from collections import deque
+
+
+class DeviceAdded:
+    """A device entered the table, `device` is the whole record."""
+
+    def __init__(self, mac_addr, device, controller=None):
+        self.mac_addr = mac_addr
+        self.device = device
+        # the adapter whose table it is
+        self.controller = controller
+
+    def __repr__(self):
+        return "DeviceAdded(%s)" % self.mac_addr
+
+
+class DeviceChanged:
+    """
+    `fields` maps the fields of the record that changed to their new values,
+    `folded` is how many raw bluetoothctl events went into the change.
+    """
+
+    def __init__(self, mac_addr, fields, controller=None, folded=1):
+        self.mac_addr = mac_addr
+        self.fields = fields
+        self.controller = controller
+        self.folded = folded
+
+    def __repr__(self):
+        return "DeviceChanged(%s, %s)" % (self.mac_addr, sorted(self.fields))
+
+
+class DeviceRemoved:
+    """bluez dropped the device, it left the table."""
+
+    def __init__(self, mac_addr, controller=None):
+        self.mac_addr = mac_addr
+        self.controller = controller
+
+    def __repr__(self):
+        return "DeviceRemoved(%s)" % self.mac_addr
+
+
+class ControllerChanged:
+    """Name, power or discovery state of an adapter changed, or it went away."""
+
+    def __init__(self, mac_addr, fields, removed=False):
+        self.mac_addr = mac_addr
+        self.fields = fields
+        self.removed = removed
+
+    def __repr__(self):
+        return "ControllerChanged(%s, %s%s)" % (self.mac_addr, sorted(self.fields), \
+                                               ", removed" if self.removed else "")
+
+
+def coalesce(events):
+    """
+    Net effect of a run of events, at most one per device and controller,
+    in the order they were first seen. A device added and changed is
+    reported added with its latest fields, one added and removed not at
+    all; DeviceAdded is an upsert for a device that was removed and came
+    back.
+    """
+    merged = {}
+    for event in events:
+        if isinstance(event, ControllerChanged):
+            key = (None, event.mac_addr)
+        else:
+            key = (event.controller, event.mac_addr)
+        prev = merged.get(key)
+        if prev is None:
+            merged[key] = event
+
+        elif isinstance(event, ControllerChanged):
+            fields = dict(prev.fields)
+            fields.update(event.fields)
+            merged[key] = ControllerChanged(event.mac_addr, fields, event.removed)
+
+        elif isinstance(event, DeviceRemoved):
+            if isinstance(prev, DeviceAdded):
+                del merged[key]
+            else:
+                merged[key] = event
+
+        elif isinstance(event, DeviceChanged) and isinstance(prev, DeviceAdded):
+            device = dict(prev.device)
+            device.update(event.fields)
+            merged[key] = DeviceAdded(event.mac_addr, device, event.controller)
+
+        elif isinstance(event, DeviceChanged) and isinstance(prev, DeviceChanged):
+            fields = dict(prev.fields)
+            fields.update(event.fields)
+            merged[key] = DeviceChanged(event.mac_addr, fields, event.controller, \
+                                        prev.folded + event.folded)
+
+        else:
+            merged[key] = event
+    return list(merged.values())
+
+
+class Subscription:
+    """
+    Batches of events, one per ingestion pass, in order. Iterate it, or
+    `async for` it, or hand it a callback. At most `max_batches` wait for
+    the consumer; past that it is behind and new batches are folded into
+    the last waiting one, so a slow consumer holds about one event per
+    device and never holds ingestion up.
+    """
+
+    def __init__(self, max_batches=64):
+        self.max_batches = max_batches
+        self.cond = threading.Condition()
+        self.batches = deque()
+        self.closed = False
+        self.sources = []
+        # batches folded into another because the consumer was behind
+        self.coalesced = 0
+
+    def put(self, batch):
+        with self.cond:
+            if self.closed:
+                return
+            if len(self.batches) >= self.max_batches:
+                self.batches[-1] = coalesce(self.batches[-1] + batch)
+                self.coalesced += 1
+            else:
+                self.batches.append(batch)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """The next batch, None on timeout or once closed."""
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.batches) > 0 or self.closed, timeout)
+            if len(self.batches) == 0:
+                return None
+            return self.batches.popleft()
+
+    def close(self):
+        for source in self.sources:
+            source.detach(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def deliver(self, callback):
+        """Call `callback(batch)` for every batch, on a thread of its own."""
+        def run():
+            for batch in self:
+                callback(batch)
+        thread = threading.Thread(target=run, name="events", daemon=True)
+        thread.start()
+        return thread
+
+    def __iter__(self):
+        while True:
+            batch = self.get()
+            if batch is None:
+                return
+            yield batch
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        batch = await asyncio.get_running_loop().run_in_executor(None, self.get)
+        if batch is None:
+            raise StopAsyncIteration
+        return batch
+
+
+class DeviceEvents:
+    """
+    Changes made to a device table during one ingestion pass, handed to
+    every attached subscription as one batch by flush(). Nothing is kept
+    while nobody is subscribed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.pending = []
+
+    def attach(self, subscription):
+        with self.lock:
+            self.subscriptions.append(subscription)
+        subscription.sources.append(self)
+
+    def detach(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def emit(self, event):
+        if len(self.subscriptions) == 0:
+            return
+        with self.lock:
+            self.pending.append(event)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            subscriptions = list(self.subscriptions)
+        if len(pending) == 0:
+            return
+        batch = coalesce(pending)
+        for subscription in subscriptions:
+            subscription.put(batch)
@@ -0,0 +1,124 @@
+import time
+import threading
+from collections import deque
+
+
+def device_state(devices):
+    """What is worth waking up for in a device list; signal strength is not."""
+    return tuple((data["mac_addr"], data["online"], data["paired"], \
+                  data["connected"], data["trusted"], data["name"]) \
+                 for data in devices)
+
+
+class IdleMonitor:
+    """
+    Whether the applet has anything to do. It goes idle once nothing
+    happened (a key, a device change, a pending action) for `timeout`
+    seconds, or right away when the terminal loses focus; the periodic
+    work then sleeps in wait() until activity() is reported. `timeout` 0
+    never goes idle.
+
+    Counts the wakeups of the periodic work and the process CPU time spent
+    while idle and while active.
+    """
+
+    def __init__(self, timeout=60.0, on_idle=None, on_wake=None):
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.on_wake = on_wake
+        self.lock = threading.Lock()
+        self.woken = threading.Event()
+        self.last_activity = time.monotonic()
+        self.idle = False
+        # wakeups of the periodic work in the last minute
+        self.wakeups = deque()
+        self.started = (time.monotonic(), time.process_time())
+        self.idle_since = None
+        # (wall seconds, cpu seconds) spent idle
+        self.idle_spent = (0.0, 0.0)
+        # set from a signal handler, see resume()
+        self.resumed = threading.Event()
+        threading.Thread(target=self._resume_loop, name="resume", daemon=True).start()
+
+    def activity(self):
+        with self.lock:
+            self.last_activity = time.monotonic()
+            if self.idle:
+                self.woken.set()
+
+    def resume(self):
+        """
+        activity() for signal handlers: the handler may have interrupted a
+        thread holding the lock, so it only sets an Event nobody else on
+        that thread touches, and a thread of its own reports the activity.
+        """
+        self.resumed.set()
+
+    def _resume_loop(self):
+        while True:
+            self.resumed.wait()
+            self.resumed.clear()
+            self.activity()
+
+    def blur(self):
+        """The terminal lost focus, nobody is looking: idle after this round."""
+        if self.timeout > 0:
+            with self.lock:
+                self.last_activity = time.monotonic() - self.timeout
+
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            self.wakeups.append(now)
+            while self.wakeups[0] < now - 60:
+                self.wakeups.popleft()
+
+    def wait(self, interval, finished):
+        """Wait for the next round: `interval` while active, until woken while idle."""
+        with self.lock:
+            quiet = time.monotonic() - self.last_activity
+            if self.timeout <= 0 or quiet < self.timeout or finished.is_set():
+                wait_idle = False
+            else:
+                self.woken.clear()
+                self.idle = True
+                wait_idle = True
+
+        if not wait_idle:
+            finished.wait(interval)
+            return
+
+        self.idle_since = (time.monotonic(), time.process_time())
+        if not self.on_idle is None:
+            self.on_idle()
+        self.woken.wait()
+
+        with self.lock:
+            self.idle = False
+            wall, cpu = self.idle_spent
+            self.idle_spent = (wall + time.monotonic() - self.idle_since[0], \
+                               cpu + time.process_time() - self.idle_since[1])
+            self.idle_since = None
+        if not self.on_wake is None:
+            self.on_wake()
+
+    def wake(self):
+        """Stop waiting, e.g. to shut down."""
+        self.woken.set()
+
+    def get_stats(self):
+        """Wakeups/minute now, CPU seconds per hour while idle and while active."""
+        now = time.monotonic()
+        with self.lock:
+            wakeups = sum(1 for wakeup in self.wakeups if wakeup >= now - 60)
+            idle_wall, idle_cpu = self.idle_spent
+            if not self.idle_since is None:
+                idle_wall += time.monotonic() - self.idle_since[0]
+                idle_cpu += time.process_time() - self.idle_since[1]
+        wall = time.monotonic() - self.started[0] - idle_wall
+        cpu = time.process_time() - self.started[1] - idle_cpu
+        return {"idle": self.idle, \
+                "wakeups_per_min": wakeups, \
+                "idle_seconds": idle_wall, \
+                "idle_cpu_per_hour": 3600 * idle_cpu / idle_wall if idle_wall > 0 else 0.0, \
+                "active_cpu_per_hour": 3600 * cpu / wall if wall > 0 else 0.0}
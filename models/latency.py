@@ -0,0 +1,49 @@
+import time
+import threading
+from collections import deque
+
+
+class LatencyMeter:
+    """
+    Time from reading a key to the first repaint it caused. Keys that
+    paint nothing are not counted. `target` is one frame at 60Hz; the last
+    `history` samples are kept for percentiles.
+    """
+
+    def __init__(self, target=0.016, history=256):
+        self.target = target
+        self.samples = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.started = None
+        self.count = 0
+        self.over = 0
+
+    def start(self):
+        with self.lock:
+            self.started = time.perf_counter()
+
+    def cancel(self):
+        with self.lock:
+            self.started = None
+
+    def painted(self):
+        with self.lock:
+            if self.started is None:
+                return
+            latency = time.perf_counter() - self.started
+            self.started = None
+            self.samples.append(latency)
+            self.count += 1
+            if latency > self.target:
+                self.over += 1
+
+    def percentile(self, q):
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) == 0:
+            return 0.0
+        return samples[min(len(samples)-1, int(q * len(samples)))]
+
+    def slow(self):
+        """Whether the recent keys missed the target."""
+        return self.percentile(0.95) > self.target
@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import tracemalloc
+from types import MappingProxyType
+from collections import deque
+
+
+TRACE_OUTPUT = "/tmp/btapplet.tracemalloc"
+
+
+def sizeof(obj, depth=3):
+    """Bytes held by obj and, `depth` levels down, the objects it refers to."""
+    size = sys.getsizeof(obj)
+    if depth == 0:
+        return size
+    if isinstance(obj, (dict, MappingProxyType)):
+        size += sum(sizeof(k, depth-1) + sizeof(v, depth-1) for k,v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item, depth-1) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += sizeof(obj.__dict__, depth-1)
+    return size
+
+
+def footprint(items, sample=64):
+    """
+    (count, approximate bytes) of a list or dict. Only `sample` evenly spaced
+    items are measured, so this stays cheap on a list of a million records.
+    """
+    count = len(items)
+    if count == 0:
+        return 0, sys.getsizeof(items)
+
+    values = list(items.values()) if isinstance(items, dict) else items
+    step = max(1, count // sample)
+    picked = values[::step][:sample]
+    per_item = sum(sizeof(item) for item in picked) / len(picked)
+    return count, int(sys.getsizeof(items) + per_item * count)
+
+
+def process_rss():
+    """Resident set size of this process in bytes, None where unavailable."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryMonitor:
+    """
+    Periodic size readings of the structures that grow with a session.
+    `source` returns {name: (count, bytes)}; every `interval` seconds a
+    reading is kept, next to the first one (the baseline) and the peak of
+    each structure. A structure that has grown by more than `threshold`
+    bytes since the baseline is reported by warnings().
+    """
+
+    def __init__(self, source, interval=30.0, threshold=16*1024*1024, history=120):
+        self.source = source
+        self.interval = interval
+        self.threshold = threshold
+        self.history = deque(maxlen=history)
+        self.baseline = None
+        self.latest = {}
+        self.peaks = {}
+        self.last_sample = None
+
+    def sample(self, force=False):
+        now = time.monotonic()
+        if not force and not self.last_sample is None and \
+           now - self.last_sample < self.interval:
+            return False
+        self.last_sample = now
+
+        stats = dict(self.source())
+        rss = process_rss()
+        if not rss is None:
+            stats["process"] = (1, rss)
+
+        if self.baseline is None:
+            self.baseline = stats
+        for name,(count,size) in stats.items():
+            peak = self.peaks.get(name, (0, 0))
+            self.peaks[name] = (max(peak[0], count), max(peak[1], size))
+        self.latest = stats
+        self.history.append((time.time(), stats))
+        return True
+
+    def growth(self):
+        """{name: bytes gained since the baseline}"""
+        if self.baseline is None:
+            return {}
+        return dict((name, size - self.baseline.get(name, (0, 0))[1]) \
+                    for name,(count,size) in self.latest.items())
+
+    def warnings(self):
+        """(name, bytes gained) of the structures past the threshold."""
+        return [(name, grown) for name,grown in sorted(self.growth().items()) \
+                if grown > self.threshold]
+
+    def trace(self, path=TRACE_OUTPUT, limit=25):
+        """
+        Start tracing allocations; on the next call write the top `limit`
+        allocating lines to `path`, stop tracing and return them.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return None
+
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        top = snapshot.statistics("lineno")[:limit]
+        with open(path, "w") as fh:
+            for stat in top:
+                fh.write("%s\n" % stat)
+        return top
@@ -0,0 +1,137 @@
+import os
+import re
+import mmap
+import struct
+import numpy as np
+
+
+OUI_SOURCE_URL = "https://standards-oui.ieee.org/oui/oui.txt"
+
+DEFAULT_INDEX = os.path.join(os.environ.get("XDG_CACHE_HOME", \
+                                            os.path.expanduser("~/.cache")), \
+                             "btapplet", "oui.idx")
+
+# magic, number of prefixes
+HEADER = struct.Struct("<4sI")
+MAGIC = b"OUI1"
+
+
+def is_locally_administered(mac_addr, address_type=None):
+    """
+    Whether the address has no vendor to look up. bluetoothctl tells LE
+    random addresses (private or static) by `(random)`, whatever their
+    bits; only when the type is unknown is bit 1 of the first octet tested.
+    """
+    if address_type == "random":
+        return True
+    if address_type == "public":
+        return False
+    try:
+        return int(mac_addr[0:2], 16) & 0x02 != 0
+    except ValueError:
+        return False
+
+def mac_prefix(mac_addr):
+    return int(mac_addr.replace(":", "").replace("-", "")[0:6], 16)
+
+
+def parse_oui_text(lines):
+    """Yield (prefix, vendor) from the IEEE oui.txt registry."""
+    hex_regex = re.compile(r"^\s*([0-9A-Fa-f]{2})-([0-9A-Fa-f]{2})-([0-9A-Fa-f]{2})\s+\(hex\)\s+(.*)$")
+    for line in lines:
+        match = hex_regex.match(line)
+        if not match is None:
+            prefix = int("".join(match.groups()[0:3]), 16)
+            yield prefix, match.group(4).strip()
+
+def parse_oui_json(data):
+    """Yield (prefix, vendor) from an OuiLookup data file."""
+    for prefix, vendor in data["vendors"].items():
+        yield int(prefix, 16), vendor
+
+
+def write_index(entries, path):
+    """
+    Layout, all little endian:
+
+      header   magic "OUI1", uint32 count
+      prefixes count x uint32, sorted 24-bit OUIs
+      offsets  (count+1) x uint32 into the blob
+      blob     utf-8 vendor names, back to back
+    """
+    vendors = dict(entries)
+    prefixes = sorted(vendors.keys())
+
+    blob = bytearray()
+    offsets = []
+    for prefix in prefixes:
+        offsets.append(len(blob))
+        blob += vendors[prefix].encode("utf-8")
+    offsets.append(len(blob))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(HEADER.pack(MAGIC, len(prefixes)))
+        fh.write(np.array(prefixes, dtype="<u4").tobytes())
+        fh.write(np.array(offsets, dtype="<u4").tobytes())
+        fh.write(blob)
+    # readers may have the old file mapped, never rewrite it in place
+    os.replace(tmp_path, path)
+    return len(prefixes)
+
+
+class OuiIndex:
+    """
+    Vendor lookup on a compiled OUI index. The file is memory mapped, so
+    opening it parses nothing and the pages are shared between processes.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX):
+        self.path = path
+        with open(path, "rb") as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not an OUI index" % path)
+
+        offset = HEADER.size
+        self.prefixes = np.frombuffer(self.map, dtype="<u4", count=count, offset=offset)
+        offset += 4 * count
+        self.offsets = np.frombuffer(self.map, dtype="<u4", count=count+1, offset=offset)
+        self.blob_start = offset + 4 * (count+1)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def lookup(self, mac_addr):
+        """
+        The vendor registered for the address prefix. Whether the address
+        has a vendor at all is the caller's call, see is_locally_administered.
+        """
+        try:
+            prefix = mac_prefix(mac_addr)
+        except ValueError:
+            return None
+
+        idx = int(np.searchsorted(self.prefixes, prefix))
+        if idx == len(self.prefixes) or self.prefixes[idx] != prefix:
+            return None
+
+        start = self.blob_start + int(self.offsets[idx])
+        end = self.blob_start + int(self.offsets[idx+1])
+        return self.map[start:end].decode("utf-8")
+
+
+_default_index = None
+
+def default_index():
+    """The shared index at DEFAULT_INDEX, None if it has not been built."""
+    global _default_index
+    if _default_index is None and os.path.exists(DEFAULT_INDEX):
+        try:
+            _default_index = OuiIndex(DEFAULT_INDEX)
+        except ValueError as e:
+            print(e)
+    return _default_index
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import threading
+
+
+DEFAULT_OUTPUT = "/tmp/btapplet.folded"
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler that can be switched on inside a running applet,
+    where attaching an external profiler would break the TTY. A background
+    thread snapshots the stacks of the watched threads every `interval`
+    seconds; on stop they are written in collapsed format, one
+    `thread;outer;...;inner count` line per stack, for flamegraph.pl or
+    speedscope.
+    """
+
+    def __init__(self, path=DEFAULT_OUTPUT, interval=0.005, threads=None):
+        self.path = path
+        self.interval = interval
+        # Thread objects to sample, None for every thread
+        self.threads = threads
+        self.thread = None
+        self.finished = threading.Event()
+        self.stacks = {}
+        self.samples = 0
+        self.cost = 0.0
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return not self.thread is None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks = {}
+        self.samples = 0
+        self.cost = 0.0
+        self.started = time.monotonic()
+        self.stopped = None
+        self.finished.clear()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks, returns the path."""
+        if not self.running:
+            return None
+        self.finished.set()
+        self.thread.join()
+        self.stopped = time.monotonic()
+        self.write()
+        return self.path
+
+    def toggle(self):
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def overhead(self):
+        """Fraction of wall time the sampler spent on the CPU."""
+        if self.started is None:
+            return 0.0
+        end = time.monotonic() if self.stopped is None else self.stopped
+        elapsed = end - self.started
+        return self.cost / elapsed if elapsed > 0 else 0.0
+
+    def _label(self, frame):
+        code = frame.f_code
+        return "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.finished.wait(self.interval):
+            start = time.thread_time()
+            if self.threads is None:
+                watched = dict((t.ident, t.name) for t in threading.enumerate())
+            else:
+                watched = dict((t.ident, t.name) for t in self.threads \
+                               if not t.ident is None)
+
+            for ident,frame in sys._current_frames().items():
+                if ident == me or not ident in watched:
+                    continue
+                stack = []
+                while not frame is None:
+                    stack.append(self._label(frame))
+                    frame = frame.f_back
+                stack.append(watched[ident])
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+            self.samples += 1
+            self.cost += time.thread_time() - start
+
+    def write(self):
+        with open(self.path, "w") as fh:
+            for stack,count in sorted(self.stacks.items()):
+                fh.write("%s %d\n" % (stack, count))
@@ -0,0 +1,216 @@
+import os
+import re
+import time
+import threading
+import pexpect
+
+
+ANSI_REGEX = re.compile(r"\x1b[@-_][0-?]*[ -/]*[@-~]")
+# bluetoothctl clears and redraws the prompt with a bare \r
+LINE_SPLIT = re.compile(r"[\r\n]+")
+
+
+class PtyReader(threading.Thread):
+    """
+    Drains a pexpect child's pty on its own thread, so output is read as it
+    is produced instead of whenever some caller happens to be inside
+    expect(). Chunks are read into one reusable bytearray and framed into
+    lines through a memoryview. All complete lines of a chunk are decoded,
+    stripped of ANSI codes and split in one pass each, then handed to
+    `on_line` (the event parser) and appended to the text command waiters
+    match against; nothing downstream parses them again.
+
+    Implements the part of the pexpect interface the model uses: expect()
+    with `before`, `after` and `match`. Lines end with a plain "\\n" and the
+    unfinished last line (usually the prompt) can be matched before its
+    newline arrives.
+    """
+
+    def __init__(self, child, on_line=None, chunk=65536, max_pending=65536):
+        super().__init__(daemon=True)
+        self.child = child
+        self.fd = None if child is None else child.child_fd
+        self.on_line = on_line
+        self.max_pending = max_pending
+
+        self.buf = bytearray(chunk)
+        self.filled = 0
+
+        self.cond = threading.Condition()
+        self.pieces = []
+        self.pending = 0
+        self.tail = ""
+        self.tail_consumed = 0
+        self.eof = False
+        # when output was last read and when the child went away
+        self.last_read = time.monotonic()
+        self.eof_at = None
+        self.patterns = {}
+
+        self.before = ""
+        self.after = None
+        self.match = None
+
+    def run(self):
+        while True:
+            if self.filled == len(self.buf):
+                # a line longer than the buffer, make room for the rest of it
+                self.buf.extend(bytes(len(self.buf)))
+
+            with memoryview(self.buf) as view:
+                try:
+                    n = os.readv(self.fd, [view[self.filled:]])
+                except OSError:
+                    # EIO once the child has exited
+                    n = 0
+
+            if n == 0:
+                with self.cond:
+                    self.eof = True
+                    self.eof_at = time.monotonic()
+                    self.cond.notify_all()
+                return
+
+            self.last_read = time.monotonic()
+            self.filled += n
+            self._frame()
+
+    def _clean(self, data):
+        text = str(data, "utf-8", "replace")
+        if "\x1b" in text:
+            text = ANSI_REGEX.sub("", text)
+        return text
+
+    def feed(self, data):
+        """Frame bytes as if read from the pty, for tools without a child."""
+        end = self.filled + len(data)
+        if end > len(self.buf):
+            self.buf.extend(bytes(end - len(self.buf)))
+        self.buf[self.filled:end] = data
+        self.filled = end
+        self._frame()
+
+    def _frame(self):
+        # escape sequences never span a line end, so the complete lines are
+        # cleaned as one block and split afterwards
+        end = max(self.buf.rfind(b"\n", 0, self.filled), \
+                  self.buf.rfind(b"\r", 0, self.filled)) + 1
+        with memoryview(self.buf) as view:
+            text = self._clean(view[0:end]) if end > 0 else ""
+            tail = self._clean(view[end:self.filled])
+            rest = bytes(view[end:self.filled])
+        lines = LINE_SPLIT.split(text)
+        if len(lines) > 0 and lines[-1] == "":
+            lines.pop()
+
+        self.buf[0:len(rest)] = rest
+        self.filled = len(rest)
+
+        # an escape sequence split across reads is matched once it is whole
+        if "\x1b" in tail:
+            tail = tail[:tail.index("\x1b")]
+
+        # parsed before waiters wake, so they see the state the lines describe
+        if not self.on_line is None:
+            for line in lines:
+                if line.strip() != "":
+                    self.on_line(line)
+
+        with self.cond:
+            for line in lines:
+                # the unfinished line was matchable already, skip what was consumed
+                skip, self.tail_consumed = self.tail_consumed, 0
+                if line.strip() == "":
+                    continue
+                self.pieces.append(line[skip:] + "\n")
+                self.pending += len(line) - skip + 1
+            self.tail = tail
+
+            if self.pending > self.max_pending:
+                # nobody waited for it, keep the newest lines only
+                text = "".join(self.pieces)
+                cut = text.find("\n", len(text) - self.max_pending)
+                self.pieces = [text[cut+1:]]
+                self.pending = len(self.pieces[0])
+            self.cond.notify_all()
+
+    def _compile(self, pattern):
+        if not isinstance(pattern, str):
+            return pattern
+        if not pattern in self.patterns:
+            self.patterns[pattern] = re.compile(pattern, re.DOTALL)
+        return self.patterns[pattern]
+
+    def _consume(self, text, end):
+        unfinished = len(self.tail) - self.tail_consumed
+        finished = len(text) - unfinished
+        if end <= finished:
+            self.pieces = [text[end:finished]]
+            self.pending = finished - end
+        else:
+            self.pieces = []
+            self.pending = 0
+            self.tail_consumed += end - finished
+
+    def drain(self, unfinished=True):
+        """
+        Drop what was read and not matched yet, so expect() only sees what
+        follows. With unfinished=False the line still being read is kept.
+        """
+        with self.cond:
+            finished = "".join(self.pieces)
+            text = finished + self.tail[self.tail_consumed:]
+            end = len(text) if unfinished else len(finished)
+            self._consume(text, end)
+            return text[:end]
+
+    def expect(self, patterns, timeout=-1):
+        """Like pexpect's expect(), patterns may include pexpect.EOF/TIMEOUT."""
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+        if timeout == -1:
+            timeout = 30 if self.child is None else self.child.timeout
+
+        regexes = [(idx, self._compile(pattern)) for idx,pattern in enumerate(patterns) \
+                   if not pattern in [pexpect.EOF, pexpect.TIMEOUT]]
+        eof_index = patterns.index(pexpect.EOF) if pexpect.EOF in patterns else None
+        timeout_index = patterns.index(pexpect.TIMEOUT) if pexpect.TIMEOUT in patterns else None
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.cond:
+            while True:
+                text = "".join(self.pieces) + self.tail[self.tail_consumed:]
+                best = None
+                for idx,regex in regexes:
+                    match = regex.search(text)
+                    if not match is None and \
+                       (best is None or match.start() < best[1].start()):
+                        best = (idx, match)
+
+                if not best is None:
+                    idx,match = best
+                    self.before = text[:match.start()]
+                    self.after = match.group(0)
+                    self.match = match
+                    self._consume(text, match.end())
+                    return idx
+
+                if self.eof:
+                    self.before = text
+                    self.after = pexpect.EOF
+                    self.match = None
+                    self._consume(text, len(text))
+                    if eof_index is None:
+                        raise pexpect.EOF("End of file on the bluetoothctl pty")
+                    return eof_index
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not remaining is None and remaining <= 0:
+                    self.before = text
+                    self.after = pexpect.TIMEOUT
+                    self.match = None
+                    if timeout_index is None:
+                        raise pexpect.TIMEOUT("Timeout exceeded")
+                    return timeout_index
+
+                self.cond.wait(remaining)
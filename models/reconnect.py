@@ -0,0 +1,117 @@
+import time
+import threading
+
+from models.actions import Action
+
+
+class ReconnectManager:
+    """
+    Reconnects trusted devices that drop off, e.g. after suspend/resume or a
+    controller power cycle. Connects go through the shared ActionQueue, so
+    they run concurrently with (and never collide with) user actions; at
+    most `max_in_flight` reconnects are pending at a time and failed ones are
+    retried with exponential backoff.
+    """
+
+    def __init__(self, actions, max_in_flight=2, base_delay=2.0, max_delay=300.0, \
+                 max_attempts=8):
+        self.actions = actions
+        self.max_in_flight = max_in_flight
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.lock = threading.Lock()
+        # devices seen connected this session, i.e. worth reconnecting
+        self.known = set()
+        self.connected = {}
+        self.powered = None
+        # mac -> {"lost": t, "attempts": n, "next": t, "action": Action}
+        self.pending = {}
+        self.reconnect_times = {}
+
+    def forget(self, mac_addr):
+        """The user disconnected or removed the device, leave it alone."""
+        with self.lock:
+            self.known.discard(mac_addr)
+            self.pending.pop(mac_addr, None)
+
+    def _schedule(self, mac_addr, now):
+        if not mac_addr in self.pending:
+            self.pending[mac_addr] = {"lost": now, \
+                                      "attempts": 0, \
+                                      "next": now, \
+                                      "action": None}
+
+    def update(self, devices, controller):
+        """Feed the current device table, start or retry reconnects."""
+        now = time.time()
+        with self.lock:
+            powered = controller.get("powered")
+            came_back = self.powered is False and powered is True
+            self.powered = powered
+
+            for dev in devices:
+                mac = dev["mac_addr"]
+                was_connected = self.connected.get(mac, False)
+                self.connected[mac] = dev["connected"]
+
+                if dev["connected"]:
+                    self.known.add(mac)
+                    if mac in self.pending:
+                        self._reconnected(mac, now)
+                    continue
+
+                if not (dev["trusted"] and dev["paired"] and mac in self.known):
+                    continue
+                if was_connected or came_back:
+                    self._schedule(mac, now)
+
+            if powered is False:
+                return
+            self._retry(now)
+
+    def _reconnected(self, mac_addr, now):
+        entry = self.pending.pop(mac_addr)
+        self.reconnect_times.setdefault(mac_addr, []).append(now - entry["lost"])
+
+    def _retry(self, now):
+        in_flight = 0
+        for mac, entry in list(self.pending.items()):
+            action = entry["action"]
+            if not action is None and action.pending:
+                in_flight += 1
+                continue
+
+            # done while the table still shows it disconnected did not work either
+            if not action is None:
+                entry["action"] = None
+                entry["attempts"] += 1
+                if entry["attempts"] >= self.max_attempts:
+                    del self.pending[mac]
+                    continue
+                delay = min(self.max_delay, self.base_delay * 2 ** entry["attempts"])
+                entry["next"] = now + delay
+
+        for mac, entry in self.pending.items():
+            if in_flight >= self.max_in_flight:
+                break
+            if not entry["action"] is None or entry["next"] > now:
+                continue
+
+            action = self.actions.submit(Action.Kind.CONNECT, mac)
+            if not action is None:
+                entry["action"] = action
+                in_flight += 1
+
+    def get_status(self):
+        """(mac, attempts, seconds until the next try) of pending reconnects."""
+        now = time.time()
+        with self.lock:
+            return [(mac, entry["attempts"], max(0.0, entry["next"] - now)) \
+                    for mac, entry in self.pending.items()]
+
+    def get_stats(self):
+        """Time-to-reconnect samples per device, in seconds."""
+        with self.lock:
+            return dict((mac, list(times)) for mac, times in self.reconnect_times.items())
@@ -0,0 +1,121 @@
+import time
+import threading
+
+
+class ScanProfile:
+    """
+    Discovery filter pushed down to BlueZ through the bluetoothctl
+    `menu scan` settings, optionally with a duty cycle: scan for `on_time`
+    seconds, rest for `off_time` seconds.
+    """
+
+    def __init__(self, name, transport=None, rssi=None, duplicate_data=None, \
+                 uuids=None, on_time=None, off_time=None):
+        self.name = name
+        self.transport = transport
+        self.rssi = rssi
+        self.duplicate_data = duplicate_data
+        self.uuids = uuids or []
+        self.on_time = on_time
+        self.off_time = off_time
+
+    @property
+    def duty_cycled(self):
+        return not self.on_time is None and not self.off_time is None
+
+    def commands(self):
+        """Commands to run inside `menu scan`, starting from a clean filter."""
+        cmds = ["clear"]
+        if not self.transport is None:
+            cmds.append("transport %s" % self.transport)
+        if not self.rssi is None:
+            cmds.append("rssi %d" % self.rssi)
+        if not self.duplicate_data is None:
+            cmds.append("duplicate-data %s" % ("on" if self.duplicate_data else "off"))
+        if len(self.uuids) > 0:
+            cmds.append("uuids %s" % " ".join(self.uuids))
+        return cmds
+
+
+PROFILES = {
+    # whatever BlueZ reports, every advertiser and every RSSI wiggle
+    "all": ScanProfile("all"),
+    "le": ScanProfile("le", transport="le", duplicate_data=False),
+    "nearby": ScanProfile("nearby", rssi=-70, duplicate_data=False),
+    "audio": ScanProfile("audio", duplicate_data=False, \
+                         uuids=["0000110b-0000-1000-8000-00805f9b34fb", \
+                                "0000111e-0000-1000-8000-00805f9b34fb"]),
+    "input": ScanProfile("input", duplicate_data=False, \
+                         uuids=["00001124-0000-1000-8000-00805f9b34fb", \
+                                "00001812-0000-1000-8000-00805f9b34fb"]),
+    "low-power": ScanProfile("low-power", transport="le", rssi=-80, \
+                             duplicate_data=False, on_time=10.0, off_time=20.0)
+}
+
+PROFILE_ORDER = ["all", "le", "nearby", "audio", "input", "low-power"]
+
+
+class ScanStats:
+    """
+    Device events ingested per scan profile. `rate` is the recent event
+    rate, `get` the average over all the time each profile was scanning
+    (duty cycle rests included), to compare profiles against each other.
+    """
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.profile = None
+        self.started = None
+        self.totals = {}
+        self.recent = []
+
+    def start(self, profile, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._close(now)
+            self.profile = profile
+            self.started = now
+
+    def stop(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._close(now)
+            self.profile = None
+
+    def _close(self, now):
+        if self.profile is None or self.started is None:
+            return
+        total = self.totals.setdefault(self.profile, {"events": 0, "seconds": 0.0})
+        total["seconds"] += now - self.started
+        self.started = None
+
+    def add(self, count, now=None):
+        if count == 0 or self.profile is None:
+            return
+        now = time.time() if now is None else now
+        with self.lock:
+            total = self.totals.setdefault(self.profile, {"events": 0, "seconds": 0.0})
+            total["events"] += count
+            self.recent.append((now, count))
+
+    def rate(self, now=None):
+        """Events per second over the last `window` seconds."""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.recent = [(t, n) for t, n in self.recent if t >= now - self.window]
+            return sum(n for t, n in self.recent) / self.window
+
+    def get(self, now=None):
+        """{profile: {"events": n, "seconds": t, "rate": n/t}}"""
+        now = time.time() if now is None else now
+        with self.lock:
+            stats = {}
+            for name, total in self.totals.items():
+                seconds = total["seconds"]
+                if name == self.profile and not self.started is None:
+                    seconds += now - self.started
+                stats[name] = {"events": total["events"], \
+                               "seconds": seconds, \
+                               "rate": total["events"] / seconds if seconds > 0 else 0.0}
+            return stats
@@ -0,0 +1,90 @@
+import threading
+
+
+class DeviceIndex:
+    """
+    Substring index over device names, vendors and MAC addresses. Every
+    1-, 2- and 3-gram of a device's text maps to the set of devices that
+    contain it; entries are updated incrementally when a device is declared
+    or renamed. A query intersects the posting sets of its grams, starting
+    from the smallest, and a query that extends the previous one only
+    re-checks the previous matches.
+    """
+
+    GRAM = 3
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.grams = {}
+        self.texts = {}
+        self.last_query = None
+        self.last_matches = None
+
+    def _grams(self, text):
+        grams = set()
+        for n in range(1, DeviceIndex.GRAM+1):
+            for i in range(len(text) - n + 1):
+                grams.add(text[i:i+n])
+        return grams
+
+    def update(self, mac_addr, name, vendor=None):
+        text = ("%s %s %s %s" % (name or "", vendor or "", mac_addr, \
+                                 mac_addr.replace(":", ""))).lower()
+        with self.lock:
+            old = self.texts.get(mac_addr)
+            if old == text:
+                return
+
+            old_grams = set() if old is None else self._grams(old)
+            new_grams = self._grams(text)
+            for gram in old_grams - new_grams:
+                postings = self.grams[gram]
+                postings.discard(mac_addr)
+                if len(postings) == 0:
+                    del self.grams[gram]
+            for gram in new_grams - old_grams:
+                self.grams.setdefault(gram, set()).add(mac_addr)
+
+            self.texts[mac_addr] = text
+            self.last_query = None
+
+    def remove(self, mac_addr):
+        with self.lock:
+            text = self.texts.pop(mac_addr, None)
+            if text is None:
+                return
+            for gram in self._grams(text):
+                postings = self.grams[gram]
+                postings.discard(mac_addr)
+                if len(postings) == 0:
+                    del self.grams[gram]
+            self.last_query = None
+
+    def search(self, query):
+        """Set of mac addresses whose name, vendor or address contain query."""
+        query = query.lower()
+        with self.lock:
+            if query == "":
+                matches = set(self.texts.keys())
+
+            elif not self.last_query is None and \
+                 query.startswith(self.last_query) and \
+                 self.last_query != "":
+                # typing one more character can only narrow the last result
+                matches = set(mac for mac in self.last_matches \
+                              if query in self.texts[mac])
+
+            else:
+                n = min(len(query), DeviceIndex.GRAM)
+                postings = [self.grams.get(query[i:i+n], set()) \
+                            for i in range(len(query) - n + 1)]
+                postings.sort(key=len)
+                matches = set(postings[0])
+                for other in postings[1:]:
+                    matches &= other
+                if len(query) > DeviceIndex.GRAM:
+                    matches = set(mac for mac in matches if query in self.texts[mac])
+
+            self.last_query = query
+            self.last_matches = matches
+            return set(matches)
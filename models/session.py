@@ -0,0 +1,181 @@
+import re
+import time
+import queue
+import itertools
+import threading
+import pexpect
+
+from models.ptyreader import PtyReader
+
+
+# what bluetoothctl prints in front of every line it draws the prompt on
+PROMPT_PREFIX = re.compile(r"^\[[A-Z\-a-z0-9 ]+\]# ?")
+EVENT_PREFIX = re.compile(r"^\[(CHG|NEW|DEL)\]")
+
+
+class SessionStats:
+    """Commands run on one bluetoothctl session, how many failed and how long they took."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.failures = 0
+        self.total = 0.0
+        self.slowest = 0.0
+
+    def add(self, elapsed, ok=True):
+        with self.lock:
+            self.commands += 1
+            if not ok:
+                self.failures += 1
+            self.total += elapsed
+            self.slowest = max(self.slowest, elapsed)
+
+    def get(self):
+        with self.lock:
+            mean = self.total / self.commands if self.commands > 0 else 0.0
+            return {"commands": self.commands, \
+                    "failures": self.failures, \
+                    "mean_ms": 1000 * mean, \
+                    "max_ms": 1000 * self.slowest}
+
+
+class QuerySession:
+    """
+    A bluetoothctl child that never scans, for commands with a reply:
+    `info`, `devices`, `paired-devices`. Each command is followed by a
+    marker command bluetoothctl rejects, so the reply is whatever comes
+    between the command and the rejection, without guessing from prompts
+    and timeouts. Event lines are dropped from the reply.
+    """
+
+    markers = itertools.count(1)
+
+    def __init__(self, command, controller=None, timeout=2.0):
+        self.command = command
+        self.controller = controller
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stats = SessionStats()
+        self.restarts = 0
+        self._spawn()
+
+    def _spawn(self):
+        self.child = pexpect.spawn(self.command, encoding="utf-8", echo=True)
+        # the marker tells when the reply is complete, no need to pace input
+        self.child.delaybeforesend = None
+        self.reader = PtyReader(self.child)
+        self.reader.start()
+        self.selected = None
+        # queries in a row that got no reply
+        self.failures = 0
+
+    @property
+    def healthy(self):
+        return not self.reader.eof and self.child.isalive() and self.failures < 3
+
+    def restart(self):
+        with self.lock:
+            self.child.close(force=True)
+            self._spawn()
+            self.restarts += 1
+
+    def query(self, command):
+        """Lines of the reply, None if the session did not answer in time."""
+        with self.lock:
+            if self.selected != self.controller and not self.controller is None:
+                if self._run("select " + self.controller) is None:
+                    return None
+                self.selected = self.controller
+            return self._run(command)
+
+    def select(self, controller):
+        with self.lock:
+            self.controller = controller
+
+    def _run(self, command):
+        start = time.perf_counter()
+        marker = "marker-%d" % next(QuerySession.markers)
+        try:
+            self.child.send(command + "\n" + marker + "\n")
+            # marker-2 must not be taken for the rejection of marker-20
+            res = self.reader.expect(["Invalid command[^\n]*" + re.escape(marker) + r"\b", \
+                                      pexpect.EOF, pexpect.TIMEOUT], \
+                                     timeout=self.timeout)
+        except OSError:
+            res = 1
+        if res != 0:
+            self.stats.add(time.perf_counter() - start, ok=False)
+            self.failures += 1
+            return None
+        self.failures = 0
+
+        before = self.reader.before.split("\n")
+        # a late reply to a query that timed out ends in the rejection of its
+        # own marker, only what follows the last one answers this query
+        rejected = [idx for idx,line in enumerate(before) if "Invalid command" in line]
+        if len(rejected) > 0:
+            before = before[rejected[-1]+1:]
+
+        lines = []
+        for line in before:
+            line = PROMPT_PREFIX.sub("", line)
+            if line.strip() in ["", command] or "marker-" in line or \
+               not EVENT_PREFIX.match(line) is None:
+                continue
+            lines.append(line)
+        self.stats.add(time.perf_counter() - start)
+        return lines
+
+    def close(self):
+        self.child.close()
+
+
+class QueryPool:
+    """
+    Quiet bluetoothctl sessions next to the one that scans, so a query
+    neither waits for nor has to be fished out of the event stream. A query
+    takes whichever session is idle; sessions that died are left out.
+    """
+
+    def __init__(self, command, size=1, controller=None):
+        self.sessions = [QuerySession(command, controller) for _ in range(size)]
+        self.idle = queue.Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+
+    @property
+    def healthy(self):
+        return any(session.healthy for session in self.sessions)
+
+    def query(self, command):
+        """Reply lines, None if no session could answer."""
+        for _ in range(len(self.sessions)):
+            session = self.idle.get()
+            try:
+                if session.healthy:
+                    return session.query(command)
+            finally:
+                self.idle.put(session)
+        return None
+
+    def select(self, controller):
+        for session in self.sessions:
+            session.select(controller)
+
+    def restart_failed(self):
+        """Replace the children of sessions that exited or stopped answering."""
+        for session in self.sessions:
+            if not session.healthy:
+                session.restart()
+
+    def get_stats(self):
+        stats = {}
+        for idx,session in enumerate(self.sessions):
+            stats["query%d" % idx] = dict(session.stats.get(), healthy=session.healthy, \
+                                          restarts=session.restarts)
+        return stats
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
@@ -0,0 +1,333 @@
+import os
+import mmap
+import time
+import atexit
+import struct
+import threading
+import numpy as np
+
+
+DEFAULT_LOG = os.path.join(os.environ.get("XDG_DATA_HOME", \
+                                          os.path.expanduser("~/.local/share")), \
+                           "btapplet", "sightings.log")
+
+# one sighting, little endian and fixed width so the file can be mapped as an array
+RECORD = np.dtype([("time", "<f8"), \
+                   ("mac", "<u8"), \
+                   ("rssi", "i1"), \
+                   ("tx_power", "i1"), \
+                   ("event", "u1"), \
+                   ("reserved", "V5")])
+
+# magic, record size, padded to one record so the records stay aligned
+HEADER = struct.Struct("<4sI16x")
+MAGIC = b"SIG1"
+
+# what HCI reports for an RSSI or tx power that is not available
+NO_VALUE = 127
+
+# the log and its older segment together stay below this
+MAX_LOG_BYTES = 64 * 1024 * 1024
+
+EVENT_NEW = 1
+EVENT_RSSI = 2
+EVENT_TX_POWER = 3
+EVENT_CHANGE = 4
+EVENT_DEL = 5
+EVENT_NAMES = {EVENT_NEW: "new", EVENT_RSSI: "rssi", EVENT_TX_POWER: "tx_power", \
+               EVENT_CHANGE: "change", EVENT_DEL: "del"}
+
+
+def mac_to_int(mac_addr):
+    return int(mac_addr.replace(":", "").replace("-", ""), 16)
+
+def int_to_mac(value):
+    text = "%012X" % int(value)
+    return ":".join(text[idx:idx+2] for idx in range(0, 12, 2))
+
+def clamp_dbm(value):
+    if value is None or value == -1 or value < -128 or value > 126:
+        return NO_VALUE
+    return value
+
+
+class SightingLog:
+    """
+    Appends sightings to the binary log. add() fills a preallocated record
+    buffer, flush() writes what piled up with one write() on an O_APPEND
+    descriptor, so sessions of several adapters can share the file. The
+    ingestion pass flushes once `flush_interval` seconds passed or the
+    buffer is full; the rest is written on exit. Once the file holds half
+    of `max_bytes` it is renamed to `path + ".1"`, unlinking the segment
+    there, and a new one is started; nothing is ever rewritten (None
+    keeps everything in one file).
+    """
+
+    def __init__(self, path=DEFAULT_LOG, batch=4096, flush_interval=5.0, \
+                 max_bytes=MAX_LOG_BYTES):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.buffer = np.zeros(batch, dtype=RECORD)
+        self.count = 0
+        self.written = 0
+        self.writes = 0
+        self.rotations = 0
+        self.last_flush = time.monotonic()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fd = None
+        self._open()
+        atexit.register(self.close)
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size == 0:
+            os.write(self.fd, HEADER.pack(MAGIC, RECORD.itemsize))
+        elif size < HEADER.size or (size - HEADER.size) % RECORD.itemsize != 0:
+            # a write cut short by a crash, drop the partial record
+            os.ftruncate(self.fd, max(HEADER.size, size - \
+                                      (size - HEADER.size) % RECORD.itemsize))
+
+    def add(self, created, mac, event, rssi=None, tx_power=None):
+        try:
+            mac = mac_to_int(mac)
+        except ValueError:
+            return
+        with self.lock:
+            if self.count == len(self.buffer):
+                self._write()
+            self.buffer[self.count] = (created, mac, clamp_dbm(rssi), \
+                                       clamp_dbm(tx_power), event, b"")
+            self.count += 1
+
+    def flush(self, force=False):
+        with self.lock:
+            if force or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._write()
+
+    def _write(self):
+        self.last_flush = time.monotonic()
+        if self.count == 0 or self.fd is None:
+            return
+        batch = self.buffer[:self.count]
+        # adapters add their passes in turns, keep the file in time order
+        batch = batch[np.argsort(batch["time"], kind="stable")]
+        try:
+            self._reopen_if_replaced()
+            os.write(self.fd, batch.tobytes())
+            if not self.max_bytes is None and \
+               os.fstat(self.fd).st_size >= self.max_bytes // 2:
+                self._rotate()
+        except OSError as e:
+            print(e)
+        else:
+            self.written += self.count
+            self.writes += 1
+        self.count = 0
+
+    def _reopen_if_replaced(self):
+        # another process (the daemon next to a standalone applet) rotated it
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self.fd).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            os.close(self.fd)
+            self._open()
+
+    def _rotate(self):
+        """The full segment becomes the older one, the oldest goes."""
+        os.replace(self.path, self.path + ".1")
+        os.close(self.fd)
+        self._open()
+        self.rotations += 1
+
+    def close(self):
+        with self.lock:
+            self._write()
+            if not self.fd is None:
+                os.close(self.fd)
+                self.fd = None
+
+    def get_stats(self):
+        with self.lock:
+            return {"written": self.written, "writes": self.writes, \
+                    "pending": self.count, "rotations": self.rotations}
+
+
+_open_logs = {}
+_open_logs_lock = threading.Lock()
+
+def open_log(path=DEFAULT_LOG):
+    """The SightingLog of this process for `path`, shared by all adapters."""
+    with _open_logs_lock:
+        if not path in _open_logs:
+            _open_logs[path] = SightingLog(path)
+        return _open_logs[path]
+
+
+class _Segment:
+    """One memory mapped segment file of the log."""
+
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+
+    def reset(self):
+        self.map = None
+        self.inode = None
+        self.records = np.zeros(0, dtype=RECORD)
+        # whether the timestamps never go back, then time ranges are bisected
+        self.ordered = True
+
+    def refresh(self):
+        with open(self.path, "rb") as fh:
+            stat = os.fstat(fh.fileno())
+            if stat.st_size < HEADER.size:
+                raise ValueError("%s is not a sighting log" % self.path)
+            if stat.st_ino != self.inode:
+                # rotated, nothing carries over from the old file
+                self.reset()
+            elif not self.map is None and stat.st_size == len(self.map):
+                return
+            new_map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, record_size = HEADER.unpack_from(new_map, 0)
+        if magic != MAGIC or record_size != RECORD.itemsize:
+            new_map.close()
+            raise ValueError("%s is not a sighting log" % self.path)
+
+        count = (len(new_map) - HEADER.size) // RECORD.itemsize
+        records = np.frombuffer(new_map, dtype=RECORD, count=count, offset=HEADER.size)
+
+        # only the appended records have to be checked for order
+        start = len(self.records)
+        times = records["time"][max(start-1, 0):]
+        self.ordered = self.ordered and bool(np.all(times[1:] >= times[:-1]))
+        # arrays handed out keep the old map alive, it goes with the last of them
+        self.map = new_map
+        self.inode = stat.st_ino
+        self.records = records
+
+    def between(self, start, end):
+        """The records that may fall in [start, end), a view when ordered."""
+        if not self.ordered:
+            return self.records
+        times = self.records["time"]
+        lo = 0 if start is None else int(np.searchsorted(times, start, side="left"))
+        hi = len(times) if end is None else int(np.searchsorted(times, end, side="left"))
+        return self.records[lo:hi]
+
+
+class SightingHistory:
+    """
+    Queries on the sighting log, its older segment (`path + ".1"`) first.
+    The files are memory mapped and the records are numpy views of them,
+    so a query is a few vectorized passes over the columns and nothing is
+    turned into Python objects until it is returned. refresh() maps what
+    was appended or rotated since. Results are structured arrays with the
+    RECORD fields.
+    """
+
+    def __init__(self, path=DEFAULT_LOG):
+        self.path = path
+        self.segments = [_Segment(path + ".1"), _Segment(path)]
+        self.refresh()
+
+    def refresh(self):
+        for segment in self.segments:
+            if os.path.exists(segment.path) or segment.path == self.path:
+                segment.refresh()
+            else:
+                segment.reset()
+
+    @property
+    def ordered(self):
+        older, current = self.segments
+        if not (older.ordered and current.ordered):
+            return False
+        return len(older.records) == 0 or len(current.records) == 0 or \
+            older.records["time"][-1] <= current.records["time"][0]
+
+    @property
+    def records(self):
+        """Every record, copied when there are two segments."""
+        return self.between()
+
+    def __len__(self):
+        return sum(len(segment.records) for segment in self.segments)
+
+    def between(self, start=None, end=None, event=None):
+        """Sightings with start <= time < end (seconds since the epoch)."""
+        parts = [segment.between(start, end) for segment in self.segments]
+        parts = [part for part in parts if len(part) > 0]
+        if len(parts) == 0:
+            return np.zeros(0, dtype=RECORD)
+        records = parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+        mask = None
+        if not self.ordered:
+            if not start is None:
+                mask = records["time"] >= start
+            if not end is None:
+                mask = (records["time"] < end) if mask is None else \
+                    mask & (records["time"] < end)
+        if not event is None:
+            mask = (records["event"] == event) if mask is None else \
+                mask & (records["event"] == event)
+        return records if mask is None else records[mask]
+
+    def device(self, mac_addr, start=None, end=None):
+        """Sightings of one device, optionally in a time range."""
+        records = self.between(start, end)
+        return records[records["mac"] == mac_to_int(mac_addr)]
+
+    def last_seen(self, mac_addr, chunk=65536):
+        """
+        The last sighting of a device, None if it was never seen. Scans
+        backwards a chunk at a time, newest segment first, so a recent
+        device is found without touching most of the log.
+        """
+        mac = mac_to_int(mac_addr)
+        for segment in reversed(self.segments):
+            macs = segment.records["mac"]
+            end = len(macs)
+            while end > 0:
+                start = max(end - chunk, 0)
+                hits = np.flatnonzero(macs[start:end] == mac)
+                if len(hits) > 0:
+                    return segment.records[start + hits[-1]]
+                end = start
+        return None
+
+    def devices(self, start=None, end=None):
+        """
+        Per device in a time range: (mac, sightings, first seen, last seen,
+        strongest RSSI), strongest first.
+        """
+        records = self.between(start, end)
+        if len(records) == 0:
+            return []
+        # grouped by device in one sort
+        order = np.argsort(records["mac"])
+        macs = records["mac"][order]
+        starts = np.flatnonzero(np.r_[True, macs[1:] != macs[:-1]])
+        counts = np.diff(np.r_[starts, len(macs)])
+        times = records["time"][order]
+        first = np.minimum.reduceat(times, starts)
+        last = np.maximum.reduceat(times, starts)
+        rssi = records["rssi"][order].astype(np.int16)
+        rssi[rssi == NO_VALUE] = -128
+        strongest = np.maximum.reduceat(rssi, starts)
+
+        ranked = np.argsort(-strongest, kind="stable")
+        return [(int_to_mac(macs[starts[idx]]), int(counts[idx]), float(first[idx]), \
+                 float(last[idx]), None if strongest[idx] == -128 else int(strongest[idx])) \
+                for idx in ranked]
+
+    def close(self):
+        for segment in self.segments:
+            segment.reset()
@@ -0,0 +1,147 @@
+import time
+import numpy as np
+
+
+class SignalHistory:
+    """
+    Recent RSSI samples of every device, kept in one preallocated 2-D ring
+    buffer (a row per device, a column per sample) next to the last TxPower.
+    Smoothed RSSI, trend and estimated distance are computed for all devices
+    in a single vectorized pass.
+    """
+
+    # RSSI at 1m when the device does not advertise its TxPower
+    DEFAULT_MEASURED_POWER = -59.0
+    # free space is 2, indoors is usually a bit worse
+    PATH_LOSS_EXPONENT = 2.5
+    # seconds the samples have to span before their slope means anything
+    MIN_TREND_SPAN = 2.0
+
+    def __init__(self, capacity=128, samples=32, half_life=5.0, window=30.0):
+        self.samples = samples
+        self.decay = np.log(2) / half_life
+        self.window = window
+
+        self.rows = {}
+        # rows of removed devices, handed out again before the array grows
+        self.free = []
+        # rows ever handed out, the vectorized pass covers these
+        self.used = 0
+        self.rssi = np.full((capacity, samples), np.nan, dtype=np.float32)
+        self.times = np.zeros((capacity, samples), dtype=np.float64)
+        self.heads = np.zeros(capacity, dtype=np.int64)
+        self.tx_power = np.full(capacity, np.nan, dtype=np.float32)
+
+        self.smoothed = np.full(capacity, np.nan, dtype=np.float32)
+        self.trend = np.zeros(capacity, dtype=np.float32)
+        self.distance = np.full(capacity, np.nan, dtype=np.float32)
+
+    @property
+    def capacity(self):
+        return self.rssi.shape[0]
+
+    def _grow(self):
+        n = self.capacity
+        def extend(arr, fill):
+            pad = np.full((n,) + arr.shape[1:], fill, dtype=arr.dtype)
+            return np.concatenate([arr, pad])
+
+        self.rssi = extend(self.rssi, np.nan)
+        self.times = extend(self.times, 0)
+        self.heads = extend(self.heads, 0)
+        self.tx_power = extend(self.tx_power, np.nan)
+        self.smoothed = extend(self.smoothed, np.nan)
+        self.trend = extend(self.trend, 0)
+        self.distance = extend(self.distance, np.nan)
+
+    def row(self, mac_addr):
+        if not mac_addr in self.rows:
+            if len(self.free) > 0:
+                self.rows[mac_addr] = self.free.pop()
+            else:
+                if self.used == self.capacity:
+                    self._grow()
+                self.rows[mac_addr] = self.used
+                self.used += 1
+        return self.rows[mac_addr]
+
+    def remove(self, mac_addr):
+        """Forget a device, its row is cleared and reused by the next one."""
+        r = self.rows.pop(mac_addr, None)
+        if r is None:
+            return
+        self.rssi[r] = np.nan
+        self.times[r] = 0
+        self.heads[r] = 0
+        self.tx_power[r] = np.nan
+        self.smoothed[r] = np.nan
+        self.trend[r] = 0
+        self.distance[r] = np.nan
+        self.free.append(r)
+
+    def add_rssi(self, mac_addr, value, timestamp=None):
+        r = self.row(mac_addr)
+        h = self.heads[r]
+        self.rssi[r, h] = value
+        self.times[r, h] = time.time() if timestamp is None else timestamp
+        self.heads[r] = (h + 1) % self.samples
+
+    def set_tx_power(self, mac_addr, value):
+        self.tx_power[self.row(mac_addr)] = value
+
+    def update(self, now=None):
+        """Recompute smoothed RSSI, trend and distance of every device."""
+        if now is None:
+            now = time.time()
+
+        n = self.used
+        rssi = self.rssi[:n]
+        age = now - self.times[:n]
+        valid = ~np.isnan(rssi) & (age <= self.window)
+
+        # exponentially decaying weights, newer samples count more
+        weights = np.where(valid, np.exp(-self.decay * age), 0.0)
+        total = weights.sum(axis=1)
+        has_samples = total > 0
+        safe_total = np.where(has_samples, total, 1.0)
+        values = np.where(valid, rssi, 0.0)
+
+        mean = (weights * values).sum(axis=1) / safe_total
+        self.smoothed[:n] = np.where(has_samples, mean, np.nan)
+
+        # weighted least squares slope in dB per second, positive is closer
+        t_mean = (weights * -age).sum(axis=1) / safe_total
+        dt = np.where(valid, -age - t_mean[:, None], 0.0)
+        dr = np.where(valid, values - mean[:, None], 0.0)
+        var = (weights * dt * dt).sum(axis=1)
+        cov = (weights * dt * dr).sum(axis=1)
+        span = np.where(valid, age, -np.inf).max(axis=1, initial=-np.inf) - \
+               np.where(valid, age, np.inf).min(axis=1, initial=np.inf)
+        self.trend[:n] = np.where((var > 0) & (span >= SignalHistory.MIN_TREND_SPAN), \
+                                  cov / np.where(var > 0, var, 1.0), 0.0)
+
+        # log-distance path loss model, TxPower is the power at 0m, -41dB at 1m
+        measured = np.where(np.isnan(self.tx_power[:n]), \
+                            SignalHistory.DEFAULT_MEASURED_POWER, \
+                            self.tx_power[:n] - 41.0)
+        exponent = (measured - self.smoothed[:n]) / \
+                   (10.0 * SignalHistory.PATH_LOSS_EXPONENT)
+        self.distance[:n] = np.power(10.0, exponent)
+
+    def get(self, mac_addr):
+        if not mac_addr in self.rows:
+            return None, 0.0, None
+
+        r = self.rows[mac_addr]
+        if np.isnan(self.smoothed[r]):
+            return None, 0.0, None
+        return float(self.smoothed[r]), float(self.trend[r]), float(self.distance[r])
+
+
+def sort_by_proximity(devices):
+    """Nearest (strongest smoothed RSSI) first, devices without signal last."""
+    strength = np.array([dev["rssi_smoothed"] if not dev["rssi_smoothed"] is None \
+                         else -np.inf for dev in devices], dtype=np.float64)
+    # stable, so equally strong devices keep their current order
+    indices = np.argsort(-strength, kind="stable")
+    return [devices[idx] for idx in indices]
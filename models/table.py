@@ -0,0 +1,101 @@
+from collections.abc import Mapping
+
+
+class DeviceTable(Mapping):
+    """
+    The device table at one point in time: mac -> read-only record. Neither
+    the table nor its records ever change, so readers on any thread use it
+    without locks or copies; the session publishes a new table after each
+    ingestion pass with updated(), which costs the records that changed,
+    not the size of the table. The sorted order and the plain map used for
+    iteration are computed once, by the first reader asking for them.
+    """
+
+    def __init__(self, records, version, sort, layers=None, size=None):
+        # (records, removed macs), oldest first; the first one is the whole
+        # table at some earlier version, the others what changed since
+        self._layers = ((records, frozenset()),) if layers is None else layers
+        self._size = len(records) if size is None else size
+        self._sort = sort
+        self._sorted = None
+        self._flat = None
+        self.version = version
+
+    def updated(self, changed, removed, version):
+        """
+        A new table with the records in `changed` (mac -> record) added or
+        replaced and the macs in `removed` gone, sharing everything else.
+        Layers are merged like the digits of a binary counter, a layer into
+        the one below once it is at least half its size, so lookups see
+        O(log n) layers and a record is copied O(log n) times overall.
+        """
+        size = self._size + \
+               sum(1 for mac in changed if not mac in self) - \
+               sum(1 for mac in removed if mac in self and not mac in changed)
+        layers = list(self._layers)
+        layers.append((dict(changed), \
+                       frozenset(mac for mac in removed if not mac in changed)))
+
+        while len(layers) > 1 and \
+              2 * DeviceTable._layer_size(layers[-1]) >= \
+              DeviceTable._layer_size(layers[-2]):
+            upper = layers.pop()
+            lower = layers.pop()
+            layers.append(DeviceTable._merge(lower, upper, len(layers) == 0))
+
+        return DeviceTable(None, version, self._sort, tuple(layers), size)
+
+    @staticmethod
+    def _layer_size(layer):
+        return len(layer[0]) + len(layer[1])
+
+    @staticmethod
+    def _merge(lower, upper, bottom):
+        records = dict(lower[0])
+        records.update(upper[0])
+        for mac in upper[1]:
+            records.pop(mac, None)
+        if bottom:
+            # nothing below to hide
+            return (records, frozenset())
+        return (records, (lower[1] - upper[0].keys()) | upper[1])
+
+    def __getitem__(self, mac):
+        for records, removed in reversed(self._layers):
+            if mac in records:
+                return records[mac]
+            if mac in removed:
+                break
+        raise KeyError(mac)
+
+    def __contains__(self, mac):
+        for records, removed in reversed(self._layers):
+            if mac in records:
+                return True
+            if mac in removed:
+                return False
+        return False
+
+    def _records(self):
+        if self._flat is None:
+            if len(self._layers) == 1:
+                self._flat = self._layers[0][0]
+            else:
+                flat = {}
+                for records, removed in self._layers:
+                    for mac in removed:
+                        flat.pop(mac, None)
+                    flat.update(records)
+                self._flat = flat
+        return self._flat
+
+    def __iter__(self):
+        return iter(self._records())
+
+    def __len__(self):
+        return self._size
+
+    def sorted(self):
+        if self._sorted is None:
+            self._sorted = tuple(self._sort(self._records()))
+        return self._sorted
@@ -0,0 +1,65 @@
+import time
+import threading
+from collections import deque
+
+
+class Watchdog:
+    """
+    Tells when a bluetoothctl session has to be replaced: its child exited,
+    or it stopped answering. A session that failed `max_failures` commands
+    in a row, or printed nothing for `heartbeat` seconds, is probed with a
+    command that always has a reply; none within `probe_timeout` means it
+    hangs. Keeps the time from the first sign of trouble to the recovered
+    session.
+    """
+
+    def __init__(self, heartbeat=10.0, probe_timeout=1.0, max_failures=3):
+        self.heartbeat = heartbeat
+        self.probe_timeout = probe_timeout
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.failures = 0
+        # when the current outage began, None while the session is fine
+        self.failed_at = None
+        self.respawns = 0
+        # (reason, seconds to recover) of the last respawns
+        self.recoveries = deque(maxlen=32)
+
+    def command_done(self, ok):
+        if ok:
+            # it answers, an earlier timeout was not the start of an outage
+            self.answered()
+        else:
+            self.failures += 1
+            self.failing()
+
+    def failing(self, since=None):
+        if self.failed_at is None:
+            self.failed_at = time.monotonic() if since is None else since
+
+    def should_probe(self, last_read):
+        return self.failures >= self.max_failures or \
+            time.monotonic() - last_read > self.heartbeat
+
+    def answered(self):
+        self.failures = 0
+        self.failed_at = None
+
+    def recovered(self, reason, since=None):
+        """The session was respawned, returns how long it was out."""
+        now = time.monotonic()
+        if since is None:
+            since = now if self.failed_at is None else self.failed_at
+        seconds = now - since
+        with self.lock:
+            self.respawns += 1
+            self.recoveries.append((reason, seconds))
+        self.answered()
+        return seconds
+
+    def get_stats(self):
+        with self.lock:
+            seconds = [recovery[1] for recovery in self.recoveries]
+            return {"respawns": self.respawns, \
+                    "last_recover_ms": 1000 * seconds[-1] if len(seconds) > 0 else 0.0, \
+                    "max_recover_ms": 1000 * max(seconds) if len(seconds) > 0 else 0.0}
@@ -0,0 +1,436 @@
+"""
+Simulated bluetoothctl for running the applets without bluetooth hardware:
+
+    python btapplet.py --bluetoothctl "python simbluetoothctl.py --controllers 2"
+
+It reads commands line by line and answers the way bluetoothctl does: replies
+to a command are printed as plain lines followed by the prompt, while
+asynchronous [NEW]/[CHG]/[DEL] events clear the prompt line, print and redraw
+the prompt after every line. Slow operations (pair, connect) complete later.
+The `menu scan` discovery filter (transport, rssi, duplicate-data, uuids) is
+honoured, so scan profiles change the event rate the way they do on BlueZ.
+
+Instances started by the same process with the same seed share device state
+(discovered, paired, trusted, connected) through a file in /tmp, the way
+bluetoothctl sessions share bluetoothd; events are not shared.
+"""
+import os
+import sys
+import json
+import random
+import select
+import argparse
+import time
+
+
+PROMPT = "\x1b[0;94m[bluetooth]\x1b[0m# "
+COLORS = {"NEW": "\x1b[0;92m", "CHG": "\x1b[0;93m", "DEL": "\x1b[0;91m"}
+
+NAMES = ["WH-1000XM4", "MX Master 3", "K380 Keyboard", "Pixel 7", \
+         "JBL Flip 5", "Galaxy Buds", "Mi Band 6", "AirPods Pro", None, None]
+
+# with duplicate-data off, RSSI changes smaller than this are not reported
+DUPLICATE_RSSI_DELTA = 6
+
+UUIDS = ["Audio Sink                (0000110b-0000-1000-8000-00805f9b34fb)", \
+         "Human Interface Device    (00001124-0000-1000-8000-00805f9b34fb)", \
+         "Generic Access Profile    (00001800-0000-1000-8000-00805f9b34fb)"]
+
+DEVICE_COMMANDS = ["info", "pair", "remove", "trust", "untrust", "connect", "disconnect"]
+
+# (property, value, icon): a BR/EDR class of device or an LE appearance
+KINDS = [("Class", "0x00240418", "audio-headphones"), \
+         ("Class", "0x00002580", "input-mouse"), \
+         ("Class", "0x005a020c", "phone"), \
+         ("Appearance", "0x03c1", "input-keyboard"), \
+         ("Appearance", "0x00c0", "watch"), \
+         None]
+
+
+class SimDevice:
+
+    def __init__(self, rand, controller):
+        self.mac_addr = ":".join("%02X" % rand.randrange(256) for _ in range(6))
+        self.name = rand.choice(NAMES)
+        self.controller = controller
+        self.rssi = rand.randrange(-95, -40)
+        self.reported_rssi = self.rssi
+        self.tx_power = rand.choice([None, 4, 8, 12])
+        self.transport = rand.choice(["le", "le", "bredr", "dual"])
+        self.uuids = rand.sample(UUIDS, rand.randrange(1, len(UUIDS) + 1))
+        self.kind = rand.choice(KINDS)
+        self.discovered = False
+        self.paired = False
+        self.trusted = False
+        self.connected = False
+
+    @property
+    def address_type(self):
+        # LE only devices use a random address, as phones and wearables do
+        return "random" if self.transport == "le" else "public"
+
+    @property
+    def label(self):
+        if self.name is None:
+            return self.mac_addr.replace(":", "-")
+        return self.name
+
+
+class SimController:
+
+    def __init__(self, index):
+        self.mac_addr = "00:1A:7D:DA:71:%02X" % (0x10 + index)
+        self.name = "sim-hci%d" % index
+        self.powered = True
+        self.discovering = False
+        self.devices = {}
+
+
+class SimBluetoothctl:
+
+    def __init__(self, controllers=1, devices=20, rate=5.0, delay=1.0, seed=0):
+        self.rand = random.Random(seed)
+        self.controllers = [SimController(i) for i in range(controllers)]
+        self.default = self.controllers[0]
+        self.rate = rate
+        self.delay = delay
+        self.pending = []
+        self.menu = "main"
+        self.scan_filter = self.default_filter()
+        self.state_file = "/tmp/simbluetoothctl-%d-%d.json" % (os.getppid(), seed)
+        self.state_mtime = None
+        self.dirty = False
+
+        for ctrl in self.controllers:
+            for _ in range(devices):
+                dev = SimDevice(self.rand, ctrl)
+                ctrl.devices[dev.mac_addr] = dev
+
+            # a couple of paired devices, known before any scan
+            for dev in list(ctrl.devices.values())[:2]:
+                dev.paired = dev.trusted = dev.discovered = True
+
+    def save(self):
+        state = dict((dev.mac_addr, [dev.discovered, dev.paired, dev.trusted, dev.connected]) \
+                     for ctrl in self.controllers for dev in ctrl.devices.values())
+        tmp = "%s.%d" % (self.state_file, os.getpid())
+        with open(tmp, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp, self.state_file)
+        self.state_mtime = os.stat(self.state_file).st_mtime_ns
+        self.dirty = False
+
+    def load(self):
+        """Pick up what other instances changed."""
+        if self.dirty:
+            # ours is newer, it is saved after this round
+            return
+        try:
+            mtime = os.stat(self.state_file).st_mtime_ns
+            if mtime == self.state_mtime:
+                return
+            with open(self.state_file) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return
+        self.state_mtime = mtime
+        for ctrl in self.controllers:
+            for dev in ctrl.devices.values():
+                if dev.mac_addr in state:
+                    dev.discovered, dev.paired, dev.trusted, dev.connected = \
+                        state[dev.mac_addr]
+
+    def default_filter(self):
+        return {"transport": "auto", "rssi": None, "duplicate-data": True, "uuids": []}
+
+    def write(self, *lines):
+        for line in lines:
+            sys.stdout.write(line + "\n")
+        sys.stdout.write(PROMPT)
+        sys.stdout.flush()
+
+    def announce(self, *lines):
+        for line in lines:
+            sys.stdout.write("\r\x1b[K" + line + "\n" + PROMPT)
+        sys.stdout.flush()
+
+    def event(self, kind, text):
+        return "[" + COLORS[kind] + kind + "\x1b[0m] " + text
+
+    def later(self, *lines, apply=None):
+        self.pending.append((time.time() + self.delay, lines, apply))
+
+    def find(self, mac_addr):
+        return self.default.devices.get(mac_addr)
+
+    def tick(self):
+        now = time.time()
+        due = [(lines, apply) for when, lines, apply in self.pending if when <= now]
+        self.pending = [job for job in self.pending if job[0] > now]
+        for lines, apply in due:
+            if not apply is None:
+                apply()
+            self.announce(*lines)
+
+        ctrl = self.default
+        if not ctrl.discovering or not ctrl.powered:
+            return
+
+        dev = self.rand.choice(list(ctrl.devices.values()))
+        if not dev.discovered:
+            if not self.matches(dev):
+                return
+            dev.discovered = True
+            self.dirty = True
+            dev.reported_rssi = dev.rssi
+            self.announce(self.event("NEW", "Device %s %s" % (dev.mac_addr, dev.label)))
+            if not dev.kind is None:
+                prop,value,icon = dev.kind
+                self.announce(self.event("CHG", "Device %s %s: %s" % (dev.mac_addr, prop, value)), \
+                              self.event("CHG", "Device %s Icon: %s" % (dev.mac_addr, icon)))
+        else:
+            dev.rssi = max(-100, min(-30, dev.rssi + self.rand.randrange(-4, 5)))
+            if not self.matches(dev):
+                return
+            if not self.scan_filter["duplicate-data"] and \
+               abs(dev.rssi - dev.reported_rssi) < DUPLICATE_RSSI_DELTA:
+                return
+            dev.reported_rssi = dev.rssi
+            self.announce(self.event("CHG", "Device %s RSSI: %d" % (dev.mac_addr, dev.rssi)))
+
+    def matches(self, dev):
+        """Whether the discovery filter lets the device's advertisements through."""
+        transport = self.scan_filter["transport"]
+        if transport != "auto" and not dev.transport in [transport, "dual"]:
+            return False
+
+        threshold = self.scan_filter["rssi"]
+        if not threshold is None and dev.rssi < threshold:
+            return False
+
+        uuids = self.scan_filter["uuids"]
+        if len(uuids) > 0 and \
+           not any(uuid in dev_uuid.lower() for uuid in uuids for dev_uuid in dev.uuids):
+            return False
+        return True
+
+    def controller_change(self, ctrl, prop, value):
+        return self.event("CHG", "Controller %s %s: %s" % \
+                          (ctrl.mac_addr, prop, "yes" if value else "no"))
+
+    def device_change(self, dev, prop, value):
+        return self.event("CHG", "Device %s %s: %s" % \
+                          (dev.mac_addr, prop, "yes" if value else "no"))
+
+    def handle(self, line):
+        args = line.strip().split()
+        if len(args) == 0:
+            self.write()
+            return True
+
+        cmd, arg = args[0], args[1] if len(args) > 1 else None
+        ctrl = self.default
+
+        if cmd in ["quit", "exit"]:
+            return False
+
+        elif cmd == "menu":
+            if arg != "scan":
+                self.write("Unable find menu with name: %s" % arg)
+            else:
+                self.menu = arg
+                self.write("Menu scan:", "Available commands:", "-------------------", \
+                           "uuids, rssi, pathloss, transport, duplicate-data, clear, back")
+
+        elif cmd == "back":
+            self.menu = "main"
+            self.write()
+
+        elif self.menu == "scan":
+            self.handle_filter(cmd, args[1:])
+
+        elif cmd == "list":
+            self.write(*["Controller %s %s%s" % (c.mac_addr, c.name, \
+                         " [default]" if c is ctrl else "") \
+                         for c in self.controllers])
+
+        elif cmd == "select":
+            match = [c for c in self.controllers if c.mac_addr == arg]
+            if len(match) == 0:
+                self.write("Controller %s not available" % arg)
+            else:
+                self.default = match[0]
+                self.write()
+
+        elif cmd == "show":
+            self.write("Controller %s (public)" % ctrl.mac_addr, \
+                       "\tName: %s" % ctrl.name, \
+                       "\tPowered: %s" % ("yes" if ctrl.powered else "no"), \
+                       "\tDiscovering: %s" % ("yes" if ctrl.discovering else "no"))
+
+        elif cmd in ["devices", "paired-devices"]:
+            devs = [dev for dev in ctrl.devices.values() if dev.discovered and \
+                    (cmd == "devices" or dev.paired)]
+            self.write(*["Device %s %s" % (dev.mac_addr, dev.label) for dev in devs])
+
+        elif cmd == "power":
+            ctrl.powered = arg == "on"
+            if not ctrl.powered:
+                ctrl.discovering = False
+            self.write(self.controller_change(ctrl, "Powered", ctrl.powered), \
+                       "Changing power %s succeeded" % arg)
+
+        elif cmd == "discoverable":
+            self.write("Changing discoverable %s succeeded" % arg)
+
+        elif cmd == "scan":
+            ctrl.discovering = arg == "on"
+            self.write("Discovery %s" % ("started" if ctrl.discovering else "stopped"), \
+                       self.controller_change(ctrl, "Discovering", ctrl.discovering))
+
+        elif not cmd in DEVICE_COMMANDS:
+            self.write("Invalid command in menu main: %s" % cmd)
+
+        elif self.find(arg) is None:
+            self.write("Device %s not available" % arg)
+
+        else:
+            self.handle_device(cmd, self.find(arg))
+
+        return True
+
+    def handle_filter(self, cmd, args):
+        if cmd == "clear":
+            default = self.default_filter()
+            for key in (args or list(default.keys())):
+                if key in default:
+                    self.scan_filter[key] = default[key]
+            self.write()
+
+        elif cmd == "transport" and len(args) > 0:
+            self.scan_filter["transport"] = args[0]
+            self.write()
+
+        elif cmd == "rssi" and len(args) > 0:
+            self.scan_filter["rssi"] = int(args[0])
+            self.write()
+
+        elif cmd == "duplicate-data" and len(args) > 0:
+            self.scan_filter["duplicate-data"] = args[0] == "on"
+            self.write()
+
+        elif cmd == "uuids":
+            uuids = [uuid.lower().replace("0x", "") for uuid in args if uuid != "all"]
+            self.scan_filter["uuids"] = uuids
+            self.write()
+
+        elif cmd in ["transport", "rssi", "duplicate-data"]:
+            self.write("%s: %s" % (cmd, self.scan_filter[cmd]))
+
+        else:
+            self.write("Invalid command in menu scan: %s" % cmd)
+
+    def handle_device(self, cmd, dev):
+        if cmd == "info":
+            lines = ["Device %s (%s)" % (dev.mac_addr, dev.address_type)]
+            if not dev.name is None:
+                lines += ["\tName: %s" % dev.name, "\tAlias: %s" % dev.name]
+            lines += ["\tPaired: %s" % ("yes" if dev.paired else "no"), \
+                      "\tTrusted: %s" % ("yes" if dev.trusted else "no"), \
+                      "\tBlocked: no", \
+                      "\tConnected: %s" % ("yes" if dev.connected else "no")]
+            if not dev.kind is None:
+                prop,value,icon = dev.kind
+                lines += ["\t%s: %s" % (prop, value), "\tIcon: %s" % icon]
+            lines += ["\tUUID: %s" % uuid for uuid in dev.uuids]
+            lines += ["\tRSSI: %d" % dev.rssi]
+            if not dev.tx_power is None:
+                lines += ["\tTxPower: %d" % dev.tx_power]
+            self.write(*lines)
+
+        elif cmd == "pair":
+            self.write("Attempting to pair with %s" % dev.mac_addr)
+            def paired():
+                dev.paired = True
+                self.dirty = True
+            self.later(self.device_change(dev, "Paired", True), "Pairing successful", \
+                       apply=paired)
+
+        elif cmd == "remove":
+            dev.paired = dev.trusted = dev.connected = dev.discovered = False
+            self.dirty = True
+            self.write(self.event("DEL", "Device %s %s" % (dev.mac_addr, dev.label)), \
+                       "Device has been removed")
+
+        elif cmd in ["trust", "untrust"]:
+            dev.trusted = cmd == "trust"
+            self.dirty = True
+            self.write(self.device_change(dev, "Trusted", dev.trusted), \
+                       "Changing %s %s succeeded" % (dev.mac_addr, cmd))
+
+        elif cmd == "connect":
+            self.write("Attempting to connect to %s" % dev.mac_addr)
+            if not dev.paired:
+                self.later("Failed to connect: org.bluez.Error.Failed")
+            else:
+                def connected():
+                    dev.connected = True
+                    self.dirty = True
+                self.later(self.device_change(dev, "Connected", True), \
+                           "Connection successful", apply=connected)
+
+        elif cmd == "disconnect":
+            dev.connected = False
+            self.dirty = True
+            self.write("Attempting to disconnect from %s" % dev.mac_addr, \
+                       "Successful disconnected", \
+                       self.device_change(dev, "Connected", False))
+
+        else:
+            self.write("Invalid command in menu main: %s" % cmd)
+
+    def run(self):
+        fd = sys.stdin.fileno()
+        buf = b""
+        self.announce("Agent registered")
+        self.announce(*[self.event("NEW", "Controller %s %s%s" % (c.mac_addr, c.name, \
+                        " [default]" if c is self.default else "")) \
+                        for c in self.controllers])
+        self.announce(*[self.event("NEW", "Device %s %s" % (dev.mac_addr, dev.label)) \
+                        for dev in self.default.devices.values() if dev.discovered])
+        while True:
+            timeout = 1.0 / self.rate if self.rate > 0 else 0.1
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if fd in ready:
+                data = os.read(fd, 4096)
+                if data == b"":
+                    return
+                buf += data
+                while b"\n" in buf:
+                    line, buf = buf.split(b"\n", 1)
+                    self.load()
+                    if not self.handle(line.decode("utf-8", "replace")):
+                        return
+            self.tick()
+            if self.dirty:
+                self.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulated bluetoothctl")
+    parser.add_argument("--controllers", type=int, default=1)
+    parser.add_argument("--devices", type=int, default=20, \
+                        help="fake devices per controller")
+    parser.add_argument("--rate", type=float, default=5.0, \
+                        help="scan events per second while discovering")
+    parser.add_argument("--delay", type=float, default=1.0, \
+                        help="seconds until pair/connect complete")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    SimBluetoothctl(controllers=args.controllers, devices=args.devices, \
+                    rate=args.rate, delay=args.delay, seed=args.seed).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import os
+import sys
+import itertools
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SIMULATOR = os.path.join(ROOT, "simbluetoothctl.py")
+
+# each session gets a state file of its own, see simbluetoothctl.py
+seeds = itertools.count(1000)
+
+
+def sim_command(devices=20, rate=5.0, delay=0.2, seed=None):
+    return "%s %s --devices %d --rate %s --delay %s --seed %d" % \
+        (sys.executable, SIMULATOR, devices, rate, delay, \
+         next(seeds) if seed is None else seed)
+
+
+@pytest.fixture
+def bluetooth():
+    """Factory of Bluetoothctl sessions on the simulator, closed after the test."""
+    bluelib = pytest.importorskip("models.bluetooth")
+    sessions = []
+
+    def spawn(devices=20, rate=5.0, **kwargs):
+        kwargs.setdefault("sighting_log", None)
+        bt = bluelib.Bluetoothctl(rfkill_unblock=False, \
+                                  command=sim_command(devices, rate), **kwargs)
+        sessions.append(bt)
+        return bt
+
+    yield spawn
+    for bt in sessions:
+        bt.enricher.stop()
+        bt.child.close(force=True)
+        if not bt.queries is None:
+            bt.queries.close()
@@ -0,0 +1,138 @@
+import time
+import threading
+import pexpect
+import pytest
+
+from models.daemon import BluetoothDaemon, BluetoothClient, DaemonError
+
+
+class FakeBluetooth:
+    """Counts starts and stops that do not match the scan state."""
+
+    def __init__(self):
+        self.scanning = False
+        self.errors = 0
+
+    def start_scan(self):
+        if self.scanning:
+            self.errors += 1
+        self.scanning = True
+
+    def stop_scan(self):
+        if not self.scanning:
+            self.errors += 1
+        self.scanning = False
+
+
+class SlowSet(set):
+    """Lets the other threads run while the holders are counted."""
+
+    def __len__(self):
+        count = set.__len__(self)
+        time.sleep(0.0005)
+        return count
+
+
+def test_concurrent_scan_holders():
+    bt = FakeBluetooth()
+    daemon = BluetoothDaemon(path=None, scan=False, bluetooth=bt)
+    daemon.scan_holders = SlowSet()
+    lost = []
+
+    def client(name):
+        for _ in range(100):
+            daemon.hold_scan(name)
+            time.sleep(0.001)
+            # nobody may stop the scan while this client holds it
+            if not bt.scanning:
+                lost.append(name)
+            daemon.release_scan(name)
+
+    threads = [threading.Thread(target=client, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert lost == [] and bt.errors == 0
+    assert daemon.scan_holders == set()
+    assert not daemon.scanning and not bt.scanning
+
+
+class FakeSession(FakeBluetooth):
+    """Enough of Bluetoothctl to serve, with a pair that never answers."""
+
+    def __init__(self):
+        super().__init__()
+        self.devices = {"AA": {"paired": False}}
+        self.checks = 0
+
+    def power_on(self):
+        return 0
+
+    def update_devices(self, update_scanned=True, update_paired=True):
+        pass
+
+    def update_controller(self):
+        pass
+
+    def update_device_status(self, mac):
+        pass
+
+    def flush_log(self):
+        pass
+
+    def get_devices(self, sort=False):
+        return []
+
+    def get_controller(self):
+        return {"powered": True}
+
+    def pair(self, mac, sync=True):
+        raise pexpect.TIMEOUT("no reply")
+
+    def trust(self, mac, sync=True):
+        self.devices[mac]["trusted"] = True
+
+    def is_trusted(self, mac):
+        self.checks += 1
+        return self.checks >= 3 and self.devices[mac]["trusted"]
+
+    def connect(self, mac, sync=True):
+        time.sleep(0.6)
+
+
+def serve(tmp_path):
+    path = str(tmp_path / "bt.sock")
+    daemon = BluetoothDaemon(path=path, interval=60, scan=False, bluetooth=FakeSession())
+    daemon.start()
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    return daemon, path
+
+
+def test_failed_command_keeps_the_connection(tmp_path):
+    daemon, path = serve(tmp_path)
+    client = BluetoothClient(path)
+    try:
+        assert client.pair("AA") is None
+        assert client.request("controller") == {"powered": True}
+        # sync waits for the outcome, outside the session lock
+        assert client.trust("AA", sync=True) is True
+        assert daemon.bluetooth.checks == 3
+    finally:
+        client.close()
+        daemon.shutdown()
+
+
+def test_client_reconnects_after_a_timeout(tmp_path):
+    daemon, path = serve(tmp_path)
+    client = BluetoothClient(path, timeout=0.3)
+    try:
+        with pytest.raises(DaemonError):
+            client.request("connect", mac="AA")
+        time.sleep(0.5)
+        # not the late reply to connect
+        assert client.request("controller") == {"powered": True}
+    finally:
+        client.close()
+        daemon.shutdown()
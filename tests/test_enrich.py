@@ -0,0 +1,85 @@
+import time
+import threading
+
+from models.oui import is_locally_administered, write_index, OuiIndex
+from models.enrich import Enricher, decode_class, decode_appearance, \
+                          decode_info, profile_name
+
+
+def test_address_type_decides():
+    # a static random address with bit 1 clear, and the other way round
+    assert is_locally_administered("C4:00:00:00:00:01", "random")
+    assert not is_locally_administered("C6:00:00:00:00:01", "public")
+    assert is_locally_administered("C6:00:00:00:00:01")
+    assert not is_locally_administered("C4:00:00:00:00:01")
+
+
+def test_public_address_with_bit_1_set_has_a_vendor(bluetooth, tmp_path, monkeypatch):
+    import models.bluetooth
+
+    path = str(tmp_path / "oui.idx")
+    write_index([(0xC60000, "Public Vendor"), (0x001122, "Other")], path)
+    index = OuiIndex(path)
+    assert index.lookup("C6:00:00:00:00:01") == "Public Vendor"
+
+    bt = bluetooth(devices=0)
+    monkeypatch.setattr(models.bluetooth, "default_index", lambda: index)
+    assert bt._resolve_vendor("C6:00:00:00:00:01", "public") == "Public Vendor"
+    assert bt._resolve_vendor("C6:00:00:00:00:01", "random") is None
+
+
+def test_vendor_waits_for_the_address_type():
+    calls = []
+    done = threading.Event()
+
+    def resolve_vendor(mac, address_type=None):
+        calls.append((mac, address_type))
+        done.set()
+        return None if address_type == "random" else "Vendor"
+
+    enricher = Enricher(resolve_vendor, fetch_info=lambda mac: {"AddressType": "random"}, \
+                        workers=1)
+    try:
+        enricher.submit("C4:00:00:00:00:01", vendor=True)
+        assert done.wait(2)
+        assert calls == [("C4:00:00:00:00:01", "random")]
+    finally:
+        enricher.stop()
+
+
+def test_info_reports_the_address_type(bluetooth):
+    bt = bluetooth(devices=8, rate=50)
+    bt.start_scan()
+    time.sleep(1)
+    bt.flush_log()
+    bt.update_devices(update_scanned=True)
+    types = set()
+    for mac in list(bt.devices):
+        info = bt.get_device_info(mac, cached=False)
+        types.add(info["AddressType"])
+    assert types == {"random", "public"}
+
+
+def test_decoders():
+    assert decode_class("0x00240418") == "headphones"
+    assert decode_class("0x00002580") == "mouse"
+    assert decode_class("0x005a020c") == "phone"
+    assert decode_class("0x00001f00") is None
+    assert decode_class("garbage") is None
+
+    assert decode_appearance("0x03c1") == "keyboard"
+    assert decode_appearance("0x00c0") == "watch"
+    assert decode_appearance("0xffc0") is None
+
+    assert profile_name("Audio Sink (0000110b-0000-1000-8000-00805f9b34fb)") == "A2DP Sink"
+    assert profile_name("0000180f-0000-1000-8000-00805f9b34fb") == "Battery"
+    assert profile_name("Vendor specific (5052494d-2dab-0341-6972-6f6861424c45)") is None
+    assert profile_name("00001234-0000-1000-8000-00805f9b34fb") is None
+    assert profile_name("Fast Pair (0000fe2c-0000-1000-8000-00805f9b34fb)") == "Fast Pair"
+
+    fields = decode_info({"Class": "0x00240418", "Icon": "audio-headphones", \
+                          "UUIDs": ["0000110b-0000-1000-8000-00805f9b34fb", \
+                                    "0000110b-0000-1000-8000-00805f9b34fb", \
+                                    "00001800-0000-1000-8000-00805f9b34fb"]})
+    assert fields == {"device_class": "headphones", "icon": "audio-headphones", \
+                      "profiles": ("A2DP Sink", "GAP")}
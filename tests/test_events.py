@@ -0,0 +1,88 @@
+import threading
+
+from models.events import DeviceAdded, DeviceChanged, DeviceRemoved, \
+                          ControllerChanged, DeviceEvents, Subscription, coalesce
+
+
+def test_coalesce_merges_per_device():
+    events = [DeviceAdded("AA", {"name": "x", "rssi": -60}, "C0"), \
+              DeviceChanged("BB", {"rssi": -50}, "C0"), \
+              DeviceChanged("AA", {"rssi": -70}, "C0"), \
+              DeviceChanged("BB", {"connected": True}, "C0", folded=3), \
+              ControllerChanged("C0", {"powered": True}), \
+              ControllerChanged("C0", {"discovering": True})]
+    added, changed, controller = coalesce(events)
+
+    assert isinstance(added, DeviceAdded)
+    assert added.device == {"name": "x", "rssi": -70}
+    assert changed.fields == {"rssi": -50, "connected": True}
+    assert changed.folded == 4
+    assert controller.fields == {"powered": True, "discovering": True}
+
+
+def test_coalesce_added_and_removed():
+    assert coalesce([DeviceAdded("AA", {}, "C0"), DeviceRemoved("AA", "C0")]) == []
+
+    # a device that went and came back is upserted
+    events = coalesce([DeviceChanged("AA", {"rssi": -60}, "C0"), \
+                       DeviceRemoved("AA", "C0"), \
+                       DeviceAdded("AA", {"rssi": -40}, "C0")])
+    assert len(events) == 1 and isinstance(events[0], DeviceAdded)
+
+    # the same MAC on two adapters stays apart
+    events = coalesce([DeviceChanged("AA", {"rssi": -60}, "C0"), \
+                       DeviceChanged("AA", {"rssi": -50}, "C1")])
+    assert len(events) == 2
+
+
+def test_slow_consumer_is_coalesced():
+    sub = Subscription(max_batches=2)
+    for rssi in range(-60, -50):
+        sub.put([DeviceChanged("AA", {"rssi": rssi}, "C0"), \
+                 DeviceChanged("BB", {"rssi": rssi}, "C0")])
+
+    assert len(sub.batches) == 2 and sub.coalesced == 8
+    first, last = sub.get(), sub.get()
+    assert len(first) == 2 and first[0].fields == {"rssi": -60}
+    # the other nine batches, one event per device
+    assert [event.fields["rssi"] for event in last] == [-51, -51]
+    assert [event.folded for event in last] == [9, 9]
+    assert sub.get(timeout=0.01) is None
+
+
+def test_subscription_close_ends_iteration():
+    events = DeviceEvents()
+    # nothing is kept while nobody listens
+    events.emit(DeviceRemoved("AA", "C0"))
+    assert events.pending == []
+
+    sub = Subscription()
+    events.attach(sub)
+    batches = []
+    thread = threading.Thread(target=lambda: batches.extend(sub))
+    thread.start()
+
+    events.emit(DeviceAdded("AA", {}, "C0"))
+    events.emit(DeviceChanged("AA", {"rssi": -40}, "C0"))
+    events.flush()
+    sub.close()
+    thread.join(2)
+
+    assert not thread.is_alive()
+    assert len(batches) == 1 and len(batches[0]) == 1
+    assert events.subscriptions == []
+
+
+def test_change_carries_only_what_changed(bluetooth):
+    bt = bluetooth(devices=0)
+    mac = "AA:BB:CC:DD:EE:01"
+    bt._declare_device(mac, "x")
+    bt._publish()
+    subscription = bt.subscribe()
+
+    bt._set_fields(mac, {"connected": True, "time": 1.0})
+    bt._publish()
+    changes = [event for event in subscription.get(timeout=0) \
+               if isinstance(event, DeviceChanged)]
+    assert [event.fields for event in changes] == [{"connected": True}]
+    assert bt.snapshot()[mac]["connected"]
@@ -0,0 +1,112 @@
+import os
+import time
+import signal
+import threading
+
+from models.idle import IdleMonitor, device_state
+
+
+def test_device_state_ignores_signal():
+    dev = {"mac_addr": "AA", "online": True, "paired": False, "connected": False, \
+           "trusted": False, "name": "x", "rssi": -60}
+    moved = dict(dev, rssi=-80)
+    assert device_state([dev]) == device_state([moved])
+    assert device_state([dev]) != device_state([dict(dev, connected=True)])
+
+
+def idle_waiter(monitor):
+    finished = threading.Event()
+    thread = threading.Thread(target=monitor.wait, args=(0.01, finished), daemon=True)
+    thread.start()
+    return thread
+
+
+def test_goes_idle_and_wakes_on_activity():
+    events = []
+    monitor = IdleMonitor(timeout=0.05, on_idle=lambda: events.append("idle"), \
+                          on_wake=lambda: events.append("wake"))
+    time.sleep(0.1)
+    thread = idle_waiter(monitor)
+    thread.join(0.2)
+    assert thread.is_alive() and monitor.idle
+
+    monitor.activity()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert events == ["idle", "wake"]
+    assert monitor.get_stats()["idle_seconds"] > 0
+
+
+def test_active_wait_returns_after_interval():
+    monitor = IdleMonitor(timeout=10)
+    finished = threading.Event()
+    start = time.monotonic()
+    monitor.wait(0.05, finished)
+    assert time.monotonic() - start < 1
+    assert not monitor.idle
+
+
+def test_never_idle_with_timeout_zero():
+    monitor = IdleMonitor(timeout=0)
+    monitor.blur()
+    monitor.wait(0.01, threading.Event())
+    assert not monitor.idle
+
+
+def test_resume_from_signal_handler():
+    monitor = IdleMonitor(timeout=0.01)
+    time.sleep(0.05)
+    thread = idle_waiter(monitor)
+    thread.join(0.2)
+    assert monitor.idle
+
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: monitor.resume())
+    try:
+        # the handler interrupts this thread while it holds the lock
+        with monitor.lock:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.05)
+        thread.join(1)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert not thread.is_alive()
+
+
+def test_duty_cycled_window_closes_while_idle(bluetooth):
+    bt = bluetooth(devices=5)
+    bt.update_controllers()
+    bt.update_controller()
+    bt.power_on()
+    bt.set_scan_profile("low-power")
+    bt.start_scan()
+    assert bt.scan_window_on
+
+    bt.set_idle(True, wake=lambda: None)
+    assert not bt.scan_window_on and bt.scan_wanted
+    bt.set_idle(False)
+    bt.cycle_scan()
+    assert bt.scan_window_on
+
+
+def test_daemon_client_wakes_on_device_change(bluetooth, tmp_path):
+    from models.daemon import BluetoothDaemon, BluetoothClient
+
+    path = str(tmp_path / "bt.sock")
+    daemon = BluetoothDaemon(path=path, interval=0.2, scan=False, \
+                             bluetooth=bluetooth(devices=5, rate=20))
+    daemon.start()
+    threading.Thread(target=daemon.serve_forever, daemon=True).start()
+    client = BluetoothClient(path)
+    try:
+        woken = threading.Event()
+        client.set_idle(True, wake=woken.set)
+        assert not woken.wait(0.6)
+
+        # scanning finds the simulator's devices
+        client.request("scan", on=True)
+        assert woken.wait(5)
+        client.set_idle(False)
+        assert client.idle_stream is None
+    finally:
+        client.close()
+        daemon.shutdown()
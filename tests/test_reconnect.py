@@ -0,0 +1,76 @@
+from models.actions import Action
+from models.reconnect import ReconnectManager
+
+
+class Actions:
+    """Records the actions the manager submits instead of running them."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, kind, mac_addr):
+        action = Action(kind, mac_addr)
+        self.submitted.append(action)
+        return action
+
+
+MAC = "AA:BB:CC:DD:EE:01"
+CONTROLLER = {"powered": True}
+
+
+def device(connected):
+    return {"mac_addr": MAC, "connected": connected, "trusted": True, "paired": True}
+
+
+def dropped(manager):
+    manager.update([device(True)], CONTROLLER)
+    manager.update([device(False)], CONTROLLER)
+
+
+def test_drop_submits_connect():
+    actions = Actions()
+    manager = ReconnectManager(actions)
+    dropped(manager)
+    assert [action.kind for action in actions.submitted] == [Action.Kind.CONNECT]
+    assert manager.get_status()[0][0] == MAC
+
+
+def test_reconnect_is_timed():
+    actions = Actions()
+    manager = ReconnectManager(actions)
+    dropped(manager)
+    actions.submitted[-1].state = Action.State.DONE
+    manager.update([device(True)], CONTROLLER)
+    assert manager.get_status() == []
+    assert list(manager.get_stats()) == [MAC]
+
+
+def test_failed_connect_backs_off():
+    actions = Actions()
+    manager = ReconnectManager(actions, base_delay=100)
+    dropped(manager)
+    actions.submitted[-1].state = Action.State.FAILED
+    manager.update([device(False)], CONTROLLER)
+    mac, attempts, wait = manager.get_status()[0]
+    assert attempts == 1 and wait > 100
+    assert len(actions.submitted) == 1
+
+
+def test_done_but_disconnected_is_retried_and_dropped():
+    actions = Actions()
+    manager = ReconnectManager(actions, base_delay=0, max_attempts=3)
+    dropped(manager)
+    for _ in range(3):
+        actions.submitted[-1].state = Action.State.DONE
+        manager.update([device(False)], CONTROLLER)
+    # retried, then given up instead of pending for good
+    assert len(actions.submitted) == 3
+    assert manager.get_status() == []
+
+
+def test_forget_stops_reconnecting():
+    actions = Actions()
+    manager = ReconnectManager(actions)
+    dropped(manager)
+    manager.forget(MAC)
+    assert manager.get_status() == []
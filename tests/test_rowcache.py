@@ -0,0 +1,28 @@
+from views.rowcache import RowCache
+
+
+def fields(view):
+    return ("name",) if view == "all" else ("name", "distance")
+
+
+def test_unshown_changes_reuse_the_row():
+    cache = RowCache(lambda view, idx, data, action: "%d %s" % (idx, data["name"]), fields)
+    dev = {"mac_addr": "AA", "controller": "C0", "name": "x", "rssi": -60, \
+           "distance": 1.0}
+
+    assert cache.get("all", 0, dev, None) == "0 x"
+    # rssi is not on the row
+    cache.get("all", 0, dict(dev, rssi=-70), None)
+    assert cache.formatted == 1
+
+    cache.get("all", 0, dict(dev, name="y"), None)
+    cache.get("all", 1, dict(dev, name="y"), None)
+    cache.get("all", 1, dict(dev, name="y"), ("connect", "running"))
+    assert cache.formatted == 4
+
+    cache.get("nearby", 1, dict(dev, name="y"), None)
+    cache.get("nearby", 1, dict(dev, name="y", distance=2.0), None)
+    assert cache.formatted == 6
+
+    cache.retain({})
+    assert cache.rows == {}
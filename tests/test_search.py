@@ -0,0 +1,73 @@
+from models.search import DeviceIndex
+
+
+def test_search_names_and_addresses():
+    index = DeviceIndex()
+    index.update("AA:BB:CC:00:00:01", "JBL Flip 5")
+    index.update("AA:BB:CC:00:00:02", "MX Master 3")
+    index.update("11:22:33:00:00:03", None)
+
+    assert index.search("flip") == {"AA:BB:CC:00:00:01"}
+    assert index.search("aabbcc") == {"AA:BB:CC:00:00:01", "AA:BB:CC:00:00:02"}
+    assert index.search("11:22") == {"11:22:33:00:00:03"}
+    assert index.search("m") == {"AA:BB:CC:00:00:02"}
+    assert len(index.search("")) == 3
+    assert index.search("nothing") == set()
+
+
+def test_narrowing_and_updates():
+    index = DeviceIndex()
+    index.update("AA", "speaker one")
+    index.update("BB", "speaker two")
+
+    assert index.search("speaker") == {"AA", "BB"}
+    # narrows the last result
+    assert index.search("speaker t") == {"BB"}
+
+    # a rename invalidates it
+    index.update("AA", "speaker three")
+    assert index.search("speaker th") == {"AA"}
+    assert index.search("one") == set()
+
+    index.remove("AA")
+    assert index.search("speaker") == {"BB"}
+    assert not any("AA" in postings for postings in index.grams.values())
+    index.remove("AA")
+
+
+def test_vendor_is_searchable():
+    index = DeviceIndex()
+    index.update("AA", "WH-1000XM4", "Sony Corporation")
+    assert index.search("sony") == {"AA"}
+    index.update("AA", "WH-1000XM4")
+    assert index.search("sony") == set()
+
+
+def test_named_device_found_by_vendor(bluetooth, monkeypatch):
+    bt = bluetooth(devices=0)
+    mac = "AA:BB:CC:DD:EE:04"
+    bt.logger.info("[NEW] Device %s WH-1000XM4" % mac)
+    bt._update_from_discover_log()
+    monkeypatch.setattr(bt.enricher, "results", lambda: [(mac, {"vendor": "Sony Corporation"})])
+    bt._apply_enrichment()
+
+    assert bt.devices[mac]["name"] == "WH-1000XM4"
+    assert bt.search("sony") == {mac}
+
+
+def test_client_forgets_departed_devices():
+    from models.daemon import BluetoothClient
+
+    client = BluetoothClient.__new__(BluetoothClient)
+    client.devices = {}
+    client.index = DeviceIndex()
+    listed = [{"mac_addr": "AA", "name": "Speaker", "vendor": "Sony", "time": 0}, \
+              {"mac_addr": "BB", "name": "Mouse", "vendor": None, "time": 0}]
+    client.request = lambda op: listed
+    client.update_devices()
+    assert client.search("sony") == {"AA"}
+
+    listed = listed[1:]
+    client.update_devices()
+    assert client.search("speaker") == set()
+    assert client.search("") == {"BB"}
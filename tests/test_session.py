@@ -0,0 +1,154 @@
+import os
+import time
+import signal
+
+
+def start_scanning(bt):
+    bt.update_controllers()
+    bt.update_controller()
+    bt.power_on()
+    bt.set_scan_profile("le")
+    bt.start_scan()
+    for _ in range(3):
+        time.sleep(0.3)
+        bt.update_devices()
+
+
+def wait_for_respawn(bt, respawns=1, timeout=10):
+    deadline = time.monotonic() + timeout
+    while bt.watchdog.respawns < respawns and time.monotonic() < deadline:
+        time.sleep(0.2)
+        bt.update_devices()
+    return bt.watchdog.respawns >= respawns
+
+
+def test_killed_mid_scan_is_respawned(bluetooth):
+    bt = bluetooth(devices=30, rate=50)
+    start_scanning(bt)
+    pid = bt.child.pid
+    known = len(bt.devices)
+    assert known > 0
+
+    os.kill(pid, signal.SIGKILL)
+    assert wait_for_respawn(bt)
+    assert bt.child.pid != pid
+    assert bt.replay_pending is None
+
+    events = bt.rssi_events
+    for _ in range(5):
+        time.sleep(0.3)
+        bt.update_devices()
+    # back where it was: scanning with the same filter, devices kept
+    assert bt.scan_wanted and bt.scan_window_on and bt.profile_applied
+    assert bt.scan_profile.name == "le"
+    assert bt.rssi_events > events
+    assert len(bt.devices) >= known
+    stats = bt.watchdog.get_stats()
+    assert 0 < stats["last_recover_ms"] < 5000
+
+
+def test_hung_session_is_respawned(bluetooth):
+    bt = bluetooth(devices=10, rate=20)
+    start_scanning(bt)
+    bt.watchdog.heartbeat = 0.5
+    pid = bt.child.pid
+    os.kill(pid, signal.SIGSTOP)
+    try:
+        assert wait_for_respawn(bt)
+    finally:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # closed by the respawn already
+            pass
+    assert bt.scan_window_on
+
+
+def test_failed_replay_is_retried(bluetooth):
+    bt = bluetooth(devices=10, rate=20)
+    start_scanning(bt)
+
+    scan_on = bt._scan_on
+    bt._scan_on = lambda: None
+    os.kill(bt.child.pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while bt.replay_pending is None and time.monotonic() < deadline:
+        time.sleep(0.2)
+        bt.update_devices()
+    # the new child answers, only the replay knows the scan is missing
+    assert not bt.replay_pending is None
+    assert bt.watchdog.respawns == 0
+
+    bt._scan_on = scan_on
+    time.sleep(0.2)
+    bt.update_devices()
+    assert bt.replay_pending is None
+    assert bt.scan_window_on
+    assert bt.watchdog.respawns == 1
+
+
+def test_query_pool_answers_and_restarts():
+    from conftest import sim_command
+    from models.session import QueryPool
+
+    def devices(session):
+        # the first reply may carry the startup banner ("Agent registered")
+        return [line for line in session.query("devices") if line.startswith("Device ")]
+
+    pool = QueryPool(sim_command(devices=5, rate=50), size=2)
+    try:
+        lines = devices(pool)
+        assert len(lines) > 0
+        mac = lines[0].split(" ")[1]
+        info = pool.query("info " + mac)
+        assert "Device %s (random)" % mac in info or "Device %s (public)" % mac in info
+        assert any(line.startswith("\tPaired: ") for line in info)
+
+        # a session that died is left out, then replaced
+        dead = pool.sessions[0]
+        dead.child.close(force=True)
+        assert not dead.healthy and pool.healthy
+        for _ in range(3):
+            assert devices(pool) == lines
+
+        pool.restart_failed()
+        assert dead.healthy
+        assert pool.get_stats()["query0"]["restarts"] == 1
+        assert devices(dead) == lines
+    finally:
+        pool.close()
+
+
+def test_probe_ignores_earlier_output(bluetooth):
+    bt = bluetooth(devices=5)
+    bt.update_controller()
+    assert bt._probe()
+
+    pid = bt.child.pid
+    os.kill(pid, signal.SIGSTOP)
+    try:
+        # read before the probe, from a child that has hung since
+        with bt.reader.cond:
+            bt.reader.pieces.append("[CHG] Controller %s Discovering: yes\n" % \
+                                    bt.controller["mac_addr"])
+        assert not bt._probe()
+    finally:
+        os.kill(pid, signal.SIGKILL)
+
+
+def test_late_reply_is_not_taken_for_the_next(monkeypatch):
+    import itertools
+    from conftest import sim_command
+    from models.session import QuerySession
+
+    session = QuerySession(sim_command(devices=5))
+    try:
+        expected = [line for line in session.query("devices") if line.startswith("Device ")]
+        # the late reply to a query that timed out, with a longer marker number
+        with session.reader.cond:
+            session.reader.pieces.append("Device 00:00:00:00:00:00 stale\n")
+            session.reader.pieces.append("Invalid command in menu main: marker-20\n")
+        monkeypatch.setattr(QuerySession, "markers", itertools.count(2))
+        assert session.query("devices") == expected
+    finally:
+        session.close()
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+
+from models.sightings import SightingLog, SightingHistory, HEADER, RECORD, \
+                             EVENT_NEW, EVENT_RSSI, EVENT_DEL, NO_VALUE, int_to_mac
+
+
+def fill(log, count, start=1000.0, macs=("AA:00:00:00:00:01", "AA:00:00:00:00:02")):
+    for idx in range(count):
+        log.add(start + idx, macs[idx % len(macs)], EVENT_RSSI, rssi=-40 - idx % 30)
+
+
+def test_queries(tmp_path):
+    path = str(tmp_path / "sightings.log")
+    log = SightingLog(path, flush_interval=0, max_bytes=None)
+    log.add(999.0, "AA:00:00:00:00:01", EVENT_NEW)
+    fill(log, 100)
+    log.add(1100.0, "AA:00:00:00:00:02", EVENT_DEL)
+    log.add(1101.0, "not a mac", EVENT_NEW)
+    log.flush()
+
+    history = SightingHistory(path)
+    assert len(history) == 102
+    assert len(history.between(1010, 1020)) == 10
+    assert len(history.between(event=EVENT_DEL)) == 1
+    assert len(history.device("AA:00:00:00:00:01", 1000, 1010)) == 5
+    assert history.last_seen("AA:00:00:00:00:02")["event"] == EVENT_DEL
+    assert history.last_seen("AA:00:00:00:00:03") is None
+    assert history.between(998, 1000)["rssi"][0] == NO_VALUE
+
+    devices = history.devices()
+    assert [dev[0] for dev in devices] == ["AA:00:00:00:00:01", "AA:00:00:00:00:02"]
+    mac, count, first, last, strongest = devices[0]
+    assert (count, first, strongest) == (51, 999.0, -40)
+
+    # appended records show up on refresh
+    fill(log, 10, start=2000.0)
+    log.close()
+    history.refresh()
+    assert len(history) == 112 and history.ordered
+
+
+def test_partial_record_is_dropped(tmp_path):
+    path = str(tmp_path / "sightings.log")
+    log = SightingLog(path, max_bytes=None)
+    fill(log, 3)
+    log.close()
+    with open(path, "ab") as fh:
+        fh.write(b"\0" * 5)
+
+    SightingLog(path, max_bytes=None).close()
+    assert len(SightingHistory(path)) == 3
+
+
+def test_log_is_rotated(tmp_path):
+    path = str(tmp_path / "sightings.log")
+    max_bytes = 2 * (HEADER.size + 500 * RECORD.itemsize)
+    log = SightingLog(path, batch=64, max_bytes=max_bytes)
+    history = SightingHistory(path)
+
+    fill(log, 5000)
+    log.flush(force=True)
+    assert os.path.getsize(path) + os.path.getsize(path + ".1") <= max_bytes
+    assert log.get_stats()["rotations"] >= 8
+
+    # the newest records survive, in order, across both segments
+    history.refresh()
+    times = history.records["time"]
+    assert times[-1] == 1000.0 + 4999
+    assert len(history) == len(times) >= 500 and history.ordered
+    assert np.all(np.diff(times) == 1)
+    assert len(history.between(1000.0 + 4990)) == 10
+    assert history.last_seen("AA:00:00:00:00:02")["time"] == 1000.0 + 4999
+
+    # a rotation while mapped
+    fill(log, 600, start=10000.0)
+    log.close()
+    history.refresh()
+    assert history.records["time"][-1] == 10599.0 and history.ordered
+    assert len(history) <= 2 * 500
+
+
+def test_replaced_log_is_reopened(tmp_path):
+    path = str(tmp_path / "sightings.log")
+    first = SightingLog(path, max_bytes=None)
+    second = SightingLog(path, max_bytes=HEADER.size + 100 * RECORD.itemsize)
+    fill(second, 300)
+    second.flush(force=True)
+
+    # the rotation swapped the file under the first writer
+    fill(first, 1, start=5000.0)
+    first.close()
+    second.close()
+    assert SightingHistory(path).records["time"][-1] == 5000.0
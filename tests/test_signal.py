@@ -0,0 +1,91 @@
+import time
+import numpy as np
+
+from models.signal import SignalHistory
+from models.events import DeviceChanged
+
+
+def test_smoothing_and_trend():
+    history = SignalHistory(capacity=2)
+    now = time.time()
+    for idx in range(10):
+        history.add_rssi("AA", -80 + idx, now - 10 + idx)
+        history.add_rssi("BB", -50, now - 10 + idx)
+    history.add_rssi("CC", -60, now)
+    history.update(now)
+
+    rssi, trend, distance = history.get("AA")
+    assert -80 < rssi < -70
+    assert trend > 0.5
+    rssi, trend, distance = history.get("BB")
+    assert rssi == -50 and trend == 0.0
+    assert history.get("DD") == (None, 0.0, None)
+
+
+def test_jitter_publishes_no_proximity_change(bluetooth):
+    bt = bluetooth(devices=0)
+    mac = "AA:BB:CC:DD:EE:01"
+    bt._declare_device(mac, "jitter")
+    rand = np.random.default_rng(0)
+
+    start = time.time()
+    for tick in range(5):
+        bt.signal.add_rssi(mac, -60 + int(rand.integers(-1, 2)), start + tick * 0.2)
+    bt._update_signal(start + 1.0)
+    bt._publish()
+    subscription = bt.subscribe()
+
+    for tick in range(5, 150):
+        bt.signal.add_rssi(mac, -60 + int(rand.integers(-1, 2)), start + tick * 0.2)
+        if tick % 5 == 0:
+            bt._update_signal(start + tick * 0.2)
+            bt._publish()
+
+    changes = []
+    batch = subscription.get(timeout=0)
+    while not batch is None:
+        changes += [event for event in batch \
+                    if isinstance(event, DeviceChanged) and event.mac_addr == mac]
+        batch = subscription.get(timeout=0)
+    assert changes == []
+
+
+def test_approaching_device_is_published(bluetooth):
+    bt = bluetooth(devices=0)
+    mac = "AA:BB:CC:DD:EE:02"
+    bt._declare_device(mac, "approaching")
+    start = time.time()
+    for tick in range(50):
+        bt.signal.add_rssi(mac, -90 + tick // 5, start + tick * 0.2)
+    bt._update_signal(start + 10.0)
+    assert bt.devices[mac]["rssi_trend"] >= 0.5
+
+
+def test_removed_row_is_reused():
+    history = SignalHistory(capacity=2)
+    history.add_rssi("AA", -50)
+    history.add_rssi("BB", -60)
+    history.remove("AA")
+    assert history.get("AA") == (None, 0.0, None)
+
+    history.add_rssi("CC", -70)
+    assert history.capacity == 2 and history.used == 2
+    history.update()
+    assert round(history.get("CC")[0]) == -70
+    assert round(history.get("BB")[0]) == -60
+
+
+def test_deleted_device_is_forgotten(bluetooth):
+    bt = bluetooth(devices=0)
+    mac = "AA:BB:CC:DD:EE:03"
+    bt.logger.info("[NEW] Device %s Speaker" % mac)
+    bt.logger.info("[CHG] Device %s RSSI: -50" % mac)
+    bt._update_from_discover_log()
+    assert bt.search("speaker") == {mac}
+    assert mac in bt.signal.rows
+
+    bt.logger.info("[DEL] Device %s Speaker" % mac)
+    bt._update_from_discover_log()
+    assert bt.search("speaker") == set()
+    assert not mac in bt.signal.rows
+    assert bt.signal.free == [0]
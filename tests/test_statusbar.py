@@ -0,0 +1,66 @@
+import io
+import os
+import signal
+import pytest
+
+from views.statusbar import StatusBar
+
+
+class Quiet:
+    """A session with nothing going on; the bar may wait on it forever."""
+
+    def __init__(self):
+        self.devices = {}
+        self.timeouts = []
+        self.updates = 0
+
+    def update_devices(self, update_scanned=True, update_paired=True):
+        self.updates += 1
+
+    def update_controller(self):
+        pass
+
+    def get_controller(self):
+        return {"powered": True, "discovering": False}
+
+    def wait_for_event(self, timeout=None):
+        self.timeouts.append(timeout)
+        if len(self.timeouts) == 2:
+            raise KeyboardInterrupt()
+        return True
+
+
+def test_local_bar_blocks_until_an_event():
+    out = io.StringIO()
+    bluetooth = Quiet()
+    with pytest.raises(KeyboardInterrupt):
+        StatusBar(StatusBar.Mode.I3BLOCKS, out=out).run_local(bluetooth)
+
+    # no timed wakeups, one refresh per event, one line while nothing changes
+    assert bluetooth.timeouts == [None, None]
+    assert bluetooth.updates == 2
+    assert out.getvalue() == "BT on\n"
+
+
+def test_a_burst_of_events_wakes_once(bluetooth):
+    bt = bluetooth(devices=5)
+    bt.update_controller()
+    pid = bt.child.pid
+    os.kill(pid, signal.SIGSTOP)
+    try:
+        bt.reader.drain()
+        mac = bt.controller["mac_addr"]
+        with bt.reader.cond:
+            for idx in range(20):
+                bt.reader.pieces.append("[CHG] Device AA:00:00:00:00:%02d RSSI: -60\n" % idx)
+            # a line still being read is left for the next wait
+            bt.reader.tail, bt.reader.tail_consumed = "[CHG] Controller %s Pow" % mac, 0
+
+        assert bt.wait_for_event(timeout=1)
+        with bt.reader.cond:
+            assert "".join(bt.reader.pieces) == ""
+            assert bt.reader.tail[bt.reader.tail_consumed:].endswith(" Pow")
+            bt.reader.tail = ""
+        assert not bt.wait_for_event(timeout=0.1)
+    finally:
+        os.kill(pid, signal.SIGKILL)
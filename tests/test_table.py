@@ -0,0 +1,43 @@
+import random
+
+from models.table import DeviceTable
+
+
+def sort(records):
+    return sorted(records)
+
+
+def test_updates_share_unchanged_records():
+    rand = random.Random(3)
+    expected = dict(("M%03d" % idx, {"n": idx}) for idx in range(200))
+    table = DeviceTable(dict(expected), 0, sort)
+    snapshots = [(table, dict(expected))]
+
+    for version in range(1, 400):
+        changed, removed = {}, set()
+        for _ in range(rand.randint(1, 8)):
+            mac = "M%03d" % rand.randrange(260)
+            if rand.random() < 0.2:
+                removed.add(mac)
+                changed.pop(mac, None)
+            else:
+                changed[mac] = {"n": version}
+                removed.discard(mac)
+        for mac in removed:
+            expected.pop(mac, None)
+        expected.update(changed)
+
+        table = table.updated(changed, removed, version)
+        snapshots.append((table, dict(expected)))
+
+    # O(log n) layers, and every earlier snapshot still reads as it was
+    assert len(table._layers) <= 10
+    for table, expected in snapshots[::37] + snapshots[-3:]:
+        assert len(table) == len(expected)
+        assert dict(table) == expected
+        assert table.sorted() == tuple(sorted(expected))
+        assert not "M999" in table
+
+    # a record that did not change is the same object
+    base = DeviceTable({"A": {"n": 1}, "B": {"n": 2}}, 0, sort)
+    assert base.updated({"B": {"n": 3}}, (), 1)["A"] is base["A"]
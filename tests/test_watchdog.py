@@ -0,0 +1,37 @@
+import time
+
+from models.watchdog import Watchdog
+
+
+def test_failures_trigger_probe():
+    watchdog = Watchdog(heartbeat=10, max_failures=3)
+    now = time.monotonic()
+    assert not watchdog.should_probe(now)
+    for _ in range(3):
+        watchdog.command_done(False)
+    assert watchdog.should_probe(now)
+    watchdog.command_done(True)
+    assert not watchdog.should_probe(now)
+    assert watchdog.should_probe(now - 11)
+
+
+def test_answered_command_ends_outage():
+    watchdog = Watchdog()
+    watchdog.command_done(False)
+    watchdog.failed_at -= 3600
+    watchdog.command_done(True)
+
+    watchdog.failing()
+    seconds = watchdog.recovered("exited")
+    assert seconds < 1
+    stats = watchdog.get_stats()
+    assert stats["respawns"] == 1
+    assert stats["last_recover_ms"] < 1000
+
+
+def test_recovery_measured_from_first_failure():
+    watchdog = Watchdog()
+    watchdog.failing(time.monotonic() - 2)
+    watchdog.failing()
+    assert 2 <= watchdog.recovered("hung") < 3
+    assert watchdog.failed_at is None
@@ -0,0 +1,41 @@
+import os
+from picotui.screen import Screen
+
+
+class FrameBuffer:
+    """
+    Collects what picotui writes while it is open and sends it to the
+    terminal in one write() on close, instead of a syscall for every escape
+    sequence and text fragment. Nested frames (a resize signal landing in
+    the middle of a paint) write into the outermost one.
+    """
+
+    depth = 0
+    chunks = []
+    wr = None
+
+    @staticmethod
+    def _wr(s):
+        if isinstance(s, str):
+            s = bytes(s, "utf-8")
+        FrameBuffer.chunks.append(s)
+
+    def __enter__(self):
+        if FrameBuffer.depth == 0:
+            FrameBuffer.chunks = []
+            FrameBuffer.wr = Screen.__dict__["wr"]
+            Screen.wr = FrameBuffer.__dict__["_wr"]
+        FrameBuffer.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        FrameBuffer.depth -= 1
+        if FrameBuffer.depth > 0:
+            return False
+
+        Screen.wr = FrameBuffer.wr
+        data = memoryview(b"".join(FrameBuffer.chunks))
+        FrameBuffer.chunks = []
+        while len(data) > 0:
+            data = data[os.write(1, data):]
+        return False
@@ -11,8 +11,19 @@ class WListBox2(ChoiceWidget):
     def __init__(self, w, h, items, margin=2):
         ChoiceWidget.__init__(self, 0)
         self.margin = margin
-        self.width = w - margin
-        self.height = h - margin
+        self.resize(w, h)
+
+        self.items = []
+        self.keys = []
+        self.choice = 0
+        # screen line -> (text, selected) as last written
+        self.painted = {}
+        self.y_offset = 0
+        self.rendering = False
+
+    def resize(self, w, h):
+        self.width = w - self.margin
+        self.height = h - self.margin
 
         self.w = w
         self.h = h
@@ -20,21 +31,27 @@ class WListBox2(ChoiceWidget):
         if self.height <= 2:
             raise Exception("height of list box must be at least 3")
 
-
-        self.items = []
-        self.choice = 0
-        self.y_offset = 0
         self.center = math.floor(h/2)
-        self.rendering = False
+        self.painted = {}
 
     @property
     def n(self):
         return len(self.items)
 
-    def set_lines(self, items):
+    def set_lines(self, items, keys=None, redraw=True):
+        """
+        Replace the items, `keys` identify them so the selection follows
+        the same item when it moves. Only the lines that differ from what
+        is on screen are written.
+        """
+        selected = self.keys[self.choice] if self.choice < len(self.keys) else None
         self.items = items
-        self.move_sel(0)
-        self.redraw()
+        self.keys = keys if not keys is None else []
+        if not selected is None and selected in self.keys:
+            self.choice = self.keys.index(selected)
+        self.choice = min(max(0, self.choice), self.n-1) if self.n > 0 else 0
+        if redraw:
+            self.update()
         self.signal("changed")
 
     def handle_key(self, key):
@@ -44,10 +61,9 @@ class WListBox2(ChoiceWidget):
             self.move_sel(1)
 
     def move_sel(self, direction):
-        self.redraw()
         new_idx = min(max(0,self.choice+ direction),self.n-1)
-        self.choice = new_idx
-        self.redraw()
+        self.choice = max(new_idx, 0)
+        self.update()
         self.signal("changed")
 
     def handle_edit_key(self, key):
@@ -71,16 +87,10 @@ class WListBox2(ChoiceWidget):
             return lo
 
 
-    def wr_line(self,idx):
-        text = self.items[idx]
-        low = self.get_window()
-        if idx < low or idx > low + self.height-1:
-            return
-
-        offset = (idx-low)
+    def wr_line(self,offset,text,selected):
         self.goto(self.x + self.margin,  \
                   self.y + offset + self.margin)
-        if idx == self.choice:
+        if selected:
             self.attr_color(C_B_BLUE,None)
         else:
             self.attr_color(C_B_WHITE,None)
@@ -89,10 +99,21 @@ class WListBox2(ChoiceWidget):
         self.wr_fixedw(text.strip(),self.width)
         self.attr_reset()
 
+    def update(self):
+        """Write the visible lines whose text or highlight changed."""
+        low = self.get_window()
+        for offset in range(self.height):
+            idx = low + offset
+            if idx < self.n:
+                line = (self.items[idx], idx == self.choice)
+            else:
+                line = ("", False)
+            if self.painted.get(offset) != line:
+                self.wr_line(offset, *line)
+                self.painted[offset] = line
 
     def redraw(self):
         self.rendering = True
-        for idx,text in enumerate(self.items):
-            self.wr_line(idx)
+        self.painted = {}
+        self.update()
         self.rendering = False
- 
@@ -0,0 +1,33 @@
+class RowCache:
+    """
+    Formatted text of the device list. A row is formatted by `format` only
+    when one of the device fields it shows changed (`fields(view)` names
+    them), or when the view, its position or its pending action did;
+    otherwise the text from the last refresh is reused. A device whose
+    record only changed in something the row leaves out, e.g. its RSSI in
+    the paired view, keeps its text.
+    """
+
+    def __init__(self, format, fields):
+        self.format = format
+        self.fields = fields
+        # mac -> (key, text)
+        self.rows = {}
+        self.formatted = 0
+
+    def get(self, view, idx, data, action):
+        shown = tuple(data[field] for field in self.fields(view))
+        key = (data["controller"], view, idx, action, shown)
+        cached = self.rows.get(data["mac_addr"])
+        if not cached is None and cached[0] == key:
+            return cached[1]
+
+        text = self.format(view, idx, data, action)
+        self.rows[data["mac_addr"]] = (key, text)
+        self.formatted += 1
+        return text
+
+    def retain(self, macs):
+        """Drop the rows of devices that are no longer listed."""
+        for mac in [mac for mac in self.rows if not mac in macs]:
+            del self.rows[mac]
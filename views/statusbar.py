@@ -0,0 +1,87 @@
+import sys
+import json
+
+
+class StatusBar:
+    """
+    Renders the bluetooth state as an i3bar block (JSON protocol) or as an
+    i3blocks line. A block is only written when its visible text changes.
+    """
+
+    class Mode:
+        I3BAR = "i3bar"
+        I3BLOCKS = "i3blocks"
+
+    COLOR_OFF = "#777777"
+    COLOR_ON = "#ffffff"
+    COLOR_CONNECTED = "#44aaff"
+
+    def __init__(self, mode=Mode.I3BAR, out=sys.stdout, name="bluetooth"):
+        self.mode = mode
+        self.out = out
+        self.name = name
+        self.last_block = None
+        self.started = False
+
+    def render(self, devices, controller):
+        connected = sorted(dev["name"] if not dev["name"] is None \
+                           else dev["mac_addr"] \
+                           for dev in devices if dev["connected"])
+
+        if controller.get("powered") is False:
+            text, color = "BT off", StatusBar.COLOR_OFF
+        elif len(connected) > 0:
+            text, color = "BT " + ", ".join(connected), \
+                          StatusBar.COLOR_CONNECTED
+        else:
+            text, color = "BT on", StatusBar.COLOR_ON
+
+        if controller.get("discovering"):
+            text += " (scan)"
+
+        return {"name": self.name, \
+                "full_text": text, \
+                "short_text": "BT %d" % len(connected), \
+                "color": color}
+
+    def _start(self):
+        if self.mode == StatusBar.Mode.I3BAR:
+            self.out.write(json.dumps({"version": 1}) + "\n[\n")
+        self.started = True
+
+    def update(self, devices, controller):
+        """Write a block if the rendered state differs from the last one."""
+        block = self.render(devices, controller)
+        if block == self.last_block:
+            return False
+
+        if not self.started:
+            self._start()
+
+        if self.mode == StatusBar.Mode.I3BAR:
+            prefix = "" if self.last_block is None else ","
+            self.out.write(prefix + json.dumps([block]) + "\n")
+        else:
+            self.out.write(block["full_text"] + "\n")
+
+        self.out.flush()
+        self.last_block = block
+        return True
+
+    def run_local(self, bluetooth):
+        """Drive the bar from our own bluetoothctl session; blocks on its pty."""
+        bluetooth.update_devices()
+        bluetooth.update_controller()
+        self.update(bluetooth.devices.values(), bluetooth.get_controller())
+
+        while True:
+            # nothing wakes us while nothing changes; a child that exits is
+            # seen as EOF here and respawned by wait_for_event
+            bluetooth.wait_for_event(timeout=None)
+            bluetooth.update_devices(update_scanned=True, update_paired=False)
+            self.update(bluetooth.devices.values(), bluetooth.get_controller())
+
+    def run_attached(self, client):
+        """Drive the bar from a daemon subscription; blocks on the socket."""
+        for msg in client.subscribe():
+            self.update(msg["devices"], msg["controller"])
@@ -0,0 +1,11 @@
+from collections import namedtuple
+
+
+# Everything the applet paints. A snapshot is built by whoever fetched the
+# data and never changed afterwards; newer state replaces the whole
+# snapshot, so redraws can paint the last one from any thread without
+# asking bluetoothctl or the daemon for anything.
+ViewModel = namedtuple("ViewModel", ["header", "lines", "rows", "status", "message"])
+
+EMPTY_VIEW = ViewModel(header="<current view>", lines=(), rows=(), \
+                       status="<status line>", message="<feedback>")